@@ -5,22 +5,42 @@ from main.models import Camera
 from main.models import Event
 from main.models import Image
 from main.models import Video
+from main.models import Usage
+
+from services.usage import COUNTERS
+from services.capture import get_zone_cameras
 
 
 def get_model_names():
     return ['%s %s' % ()]
 
 
+def get_usage(rows):
+    """Returns the sum of the counters of Usage rows."""
+    usage = dict.fromkeys(COUNTERS, 0)
+    for row in rows:
+        for key in COUNTERS:
+            usage[key] += getattr(row, key)
+    usage['bytes'] = usage['image_bytes'] + usage['video_bytes']
+    return usage
+
+
 class ZoneSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = Zone
-        fields = ('url', 'name', 'parent', 'children', 'cameras')
+        fields = ('url', 'name', 'parent', 'children', 'cameras', 'usage')
 
     url = serializers.HyperlinkedIdentityField(view_name='api.zone-detail')
     parent = serializers.RelatedField()
     children = serializers.RelatedField(many=True)
     cameras = serializers.HyperlinkedRelatedField(many=True,
                                                   view_name='api.camera-detail')
+    usage = serializers.SerializerMethodField('get_usage')
+
+    def get_usage(self, obj):
+        """Usage of the cameras in the zone and the zones nested in it."""
+        return get_usage(Usage.objects.filter(
+            camera__in=get_zone_cameras(obj).values('id')))
 
 
 class ImageSerializer(serializers.HyperlinkedModelSerializer):
@@ -36,17 +56,20 @@ class ImageSerializer(serializers.HyperlinkedModelSerializer):
 class VideoSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = Video
-        fields = ('url', 'timestamp', 'duration', 'stream')
+        fields = ('url', 'timestamp', 'duration', 'closed', 'segmented',
+                  'stream', 'playlist')
 
     url = serializers.HyperlinkedIdentityField(view_name='api.video-detail')
     timestamp = serializers.DateTimeField(source='created')
     stream = serializers.HyperlinkedIdentityField(view_name='api.video-stream')
+    playlist = serializers.HyperlinkedIdentityField(view_name='api.video-playlist')
 
 
 class EventSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = Event
-        fields = ('url', 'camera', 'name', 'timestamp', 'image', 'video')
+        fields = ('url', 'camera', 'name', 'timestamp', 'count', 'closed',
+                  'image', 'video')
 
     url = serializers.HyperlinkedIdentityField(view_name='api.event-detail')
     camera = serializers.HyperlinkedRelatedField(view_name='api.camera-detail')
@@ -61,10 +84,15 @@ class CameraSerializer(serializers.ModelSerializer):
     class Meta:
         model = Camera
         fields = ('url', 'href', 'name', 'model', 'username', 'password',
-                  'auth', 'key', 'events')
+                  'preroll', 'auth', 'key', 'events', 'usage')
         read_only_fields = ('auth', 'key')
 
     url = serializers.HyperlinkedIdentityField(view_name='api.camera-detail')
     href = serializers.URLField(source='url')
     model = serializers.CharField(read_only=True, source='model')
     events = serializers.HyperlinkedIdentityField(view_name='api.camera-events')
+    usage = serializers.SerializerMethodField('get_usage')
+
+    def get_usage(self, obj):
+        # Prefetched for lists.
+        return get_usage(obj.usage.all())
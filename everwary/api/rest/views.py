@@ -1,8 +1,13 @@
+import math
+
 from rest_framework.views import APIView
+from rest_framework.response import Response
 from rest_framework import mixins
 from rest_framework import generics
 
+from django.http import HttpResponse
 from django.http import StreamingHttpResponse
+from django.core.urlresolvers import reverse
 from django.shortcuts import get_object_or_404
 
 from main.models import Zone
@@ -10,6 +15,12 @@ from main.models import Camera
 from main.models import Event
 from main.models import Image
 from main.models import Video
+from main.models import Segment
+from main.models import Usage
+from main.cameras import REGISTRY
+
+from services.capture import get_capturer
+from services.capture import get_zone_cameras
 
 from api.rest.filters import EventFilter
 from api.rest.serializers import ZoneSerializer
@@ -17,6 +28,7 @@ from api.rest.serializers import CameraSerializer
 from api.rest.serializers import EventSerializer
 from api.rest.serializers import ImageSerializer
 from api.rest.serializers import VideoSerializer
+from api.rest.serializers import get_usage
 
 
 class StreamView(APIView):
@@ -64,13 +76,31 @@ class ZoneDetail(mixins.RetrieveModelMixin, mixins.UpdateModelMixin,
         return self.destroy(request, *args, **kwargs)
 
 
+class ZoneCapture(APIView):
+    """Captures a still from every camera in the zone, and the zones nested
+    in it, right now."""
+    def post(self, request, *args, **kwargs):
+        zone = get_object_or_404(Zone, user=request.user, pk=kwargs['pk'])
+        images, failed = get_capturer().capture(get_zone_cameras(zone))
+        return Response({
+            'images': ImageSerializer(images, many=True,
+                                      context={'request': request}).data,
+            'failed': [{
+                'camera': request.build_absolute_uri(reverse(
+                    'api.camera-detail', kwargs={'pk': camera.pk})),
+                'error': str(e),
+            } for camera, e in failed],
+        })
+
+
 class CameraList(mixins.ListModelMixin, mixins.CreateModelMixin,
                  generics.GenericAPIView):
     model = Camera
     serializer_class = CameraSerializer
 
     def get_queryset(self):
-        return Camera.objects.filter(zone__user=self.request.user)
+        return Camera.objects.filter(zone__user=self.request.user) \
+            .prefetch_related('usage')
 
     def get(self, request, *args, **kwargs):
         return self.list(request, *args, **kwargs)
@@ -108,6 +138,23 @@ class CameraEventList(mixins.ListModelMixin, generics.GenericAPIView):
         return self.list(request, *args, **kwargs)
 
 
+class CameraModelList(APIView):
+    """Lists the camera makes and models that are supported."""
+    def get(self, request, *args, **kwargs):
+        return Response([{'make': make, 'model': model} for make, model in
+                         REGISTRY.supported()])
+
+
+class UsageDetail(APIView):
+    """Shows the files stored for all of your cameras, and your quota in
+    bytes (null for none)."""
+    def get(self, request, *args, **kwargs):
+        usage = get_usage(Usage.objects.filter(user=request.user,
+                                               camera=None))
+        usage['quota'] = Usage.objects.get_quota(request.user.id)
+        return Response(usage)
+
+
 class CameraRecord(APIView):
     def post(self):
         pass
@@ -186,3 +233,37 @@ class VideoDetail(mixins.RetrieveModelMixin, generics.GenericAPIView):
 
 class VideoStream(StreamView):
     model = Video
+
+
+class VideoPlaylist(APIView):
+    """An HLS playlist of the segments of a video. The playlist of a video
+    being recorded lists the segments written so far, players reload it
+    until the end is listed."""
+    def get(self, request, *args, **kwargs):
+        video = get_object_or_404(Video, camera__zone__user=request.user,
+                                  segmented=True, pk=kwargs['pk'])
+        segments = list(video.segments.all())
+        lines = [
+            '#EXTM3U',
+            '#EXT-X-VERSION:3',
+            '#EXT-X-TARGETDURATION:%d' % max([math.ceil(s.duration) for s in
+                                              segments] or [1]),
+            '#EXT-X-MEDIA-SEQUENCE:0',
+        ]
+        for segment in segments:
+            lines.append('#EXTINF:%.3f,' % segment.duration)
+            lines.append(reverse('api.video-segment', kwargs={
+                'pk': video.pk, 'sequence': segment.sequence}))
+        if video.closed is not None:
+            lines.append('#EXT-X-ENDLIST')
+        return HttpResponse('\n'.join(lines) + '\n',
+                            content_type='application/vnd.apple.mpegurl')
+
+
+class SegmentStream(APIView):
+    def get(self, request, *args, **kwargs):
+        o = get_object_or_404(Segment.objects.select_related('video'),
+                              video__camera__zone__user=request.user,
+                              video__pk=kwargs['pk'],
+                              sequence=kwargs['sequence'])
+        return StreamingHttpResponse(o.open(), content_type=o.video.mime)
@@ -3,8 +3,10 @@ from django.conf.urls import url
 
 from api.rest.views import ZoneList
 from api.rest.views import ZoneDetail
+from api.rest.views import ZoneCapture
 from api.rest.views import CameraList
 from api.rest.views import CameraDetail
+from api.rest.views import CameraModelList
 from api.rest.views import CameraEventList
 from api.rest.views import CameraRecord
 from api.rest.views import EventList
@@ -15,14 +17,19 @@ from api.rest.views import ImageStream
 from api.rest.views import VideoList
 from api.rest.views import VideoDetail
 from api.rest.views import VideoStream
+from api.rest.views import VideoPlaylist
+from api.rest.views import SegmentStream
+from api.rest.views import UsageDetail
 
 
 urlpatterns = patterns(
     '',
     url(r'^zones/$', ZoneList.as_view(), name='api.zone-list'),
     url(r'^zones/(?P<pk>[0-9]+)/$', ZoneDetail.as_view(), name='api.zone-detail'),
+    url(r'^zones/(?P<pk>[0-9]+)/capture/$', ZoneCapture.as_view(), name='api.zone-capture'),
 
     url(r'^cameras/$', CameraList.as_view(), name='api.camera-list'),
+    url(r'^cameras/models/$', CameraModelList.as_view(), name='api.camera-models'),
     url(r'^cameras/(?P<pk>[0-9]+)/$', CameraDetail.as_view(), name='api.camera-detail'),
     url(r'^cameras/(?P<pk>[0-9]+)/events/$', CameraEventList.as_view(), name='api.camera-events'),
     url(r'^cameras/(?P<pk>[0-9]+)/record/$', CameraRecord.as_view(), name='api.camera-record'),
@@ -37,4 +44,8 @@ urlpatterns = patterns(
     url(r'^videos/$', VideoList.as_view(), name='api.video-list'),
     url(r'^videos/(?P<pk>[0-9a-f\-]+)/$', VideoDetail.as_view(), name='api.video-detail'),
     url(r'^videos/(?P<pk>[0-9a-f\-]+)/stream/$', VideoStream.as_view(), name='api.video-stream'),
+    url(r'^videos/(?P<pk>[0-9a-f\-]+)/playlist.m3u8$', VideoPlaylist.as_view(), name='api.video-playlist'),
+    url(r'^videos/(?P<pk>[0-9a-f\-]+)/segments/(?P<sequence>[0-9]+)/$', SegmentStream.as_view(), name='api.video-segment'),
+
+    url(r'^usage/$', UsageDetail.as_view(), name='api.usage'),
 )
@@ -213,10 +213,155 @@ REST_FRAMEWORK = {
 
 ALARM_IMAGE_DIR = os.path.join(tempfile.tempdir, 'everwary')
 
+# Storage class for Image and Video files. The default keeps them in
+# ALARM_IMAGE_DIR, in directories per camera, day and key prefix. Recording
+# video needs a local storage.
+FILE_STORAGE = 'main.storage.ShardedFileSystemStorage'
+
+# Store identical stills once, as a blob named after the SHA-256 digest of
+# its content, rather than as a file per Image.
+IMAGE_DEDUPLICATE = True
+
+# Storage class for Image files, FILE_STORAGE when None. With
+# 'main.storage.PackStorage' stills are appended to a file per camera and day
+# in IMAGE_PACK_DIR (ALARM_IMAGE_DIR/packs when None), compacted by
+# `manage.py retention` as stills are deleted.
+IMAGE_STORAGE = None
+IMAGE_PACK_DIR = None
+
 GEARMAN_SERVERS = (
     'localhost',
 )
 
+# Runs tasks queued by the ingest servers. The Gearman backend needs gearmand
+# and `manage.py worker`, the local backend runs tasks on TASK_WORKERS threads
+# within each process, for single node installs.
+TASK_BACKEND = 'services.async.backends.gearmand.GearmanBackend'
+# TASK_BACKEND = 'services.async.backends.local.LocalBackend'
+TASK_WORKERS = 4
+if TESTING:
+    TASK_BACKEND = 'services.async.backends.EagerBackend'
+
+# Number of jobs each `manage.py worker` process runs at once.
+WORKER_CONCURRENCY = 8
+# Each worker serves metrics (queue latency, run time, payload size, errors
+# per task) as JSON on this local port when set, and writes them to this file
+# every few seconds, %(pid)s is replaced with the process id.
+WORKER_STATS_PORT = None
+WORKER_STATS_FILE = os.path.join(tempfile.gettempdir(), 'everwary-worker-%(pid)s.json')
+
+# Camera health checks (manage.py cron) run on HEALTH_WORKERS threads, each
+# probe times out after HEALTH_TIMEOUT seconds. Probes are spread over the
+# first HEALTH_SPREAD seconds of each run, runs start every HEALTH_INTERVAL
+# seconds with --loop.
+HEALTH_WORKERS = 256
+HEALTH_TIMEOUT = 2
+HEALTH_SPREAD = 30
+HEALTH_INTERVAL = 60
+# An alert is sent when a camera fails this many health checks in a row.
+HEALTH_ALERT_AFTER = 3
+
+# The scheduler (manage.py scheduler) picks up changed periods this often, in
+# seconds.
+SCHEDULER_RELOAD_INTERVAL = 5
+
+# The FTP and SMTP servers cache camera credentials, entries expire after
+# CAMERA_CACHE_TTL seconds, which bounds how long a change made by another
+# process (such as the web application) goes unnoticed.
+CAMERA_CACHE_SIZE = 10000
+CAMERA_CACHE_TTL = 60
+
+# Images and events received by the FTP and SMTP servers are inserted in
+# batches, once INGEST_BATCH_SIZE rows are waiting or the oldest has waited
+# INGEST_BATCH_INTERVAL seconds.
+INGEST_BATCH_SIZE = 100
+INGEST_BATCH_INTERVAL = 1.0
+
+# Stills a camera sends within MOTION_COALESCE_WINDOW seconds of the last
+# dispatched motion task are collected into a single task. 0 dispatches a
+# task for every still.
+MOTION_COALESCE_WINDOW = 10
+
+# The recorder listens for commands from the motion task on this UNIX socket,
+# so workers must run on the same host as the recorder.
+RECORDER_SOCKET = '/tmp/everwary-recorder.sock'
+
+# Record video as segments of RECORD_SEGMENT_TIME seconds, each registered as
+# soon as it is written, rather than as a single file. Segments are stream
+# copied when the camera's codec allows.
+RECORD_SEGMENTED = True
+RECORD_SEGMENT_TIME = 10
+
+# Cameras with pre-roll (Camera.preroll) are buffered in RECORD_PREROLL_DIR as
+# segments of RECORD_PREROLL_SEGMENT_TIME seconds, held in memory up to
+# RECORD_PREROLL_CAMERA_MAX_BYTES per camera and RECORD_PREROLL_MAX_BYTES in
+# total. Memory use is served as JSON on RECORDER_STATS_PORT when set.
+RECORD_PREROLL_DIR = os.path.join(tempfile.gettempdir(), 'everwary-preroll')
+RECORD_PREROLL_SEGMENT_TIME = 2
+RECORD_PREROLL_CAMERA_MAX_BYTES = 16 * 1024 * 1024
+RECORD_PREROLL_MAX_BYTES = 256 * 1024 * 1024
+RECORDER_STATS_PORT = None
+
+# Threads running the blocking operations of camera backends that have no
+# asynchronous version, see BaseCamera.
+CAMERA_WORKERS = 16
+
+# Stills are captured from many cameras at once (for example all the cameras
+# in a zone) on CAPTURE_WORKERS threads, with at most CAPTURE_PER_HOST
+# requests to any one host, each allowed CAPTURE_TIMEOUT seconds.
+CAPTURE_WORKERS = 64
+CAPTURE_PER_HOST = 2
+CAPTURE_TIMEOUT = 10
+
+# Finished recordings and stills (stills UPLOAD_IMAGE_AGE seconds old) are
+# moved to the UPLOAD_STORE object store by `manage.py uploader`, every
+# UPLOAD_INTERVAL seconds with --loop, and evicted locally. Up to UPLOAD_FILES
+# files are sent at once, those over UPLOAD_PART_SIZE bytes as multipart
+# uploads, with parts and segments sent on UPLOAD_WORKERS threads, at up to
+# UPLOAD_RATE bytes per second when set. None disables uploads.
+UPLOAD_STORE = None
+# UPLOAD_STORE = 'main.storage.S3ObjectStore'
+UPLOAD_BUCKET = 'everwary'
+# Host of an S3 compatible store, None for Amazon S3.
+UPLOAD_HOST = None
+UPLOAD_INTERVAL = 10
+UPLOAD_IMAGE_AGE = 300
+UPLOAD_FILES = 4
+UPLOAD_WORKERS = 8
+UPLOAD_PART_SIZE = 8 * 1024 * 1024
+UPLOAD_RATE = None
+
+# Images, videos and events are deleted by `manage.py retention` (every
+# RETENTION_INTERVAL seconds with --loop) once older than the Retention policy
+# of their camera or user, or RETENTION_DAYS days without one. Alerts, and
+# their image and video, are kept RETENTION_ALERT_DAYS days when longer. None
+# keeps everything. Rows are deleted RETENTION_BATCH_SIZE at a time, with a
+# pause of RETENTION_BATCH_PAUSE seconds between batches.
+RETENTION_DAYS = None
+RETENTION_ALERT_DAYS = None
+RETENTION_INTERVAL = 3600
+RETENTION_BATCH_SIZE = 500
+RETENTION_BATCH_PAUSE = 0.1
+
+# Files stored per camera and user are counted as they are written, uploaded
+# and deleted (see Usage), and recounted by `manage.py usage` every
+# USAGE_RECONCILE_INTERVAL seconds with --loop. Stills from users storing
+# more than their quota (Usage.quota, or USAGE_QUOTA bytes) are refused,
+# ingest servers look quotas up every USAGE_QUOTA_CACHE_TTL seconds. None
+# for no quota. A camera moved to another user is charged to its new user
+# within USAGE_USER_CACHE_TTL seconds.
+USAGE_QUOTA = None
+USAGE_QUOTA_CACHE_TTL = 10
+USAGE_USER_CACHE_TTL = 60
+USAGE_RECONCILE_INTERVAL = 86400
+
+# SQLite database holding per camera state (last motion, last alert, disabled)
+# shared by the ingest servers, workers and recorder on this host. When empty
+# state is kept in memory, within each process.
+STATE_DB = os.path.join(tempfile.gettempdir(), 'everwary-state.db')
+if TESTING:
+    STATE_DB = None
+
 # Override settings if local settings file exists.
 try:
     local_settings = os.path.join(os.path.dirname(__file__), 'settings_local.py')
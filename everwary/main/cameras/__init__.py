@@ -1,10 +1,17 @@
 import os
 import glob
+import logging
+import threading
 
 from django.utils import importlib
 
 
+LOGGER = logging.getLogger(__name__)
+
 BACKEND_PATTERN = '*.py'
+# Third party packages can provide backends by declaring entry points in
+# this group, pointing at a backend class or a module of backends.
+ENTRY_POINT_GROUP = 'everwary.cameras'
 
 
 def iter_backends():
@@ -18,25 +25,92 @@ def iter_backends():
             continue
         # Remove the extension
         path = os.path.splitext(path)[0]
-        yield importlib.import_module('%s.%s' % (__name__, path))
+        try:
+            yield importlib.import_module('%s.%s' % (__name__, path))
+        except ImportError:
+            LOGGER.exception('Could not load camera backend %s', path)
+
+
+def iter_entry_points():
+    """Iterates over the modules and classes provided by entry points."""
+    try:
+        import pkg_resources
+    except ImportError:
+        return
+    for entry_point in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP):
+        try:
+            yield entry_point.load()
+        except Exception:
+            LOGGER.exception('Could not load camera backend %s', entry_point)
 
 
 def iter_cameras(module):
     for name in dir(module):
         klass = getattr(module, name)
-        if hasattr(klass, 'make') and hasattr(klass, 'model'):
+        if isinstance(klass, type) and getattr(klass, 'make', None) and \
+           getattr(klass, 'models', None):
             yield klass
 
 
+def normalize(name):
+    """Normalizes a make or model name for lookups."""
+    return ' '.join((name or '').split()).lower()
+
+
+class Registry(object):
+    """Maps (make, model) to the backend class supporting it. Backends are
+    found the first time the registry is used, lookups are then a dict
+    access. Make and model are matched ignoring case and repeated
+    whitespace."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.backends = None
+
+    def register(self, klass, backends=None):
+        if backends is None:
+            backends = self.get_backends()
+        for model in klass.models:
+            backends[(normalize(klass.make), normalize(model))] = klass
+
+    def load(self):
+        backends = {}
+        for module in iter_backends():
+            for klass in iter_cameras(module):
+                self.register(klass, backends)
+        for obj in iter_entry_points():
+            for klass in ([obj] if isinstance(obj, type) else iter_cameras(obj)):
+                self.register(klass, backends)
+        return backends
+
+    def get_backends(self):
+        if self.backends is None:
+            with self.lock:
+                if self.backends is None:
+                    self.backends = self.load()
+        return self.backends
+
+    def get(self, make, model):
+        """Returns the backend class for a make and model, or None."""
+        return self.get_backends().get((normalize(make), normalize(model)))
+
+    def supported(self):
+        """Returns a sorted list of the supported (make, model) pairs, as
+        named by their backends."""
+        models = set()
+        for klass in set(self.get_backends().values()):
+            models.update((klass.make, model) for model in klass.models)
+        return sorted(models)
+
+
+REGISTRY = Registry()
+
+
 def get_backend(camera):
     """Finds a camera backend that supports the given make/model."""
-    # Asks each available backend if this make/model is supported.
-    for module in iter_backends():
-        for klass in iter_cameras(module):
-            if ((getattr(klass, 'make', '').lower() == camera.make and
-                 camera.model in getattr(klass, 'models', []))):
-                return klass(camera)
-    raise NotSupportedError(camera)
+    klass = REGISTRY.get(camera.make, camera.model)
+    if klass is None:
+        raise NotSupportedError(camera)
+    return klass(camera)
 
 
 class NotSupportedError(Exception):
@@ -1,33 +1,123 @@
+import os
+import threading
+
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from main.models import Image
 from main.models import Video
 
 
 MODELS = {
 }
 
+# Segment container for each stream codec that can be copied without
+# re-encoding, as (ffmpeg format, extension, mime type).
+SEGMENT_FORMATS = {
+    'h264': ('mpegts', 'ts', 'video/mp2t'),
+    'mjpeg': ('matroska', 'mkv', 'video/x-matroska'),
+}
+# Other codecs are re-encoded to H.264 in this format.
+DEFAULT_SEGMENT_FORMAT = SEGMENT_FORMATS['h264']
+
+EXECUTOR = None
+EXECUTOR_LOCK = threading.Lock()
+
+
+def run_async(f, *args, **kwargs):
+    """Runs a blocking call on a pool shared by all backends, returning a
+    future of its result."""
+    global EXECUTOR
+    with EXECUTOR_LOCK:
+        if EXECUTOR is None:
+            EXECUTOR = ThreadPoolExecutor(getattr(settings, 'CAMERA_WORKERS', 16))
+    return EXECUTOR.submit(f, *args, **kwargs)
+
 
 class BaseCamera(object):
     mime = 'video/x-msvideo'
     make = None
     models = MODELS.keys()
+    # Codec of the video stream given by get_input_args().
+    codec = None
 
     def __init__(self, camera):
         self.camera = camera
 
-    def get_video(self):
-        return Video.objects.create(camera=self.camera, mime=self.mime)
+    def get_segment_format(self):
+        return SEGMENT_FORMATS.get(self.codec, DEFAULT_SEGMENT_FORMAT)
 
-    def health(self):
-        """Performs a camera health check."""
-        raise NotImplemented()
+    def get_video(self, segmented=False):
+        mime = self.get_segment_format()[2] if segmented else self.mime
+        return Video.objects.create(camera=self.camera, mime=mime,
+                                    segmented=segmented)
+
+    def health(self, session=requests, timeout=5):
+        """Performs a camera health check, returns True if the camera
+        answers HTTP requests."""
+        try:
+            session.get(self.camera.url, timeout=timeout)
+        except requests.RequestException:
+            return False
+        return True
+
+    def get_snapshot_url(self):
+        """Returns the URL of a still image from the camera."""
+        raise NotImplementedError()
 
-    def capture(self):
+    def snapshot(self, session=requests, timeout=10):
+        """Grabs a still image, returns an unsaved Image and its content."""
+        r = session.get(self.get_snapshot_url(), timeout=timeout)
+        r.raise_for_status()
+        mime = r.headers.get('Content-Type') or 'image/jpeg'
+        return Image(camera=self.camera, mime=mime.split(';')[0]), r.content
+
+    def capture(self, session=requests, timeout=10):
         """Captures a still image."""
-        raise NotImplemented()
+        image, content = self.snapshot(session=session, timeout=timeout)
+        image.write(content)
+        image.save(force_insert=True)
+        return image
 
     def record(self):
         """Starts recording video."""
         raise NotImplemented()
 
+    def get_input_args(self):
+        """Returns the ffmpeg arguments that read the camera's video
+        stream."""
+        raise NotImplementedError()
+
+    def get_record_args(self, video):
+        """Returns the command line of a process that records video to the
+        given Video's path, and stops cleanly on SIGINT."""
+        if video.segmented:
+            return self.get_segment_args(video.get_segment_dir(),
+                                         video.get_segment_list())
+        return ['ffmpeg', '-nostdin'] + self.get_input_args() + \
+            [video.get_path()]
+
+    def get_segment_args(self, directory, segment_list, segment_time=None):
+        """Returns an ffmpeg command line that writes the video to
+        `directory` as segments of `segment_time` seconds, appending each to
+        `segment_list` as it is closed. The stream is copied as is when its
+        codec allows."""
+        format, ext, mime = self.get_segment_format()
+        if self.codec in SEGMENT_FORMATS:
+            codec = ['-c', 'copy']
+        else:
+            codec = ['-c:v', 'libx264', '-preset', 'veryfast']
+        if segment_time is None:
+            segment_time = getattr(settings, 'RECORD_SEGMENT_TIME', 10)
+        return ['ffmpeg', '-nostdin'] + self.get_input_args() + codec + [
+            '-f', 'segment', '-segment_time', str(segment_time),
+            '-segment_format', format, '-reset_timestamps', '1',
+            '-segment_list', segment_list, '-segment_list_type', 'csv',
+            os.path.join(directory, '%%05d.%s' % ext)]
+
     def stop(self):
         """Stops recording video."""
         raise NotImplemented()
@@ -35,3 +125,23 @@ class BaseCamera(object):
     def configure(self):
         """Auto-configures the camera."""
         raise NotImplemented()
+
+    # Asynchronous versions of the operations above return a Future. By
+    # default they run the blocking version on a shared pool. Backends that
+    # can do without a thread override them, and have the blocking version
+    # wait on the future.
+
+    def health_async(self, **kwargs):
+        return run_async(self.health, **kwargs)
+
+    def capture_async(self):
+        return run_async(self.capture)
+
+    def record_async(self):
+        return run_async(self.record)
+
+    def stop_async(self):
+        return run_async(self.stop)
+
+    def configure_async(self):
+        return run_async(self.configure)
@@ -1,13 +1,13 @@
-import time
-import signal
-import urllib
 import urlparse
 
-from sh import ffmpeg
+import requests
 
-from django.utils import timezone
+from concurrent.futures import Future
+
+from django.conf import settings
 
 from main.cameras.base import BaseCamera
+from main.cameras.process import WATCHER
 
 
 MODELS = {
@@ -19,6 +19,7 @@ MODELS = {
 class Camera(BaseCamera):
     make = 'Foscam'
     models = MODELS.keys()
+    codec = 'mjpeg'
 
     def __init__(self, camera):
         super(Camera, self).__init__(camera)
@@ -31,8 +32,6 @@ class Camera(BaseCamera):
         # http://192.168.1.89:88/CGIProxy.fcgi?usr=admin&pwd=12345&cmd=setSubStreamFormat&format=1
         # Capture stream
         # http://192.168.1.87:88/cgi-bin/CGIStream.cgi?cmd=GetMJStream\&usr=admin\&pwd=12345
-        # TODO: use requests.
-        urlp = urlparse.urlsplit(self.camera.url)
         params = {
             'usr': self.camera.username,
             'pwd': self.camera.password,
@@ -43,39 +42,54 @@ class Camera(BaseCamera):
         elif type == 'stream':
             path = '/cgi-bin/CGIStream.cgi'
             params['cmd'] = 'GetMJStream'
+        elif type == 'snapshot':
+            path = '/cgi-bin/CGIProxy.fcgi'
+            params['cmd'] = 'snapPicture2'
         else:
             raise Exception('Invalid URL type %s' % type)
-        return urlparse.SplitResult(urlp.scheme, urlp.netloc,
-                                    path, urllib.urlencode(params),
-                                    urlp.fragment).geturl()
+        return requests.Request('GET', urlparse.urljoin(self.camera.url, path),
+                                params=params).prepare().url
+
+    def get_snapshot_url(self):
+        return self.build_url('snapshot')
+
+    def get_input_args(self):
+        return ['-f', 'mjpeg', '-i', self.build_url('stream')]
 
     def record(self):
         """Records video."""
-        v = self.get_video()
-        p = ffmpeg('-f', 'mjpeg', '-i', self.build_url('stream'), v.get_path(),
-                   _bg=True)
-        self.recording = (p, v)
+        return self.record_async().result()
+
+    def record_async(self):
+        # Segmented as by the recorder, see get_record_args().
+        v = self.get_video(segmented=getattr(settings, 'RECORD_SEGMENTED',
+                                             True))
+        process, exited = WATCHER.spawn(self.get_record_args(v))
+        self.recording = (process, exited, v)
+        future = Future()
+        future.set_result(v)
+        return future
 
     def stop(self):
         """Stop recording."""
+        return self.stop_async().result()
+
+    def stop_async(self):
+        """Asks ffmpeg to stop, escalating to SIGTERM then SIGKILL, the
+        returned future completes with the video once ffmpeg exits."""
+        future = Future()
         if self.recording is None:
-            return
-        p, v = self.recording
-        # Ask ffmpeg nicely to stop recording
-        p.process.signal(signal.SIGINT)
-        timestamp = time.time()
-        while p.process.alive:
-            # Wait 15 seconds then yell at ffmpeg
-            if time.time() - timestamp >= 15:
-                p.process.terminate()
-            # Wait 30 seconds then fucking stab ffmpeg
-            if time.time() - timestamp >= 30:
-                p.process.kill()
-            # Wait 45 seconds then go nuclear on ffmpeg
-            if time.time() - timestamp >= 45:
-                raise Exception('Runaway recording process')
-            time.sleep(0.01)
+            future.set_result(None)
+            return future
+        p, exited, v = self.recording
         self.recording = None
-        v.duration = (timezone.now() - v.created).seconds
-        v.save()
-        return v
+
+        def finish(f):
+            try:
+                v.close()
+            except Exception, e:
+                future.set_exception(e)
+            else:
+                future.set_result(v)
+        WATCHER.stop(p, exited).add_done_callback(finish)
+        return future
@@ -0,0 +1,151 @@
+import os
+import time
+import heapq
+import errno
+import fcntl
+import signal
+import select
+import logging
+import threading
+import subprocess
+
+from concurrent.futures import Future
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Seconds after asking a process to stop before it is terminated, then killed.
+TERMINATE_AFTER = 15
+KILL_AFTER = 30
+
+
+def send_signal(process, signum):
+    try:
+        os.kill(process.pid, signum)
+    except OSError, e:
+        if e.errno != errno.ESRCH:
+            raise
+
+
+class ProcessWatcher(object):
+    """Supervises any number of child processes from a single thread.
+
+    Each process is spawned with its stderr on a pipe, the pipe reaches EOF
+    when the process exits, so the thread sleeps in select() until a process
+    exits or a timer is due, rather than polling. Processes must not leave
+    children of their own holding stderr.
+
+    Futures returned by spawn() and stop() are completed on this thread, so
+    their callbacks should be quick."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.processes = {}
+        self.timers = []
+        self.sequence = 0
+        self.thread = None
+        # Wakes the thread when a process or timer is added.
+        self.wake_r, self.wake_w = os.pipe()
+        for fd in (self.wake_r, self.wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                                               name='process-watcher')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def wake(self):
+        try:
+            os.write(self.wake_w, 'x')
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def spawn(self, args):
+        """Starts a process. Returns it, and a future of its exit status."""
+        null = open(os.devnull, 'r+')
+        try:
+            process = subprocess.Popen(args, stdin=null, stdout=null,
+                                       stderr=subprocess.PIPE,
+                                       close_fds=True)
+        finally:
+            null.close()
+        exited = Future()
+        exited.set_running_or_notify_cancel()
+        with self.lock:
+            self.processes[process.stderr.fileno()] = (process, exited)
+        self.start()
+        self.wake()
+        return process, exited
+
+    def call_later(self, delay, f, *args):
+        with self.lock:
+            self.sequence += 1
+            heapq.heappush(self.timers, (time.time() + delay, self.sequence,
+                                         f, args))
+        self.start()
+        self.wake()
+
+    def stop(self, process, exited, terminate_after=TERMINATE_AFTER,
+             kill_after=KILL_AFTER):
+        """Asks a process to stop with SIGINT, then SIGTERM and SIGKILL if
+        it is still running after `terminate_after` and `kill_after`
+        seconds. Returns `exited`."""
+        def escalate(signum):
+            if not exited.done():
+                send_signal(process, signum)
+        send_signal(process, signal.SIGINT)
+        self.call_later(terminate_after, escalate, signal.SIGTERM)
+        self.call_later(kill_after, escalate, signal.SIGKILL)
+        return exited
+
+    def run(self):
+        while True:
+            with self.lock:
+                fds = self.processes.keys()
+                timeout = None
+                if self.timers:
+                    timeout = max(0, self.timers[0][0] - time.time())
+            try:
+                r, w, x = select.select([self.wake_r] + fds, [], [], timeout)
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                r = []
+            for fd in r:
+                if fd == self.wake_r:
+                    try:
+                        os.read(self.wake_r, 4096)
+                    except OSError, e:
+                        if e.errno != errno.EAGAIN:
+                            raise
+                else:
+                    self.read(fd)
+            self.run_timers()
+
+    def read(self, fd):
+        if os.read(fd, 4096):
+            # Output is discarded, only EOF matters.
+            return
+        with self.lock:
+            process, exited = self.processes.pop(fd)
+        process.stderr.close()
+        exited.set_result(process.wait())
+
+    def run_timers(self):
+        now = time.time()
+        while True:
+            with self.lock:
+                if not self.timers or self.timers[0][0] > now:
+                    return
+                when, sequence, f, args = heapq.heappop(self.timers)
+            try:
+                f(*args)
+            except Exception:
+                LOGGER.exception('Error running %r', f)
+
+
+WATCHER = ProcessWatcher()
@@ -1,17 +1,33 @@
 import os
+import time
 import uuid
+import shutil
 import mimetypes
+import collections
 
 from datetime import timedelta
 
 from django.db import models
+from django.db import transaction
+from django.db import IntegrityError
+from django.db.models import F
+from django.db.models import Q
+from django.db.models.signals import post_save
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.db.models.query import QuerySet
-from django.conf import settings
 from django.utils import timezone
 from django.utils.translation import ugettext as _
+from django.conf import settings
 from django.contrib.auth.models import User
 
 from main.cameras import get_backend
+from main.storage import get_storage
+from main.storage import get_image_storage
+from main.storage import get_object_store
+from main.storage import HashingWriter
+from main.storage import get_blob_name
+from main.storage import get_sharded_name
 
 
 def make_uuid():
@@ -43,6 +59,71 @@ class CameraManager(models.Manager):
             pass
 
 
+class UsageManager(models.Manager):
+    # (expires, user) of the cameras whose rows are known to exist, by camera
+    # id. Saving a camera or zone drops entries within this process, other
+    # processes charge a camera moved to another user to its new user once
+    # the entry expires.
+    users = {}
+
+    def get_user(self, camera_id, create=True):
+        """Returns the user of a camera, with `create` creating its usage
+        rows and the user's if needed."""
+        now = time.time()
+        entry = self.users.get(camera_id)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        user_id = Camera.objects.filter(pk=camera_id) \
+            .values_list('zone__user', flat=True)[0]
+        if create:
+            for camera in (camera_id, None):
+                self.get_or_create(user_id=user_id, camera_id=camera)
+            ttl = getattr(settings, 'USAGE_USER_CACHE_TTL', 60)
+            self.users[camera_id] = (now + ttl, user_id)
+        return user_id
+
+    def add(self, camera_id, **deltas):
+        """Adds to the counters of a camera and its user, in one query."""
+        updates = dict((k, F(k) + v) for k, v in deltas.items() if v)
+        if updates:
+            # Nothing to take from rows that do not exist yet.
+            user_id = self.get_user(camera_id, create=all(
+                v >= 0 for v in deltas.values()))
+            self.filter(Q(camera=camera_id) |
+                        Q(camera=None, user=user_id)).update(**updates)
+
+    def record(self, objects, sign=1, uploaded=False):
+        """Counts the files of Images and closed Videos in the usage of
+        their cameras, or with `sign` -1 discounts them. With `uploaded`
+        only their bytes in the object store are counted."""
+        deltas = collections.defaultdict(lambda: collections.defaultdict(int))
+        for o in objects:
+            d = deltas[o.camera_id]
+            if uploaded or o.uploaded:
+                d['uploaded_bytes'] += sign * o.size
+            if not uploaded:
+                kind = 'images' if isinstance(o, Image) else 'videos'
+                d[kind] += sign
+                d[kind[:-1] + '_bytes'] += sign * o.size
+        for camera_id, d in deltas.items():
+            self.add(camera_id, **d)
+
+    def get_total(self, user_id):
+        """Returns the bytes stored for a user."""
+        rows = self.filter(user=user_id, camera=None) \
+            .values_list('image_bytes', 'video_bytes')
+        return sum(rows[0]) if rows else 0
+
+    def get_quota(self, user_id):
+        """Returns the bytes a user may store, None for no limit."""
+        rows = self.filter(user=user_id, camera=None) \
+            .values_list('quota', flat=True)
+        quota = rows[0] if rows else None
+        if quota is None:
+            quota = getattr(settings, 'USAGE_QUOTA', None)
+        return quota
+
+
 class UUIDKeyModel(models.Model):
     """Most models will use this as a base class, the UUID key
     is convenient for exposing via the API."""
@@ -77,6 +158,10 @@ class Event(models.Model):
     """Represents a 'stack' of camera statuses. This is used
     for alerting when a camera is unreachable, as well as for
     displaying the camera's history."""
+    class Meta:
+        # Expired in ranges of `created` per camera, see services.retention.
+        index_together = (('camera', 'created'), )
+
     CAMERA_EVENT_UNREACHABLE = 1
     CAMERA_EVENT_MOTION = 2
     CAMERA_EVENT_RECORDING = 3
@@ -95,15 +180,19 @@ class Event(models.Model):
     # how many successive failures have occurred. For example, you may
     # want to send an alert on the nth failed check.
     count = models.IntegerField(null=False, default=0)
-    # An image associated with this state transition
-    image = models.ForeignKey('Image', null=True)
+    # An image associated with this state transition, the event is kept
+    # when the image is deleted (by retention, say).
+    image = models.ForeignKey('Image', null=True, on_delete=models.SET_NULL)
     # A video associated with this state transition
-    video = models.ForeignKey('Video', null=True)
+    video = models.ForeignKey('Video', null=True, on_delete=models.SET_NULL)
     # A free-form field allowing the camera event that triggered the
     # state change to provide additional information.
     details = models.TextField(null=True)
     # The time of the state transition.
     created = models.DateTimeField(auto_now_add=True)
+    # When the state ended, for states that last such as unreachable. Null
+    # while the state continues.
+    closed = models.DateTimeField(null=True)
 
     objects = EventManager()
 
@@ -155,6 +244,9 @@ class Camera(models.Model):
     password = models.CharField(max_length=128)
     # Record video on motion?
     record = models.BooleanField(default=True)
+    # Seconds of video from before motion to include in recordings, 0 for
+    # none. The recorder buffers this camera's stream continuously.
+    preroll = models.PositiveIntegerField(default=0)
     # Perform health checks?
     health = models.BooleanField(default=True)
     # Send alerts?
@@ -162,7 +254,7 @@ class Camera(models.Model):
     # A camera can be disabled
     disabled = models.BooleanField(default=False)
     # Timestamp operations
-    updated = models.DateTimeField(auto_now=True)
+    updated = models.DateTimeField(auto_now=True, db_index=True)
     created = models.DateTimeField(auto_now_add=True)
 
     objects = CameraManager()
@@ -181,43 +273,293 @@ class Camera(models.Model):
         Camera.objects.filter(id=self.id).update(state=state)
 
 
+class Blob(models.Model):
+    """A file stored once however many Images have the same content, named
+    after its SHA-256 digest. `refs` counts the Images referencing it, blobs
+    no longer referenced are deleted by services.retention."""
+    digest = models.CharField(max_length=64, primary_key=True)
+    size = models.PositiveIntegerField()
+    refs = models.IntegerField(default=0, db_index=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return u'Blob %s: %s refs' % (self.digest, self.refs)
+
+    def __repr__(self):
+        return unicode(self)
+
+    @classmethod
+    def add(cls, digest, size, temp):
+        """Adds a reference to a blob, the file `temp` in storage having its
+        content. The file is moved in place if the blob has none, deleted
+        otherwise. The row lock held while doing so keeps a concurrent
+        delete() from removing the file after it is checked."""
+        storage, images = get_storage(), get_image_storage()
+        name = get_blob_name(digest)
+        for attempt in range(2):
+            try:
+                with transaction.commit_on_success():
+                    if not cls.objects.filter(digest=digest) \
+                            .update(refs=F('refs') + 1):
+                        cls.objects.create(digest=digest, size=size, refs=1)
+                    if images.exists(name):
+                        storage.delete(temp)
+                    else:
+                        images.import_file(storage.path(temp), name)
+                return
+            except IntegrityError:
+                # Inserted by another writer since the update.
+                if attempt:
+                    raise
+
+    @classmethod
+    def release(cls, digest):
+        cls.objects.filter(digest=digest).update(refs=F('refs') - 1)
+
+    def get_name(self):
+        return get_blob_name(self.digest)
+
+    def delete_file(self):
+        get_image_storage().delete(self.get_name())
+        store = get_object_store()
+        if store is not None:
+            store.delete(self.get_name())
+
+
 class FileBackedModel(UUIDKeyModel):
-    """Some storage related actions."""
+    """A model with a file in storage, see main.storage."""
     class Meta:
         abstract = True
 
     camera = models.ForeignKey(Camera)
     mime = models.CharField(max_length=32)
+    # The file's name in storage, assigned when the row is created. Empty
+    # for files stored before names were recorded, see get_name().
+    filename = models.CharField(max_length=128, blank=True)
+    # Set once the file is in the object store and the local copy evicted,
+    # see services.upload. upload_id is that of a multipart upload under way.
+    uploaded = models.DateTimeField(null=True, db_index=True)
+    upload_id = models.CharField(max_length=128, blank=True)
+    # Bytes in storage, counted in Usage.
+    size = models.BigIntegerField(default=0)
+
+    def save(self, *args, **kwargs):
+        self.get_name()
+        super(FileBackedModel, self).save(*args, **kwargs)
+
+    def get_name(self):
+        ext = mimetypes.guess_extension(self.mime or '') or ''
+        if not self.filename:
+            if not self._state.adding:
+                # Stored in the flat per camera layout of older versions.
+                return '%s/%s%s' % (self.camera_id, self.id, ext)
+            self.filename = get_sharded_name(self.camera_id, self.id, ext)
+        return self.filename
+
+    def get_storage(self):
+        return get_storage()
+
+    def get_size(self):
+        """Returns the size of the file in storage, 0 if it is missing."""
+        try:
+            return self.get_storage().size(self.get_name())
+        except (OSError, IOError):
+            return 0
 
     def get_path(self):
-        # TODO: use Django storage system
-        ext = mimetypes.guess_extension(self.mime)
-        fn = os.path.join(settings.ALARM_IMAGE_DIR, str(self.camera_id))
-        if not os.path.isdir(fn):
-            os.makedirs(fn)
-        return os.path.join(fn, '%s%s' % (self.id, ext))
+        """Returns the local path of the file, its directory is created if
+        needed. Only available with local storage."""
+        name = self.get_name()
+        storage = self.get_storage()
+        storage.makedirs(os.path.dirname(name))
+        return storage.path(name)
 
     def open(self, mode='w'):
-        # TODO: use Django storage system
-        return open(self.get_path(), mode)
+        if self.uploaded and 'r' in mode:
+            return get_object_store().open(self.get_name())
+        return self.get_storage().open(self.get_name(), mode)
 
     def write(self, f):
-        # TODO: use Django storage system
-        with self.open() as o:
+        with self.open('wb') as o:
             o.write(f)
+        self.size = len(f)
+
+    def delete_file(self):
+        if self.uploaded:
+            get_object_store().delete(self.get_name())
+        else:
+            self.get_storage().delete(self.get_name())
 
 
 class Image(FileBackedModel):
     """Represents an image captured by a camera."""
+    class Meta:
+        index_together = (('camera', 'created'), )
+
     # The time the image was captured
     created = models.DateTimeField(auto_now_add=True)
+    # The content of the image, shared with identical images. `filename` is
+    # then the blob's name.
+    blob = models.ForeignKey(Blob, null=True, blank=True,
+                             related_name='images', on_delete=models.PROTECT)
+
+    def get_storage(self):
+        return get_image_storage()
+
+    def open(self, mode='w'):
+        if 'w' in mode and getattr(settings, 'IMAGE_DEDUPLICATE', True):
+            return HashingWriter(get_storage(), self.set_blob)
+        return super(Image, self).open(mode)
+
+    def set_blob(self, digest, size, temp):
+        Blob.add(digest, size, temp)
+        self.blob_id = digest
+        self.size = size
+        self.filename = get_blob_name(digest)
+
+    def delete_file(self):
+        if self.blob_id is None:
+            return super(Image, self).delete_file()
+        # Saved images release the blob as their row is deleted.
+        if self._state.adding:
+            Blob.release(self.blob_id)
 
 
 class Video(FileBackedModel):
     """Represents a video captured by a camera."""
+    class Meta:
+        index_together = (('camera', 'created'), )
+
     duration = models.IntegerField(default=0)
+    # Segmented videos are recorded as a series of short files, see Segment.
+    segmented = models.BooleanField(default=False)
     # The time the recording started
     created = models.DateTimeField(auto_now_add=True)
+    # The time the recording ended, null while recording.
+    closed = models.DateTimeField(null=True)
+
+    def get_segment_dir(self):
+        return get_storage().makedirs(os.path.splitext(self.get_name())[0])
+
+    def get_size(self):
+        if not self.segmented:
+            return super(Video, self).get_size()
+        path = get_storage().path(os.path.splitext(self.get_name())[0])
+        try:
+            return sum(os.path.getsize(os.path.join(path, f))
+                       for f in os.listdir(path))
+        except OSError:
+            return 0
+
+    def close(self):
+        """Marks the recording done, counting it in the camera's usage."""
+        self.closed = timezone.now()
+        self.duration = (self.closed - self.created).seconds
+        self.size = self.get_size()
+        self.save()
+        Usage.objects.record([self])
+
+    def get_segment_list(self):
+        """Returns the path of the list ffmpeg appends a line to as it
+        closes each segment."""
+        return os.path.join(self.get_segment_dir(), 'segments.csv')
+
+    def delete_file(self):
+        if not self.segmented:
+            return super(Video, self).delete_file()
+        if self.uploaded:
+            store = get_object_store()
+            for segment in self.segments.all():
+                store.delete(segment.get_name())
+        else:
+            shutil.rmtree(get_storage().path(
+                os.path.splitext(self.get_name())[0]), ignore_errors=True)
+
+
+class Segment(models.Model):
+    """Represents a piece of a segmented video. Segments are registered by
+    the recorder as soon as ffmpeg closes them, so a video can be watched
+    or uploaded while it is still recording."""
+    class Meta:
+        unique_together = ('video', 'sequence')
+        ordering = ('sequence', )
+
+    video = models.ForeignKey(Video, related_name='segments')
+    sequence = models.PositiveIntegerField()
+    filename = models.CharField(max_length=64)
+    # Offset of the segment within the video, and its length, in seconds.
+    start = models.FloatField()
+    duration = models.FloatField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    def get_name(self):
+        return '%s/%s' % (os.path.splitext(self.video.get_name())[0],
+                          self.filename)
+
+    def get_path(self):
+        return os.path.join(self.video.get_segment_dir(), self.filename)
+
+    def open(self, mode='rb'):
+        if self.video.uploaded:
+            return get_object_store().open(self.get_name())
+        return open(self.get_path(), mode)
+
+
+class Retention(models.Model):
+    """How long a user's images, videos and events are kept, see
+    services.retention. A policy for a camera overrides the user's policy
+    (the one without a camera), which overrides RETENTION_DAYS."""
+    class Meta:
+        unique_together = ('user', 'camera')
+
+    user = models.ForeignKey(User, related_name='retention')
+    camera = models.ForeignKey(Camera, null=True, blank=True,
+                               related_name='retention')
+    # Days items are kept
+    days = models.PositiveIntegerField()
+    # Days alerts, and their image and video, are kept if longer than `days`
+    alert_days = models.PositiveIntegerField(null=True, blank=True)
+
+    def __unicode__(self):
+        return u'Retention %s: %s days' % (self.id, self.days)
+
+    def __repr__(self):
+        return unicode(self)
+
+
+class Usage(models.Model):
+    """The files stored for a camera, or for all of a user's cameras when
+    `camera` is null. Counters are kept up to date as files are written,
+    uploaded and deleted, and corrected by services.usage."""
+    class Meta:
+        unique_together = ('user', 'camera')
+
+    user = models.ForeignKey(User, related_name='usage')
+    camera = models.ForeignKey(Camera, null=True, blank=True,
+                               related_name='usage')
+    images = models.IntegerField(default=0)
+    image_bytes = models.BigIntegerField(default=0)
+    # Closed videos
+    videos = models.IntegerField(default=0)
+    video_bytes = models.BigIntegerField(default=0)
+    # Bytes moved to the object store, see services.upload
+    uploaded_bytes = models.BigIntegerField(default=0)
+    # Bytes the user may store, USAGE_QUOTA when null. Only set on the
+    # user's row.
+    quota = models.BigIntegerField(null=True, blank=True)
+    # The last time the counters were corrected
+    reconciled = models.DateTimeField(null=True)
+
+    objects = UsageManager()
+
+    def __unicode__(self):
+        return u'Usage %s: %s bytes' % (self.id, self.get_bytes())
+
+    def __repr__(self):
+        return unicode(self)
+
+    def get_bytes(self):
+        return self.image_bytes + self.video_bytes
 
 
 class Alert(models.Model):
@@ -228,4 +570,73 @@ class Alert(models.Model):
 
 
 class Period(models.Model):
-    """Represents periodic action such as capture."""
+    """Represents periodic action such as capture. Periods are run by the
+    scheduler (manage.py scheduler)."""
+    PERIOD_ACTION_CAPTURE = 1
+    PERIOD_ACTION_HEALTH = 2
+
+    PERIOD_ACTIONS = {
+        PERIOD_ACTION_CAPTURE: _('Capture a still image'),
+        PERIOD_ACTION_HEALTH: _('Health check'),
+    }
+
+    # The camera to act on, housekeeping periods such as a health check of
+    # all cameras have none.
+    camera = models.ForeignKey(Camera, related_name='periods', null=True)
+    action = models.PositiveSmallIntegerField(choices=PERIOD_ACTIONS.items())
+    # Seconds between runs
+    interval = models.PositiveIntegerField()
+    # Runs only between these times of day (in TIME_ZONE) when given, the
+    # window may span midnight.
+    start = models.TimeField(null=True, blank=True)
+    end = models.TimeField(null=True, blank=True)
+    disabled = models.BooleanField(default=False)
+    # Timestamp operations, the scheduler loads periods updated since it
+    # last looked.
+    updated = models.DateTimeField(auto_now=True, db_index=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return u'Period %s: %s every %ss' % (self.id, self.get_action_display(),
+                                             self.interval)
+
+    def __repr__(self):
+        return unicode(self)
+
+    def in_window(self, time):
+        """Returns True if the period runs at the given time of day."""
+        if self.start is None or self.end is None:
+            return True
+        if self.start <= self.end:
+            return self.start <= time < self.end
+        return time >= self.start or time < self.end
+
+
+@receiver(post_delete, sender=Image)
+def release_blob(sender, instance, **kwargs):
+    if instance.blob_id is not None:
+        Blob.release(instance.blob_id)
+
+
+@receiver(post_save, sender=Image)
+def count_image(sender, instance, created, **kwargs):
+    # Images inserted with bulk_create() are counted by the caller.
+    if created:
+        Usage.objects.record([instance])
+
+
+@receiver(post_save, sender=Zone)
+@receiver(post_save, sender=Camera)
+def forget_camera_user(sender, instance, **kwargs):
+    # The camera, or the cameras of the zone, may have another user now.
+    if sender is Camera:
+        Usage.objects.users.pop(instance.id, None)
+    else:
+        Usage.objects.users.clear()
+
+
+@receiver(post_delete, sender=Image)
+@receiver(post_delete, sender=Video)
+def discount_file(sender, instance, **kwargs):
+    if sender is Image or instance.closed is not None:
+        Usage.objects.record([instance], sign=-1)
@@ -0,0 +1,536 @@
+import os
+import mmap
+import uuid
+import errno
+import fcntl
+import struct
+import hashlib
+import threading
+import collections
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+from django.conf import settings
+from django.utils import timezone
+from django.core.files.base import ContentFile
+from django.core.files.storage import Storage
+from django.core.files.storage import FileSystemStorage
+from django.core.files.storage import get_storage_class
+
+
+# Directories remembered by ShardedFileSystemStorage, the cache is cleared
+# past this many.
+DIRECTORY_CACHE_SIZE = 10000
+
+# Pack files kept open and mapped by PackStorage.
+PACK_CACHE_SIZE = 256
+# Each record of a pack file is a header (the SHA-1 digest of the file's
+# name, the data's length and flags) followed by the data.
+PACK_HEADER = struct.Struct('>20sII')
+PACK_DELETED = 1
+
+
+def get_sharded_name(prefix, key, ext, when=None):
+    """Returns a name of the form <prefix>/<year>/<month>/<day>/<shard>/<key>
+    <ext>, the shard being the first two characters of `key`. With a random
+    key this keeps any one directory small however many files there are."""
+    when = timezone.localtime(when or timezone.now())
+    return '%s/%s/%s/%s%s' % (prefix, when.strftime('%Y/%m/%d'), key[:2], key,
+                              ext)
+
+
+def get_blob_name(digest):
+    """Returns the name of the blob with the given SHA-256 hex digest."""
+    return 'blobs/%s/%s/%s' % (digest[:2], digest[2:4], digest)
+
+
+class HashingWriter(object):
+    """A file to write a blob to. Data goes to a temporary file in `storage`
+    and is hashed as it is written. On close `callback` is called with the
+    digest, the size, and the name of the temporary file, which it should
+    move or delete."""
+    def __init__(self, storage, callback):
+        self.storage = storage
+        self.callback = callback
+        self.temp = 'blobs/tmp/%s' % uuid.uuid4()
+        self.f = storage.open(self.temp, 'wb')
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    @property
+    def name(self):
+        return self.f.name
+
+    @property
+    def closed(self):
+        return self.f.closed
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        self.f.write(data)
+
+    def close(self):
+        if self.f.closed:
+            return
+        self.f.close()
+        self.callback(self.hash.hexdigest(), self.size, self.temp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ShardedFileSystemStorage(FileSystemStorage):
+    """Local storage, by default in ALARM_IMAGE_DIR, for names laid out by
+    get_sharded_name(). Directories are created as files are written to
+    them, and remembered, so a write does not cost a stat() of its
+    directory."""
+    def __init__(self, location=None, base_url=None):
+        if location is None:
+            location = settings.ALARM_IMAGE_DIR
+        super(ShardedFileSystemStorage, self).__init__(location, base_url)
+        self.lock = threading.Lock()
+        self.directories = set()
+
+    def makedirs(self, name):
+        """Creates the directory `name` if needed, returns its path."""
+        path = self.path(name)
+        if path in self.directories:
+            return path
+        try:
+            os.makedirs(path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        with self.lock:
+            if len(self.directories) >= DIRECTORY_CACHE_SIZE:
+                self.directories.clear()
+            self.directories.add(path)
+        return path
+
+    def _open(self, name, mode='rb'):
+        if 'w' in mode or 'a' in mode:
+            self.makedirs(os.path.dirname(name))
+        return super(ShardedFileSystemStorage, self)._open(name, mode)
+
+    def _save(self, name, content):
+        self.makedirs(os.path.dirname(name))
+        return super(ShardedFileSystemStorage, self)._save(name, content)
+
+    def import_file(self, path, name):
+        """Moves the local file at `path` to `name`."""
+        os.rename(path, os.path.join(self.makedirs(os.path.dirname(name)),
+                                     os.path.basename(name)))
+
+
+def get_pack_name(name):
+    """Returns the pack a file is kept in, one per camera and day for the
+    names of get_sharded_name(), one per digest prefix for blobs."""
+    directory = os.path.dirname(name)
+    return os.path.dirname(directory) or directory or '_'
+
+
+class Pack(object):
+    """An append-only file of records, see PackStorage.
+
+    The file is mapped in memory, and indexed by scanning the headers of
+    records appended since it was last looked at. Appends take an exclusive
+    lock on the file, so writers in several processes do not interleave,
+    and compact() replaces it with a new file holding only live records.
+    A process that had mapped the old file goes on reading it until it
+    misses, then maps the new one."""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.reset(None)
+
+    def reset(self, inode):
+        self.inode = inode
+        self.map = None
+        self.scanned = 0
+        # Offset and length of the data of each live record, by key.
+        self.index = {}
+        # Bytes taken by deleted and replaced records.
+        self.garbage = 0
+
+    def refresh(self):
+        """Maps the file again if it grew or was replaced, and indexes the
+        records appended since it was last scanned."""
+        try:
+            st = os.stat(self.path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            self.reset(None)
+            return
+        if st.st_ino != self.inode:
+            self.reset(st.st_ino)
+        if st.st_size and st.st_size > (len(self.map) if self.map else 0):
+            with open(self.path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.scan()
+
+    def scan(self):
+        pos, size = self.scanned, len(self.map) if self.map else 0
+        while pos + PACK_HEADER.size <= size:
+            key, length, flags = PACK_HEADER.unpack_from(self.map, pos)
+            if pos + PACK_HEADER.size + length > size:
+                # Being appended.
+                break
+            old = self.index.pop(key, None)
+            if old is not None:
+                self.garbage += PACK_HEADER.size + old[1]
+            if flags & PACK_DELETED:
+                self.garbage += PACK_HEADER.size
+            else:
+                self.index[key] = (pos + PACK_HEADER.size, length)
+            pos += PACK_HEADER.size + length
+        self.scanned = pos
+
+    def lookup(self, key):
+        entry = self.index.get(key)
+        if entry is None:
+            self.refresh()
+            entry = self.index.get(key)
+        return entry
+
+    def get(self, key):
+        """Returns the offset and length of a record's data, or None."""
+        with self.lock:
+            return self.lookup(key)
+
+    def read(self, key):
+        with self.lock:
+            entry = self.lookup(key)
+            if entry is None:
+                raise IOError(errno.ENOENT, 'Not in %s' % self.path)
+            offset, length = entry
+            return self.map[offset:offset + length]
+
+    def open_locked(self, mode):
+        """Opens the file with an exclusive lock, retrying if the file was
+        replaced while waiting for the lock."""
+        while True:
+            f = open(self.path, mode)
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                if os.fstat(f.fileno()).st_ino == os.stat(self.path).st_ino:
+                    return f
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    f.close()
+                    raise
+            f.close()
+
+    def append(self, key, data, flags=0):
+        with self.open_locked('ab') as f:
+            f.write(PACK_HEADER.pack(key, len(data), flags) + data)
+
+    def delete(self, key):
+        if self.get(key) is not None:
+            self.append(key, '', PACK_DELETED)
+            with self.lock:
+                self.refresh()
+
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+            self.reset(None)
+
+    def compact(self):
+        """Rewrites the file without its garbage, returns the bytes freed."""
+        temp = '%s.%s' % (self.path, uuid.uuid4())
+        with self.open_locked('rb'):
+            with self.lock:
+                self.refresh()
+                garbage = self.garbage
+                records = sorted((offset, key, length) for key, (offset, length)
+                                 in self.index.items())
+                with open(temp, 'wb') as o:
+                    for offset, key, length in records:
+                        o.write(PACK_HEADER.pack(key, length, 0))
+                        o.write(self.map[offset:offset + length])
+                os.rename(temp, self.path)
+                self.refresh()
+        return garbage
+
+
+class PackStorage(Storage):
+    """Storage for small files, by default in IMAGE_PACK_DIR, appending
+    them to a pack file per camera and day (see get_pack_name()) rather
+    than creating a file each. Reads are slices of the mapped pack, without
+    a lookup or open of their own.
+
+    Deleted files are garbage until compact() rewrites the packs they were
+    deleted from. Files have no local path, and names are not reused, as
+    other processes may go on reading a file they looked up before it was
+    deleted or replaced."""
+    def __init__(self, location=None):
+        if location is None:
+            location = getattr(settings, 'IMAGE_PACK_DIR', None) or \
+                os.path.join(settings.ALARM_IMAGE_DIR, 'packs')
+        self.location = location
+        self.lock = threading.Lock()
+        self.packs = collections.OrderedDict()
+        # Packs files were deleted from, to compact.
+        self.dirty = set()
+
+    def get_pack(self, name):
+        """Returns the pack of a file, and the file's key within it."""
+        return self.load(get_pack_name(name)), hashlib.sha1(name).digest()
+
+    def load(self, pack_name):
+        with self.lock:
+            pack = self.packs.pop(pack_name, None)
+            if pack is None:
+                if len(self.packs) >= PACK_CACHE_SIZE:
+                    self.packs.popitem(last=False)[1].close()
+                path = os.path.join(self.location, pack_name + '.pack')
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                pack = Pack(path)
+            self.packs[pack_name] = pack
+        return pack
+
+    def _open(self, name, mode='rb'):
+        if 'w' in mode or 'a' in mode:
+            return PackWriter(self, name)
+        pack, key = self.get_pack(name)
+        return ContentFile(pack.read(key), name=name)
+
+    def _save(self, name, content):
+        pack, key = self.get_pack(name)
+        pack.append(key, ''.join(content.chunks()))
+        return name
+
+    def get_available_name(self, name):
+        # Names are unique, or content addressed.
+        return name
+
+    def import_file(self, path, name):
+        """Moves the local file at `path` to `name`."""
+        with open(path, 'rb') as f:
+            pack, key = self.get_pack(name)
+            pack.append(key, f.read())
+        os.remove(path)
+
+    def exists(self, name):
+        pack, key = self.get_pack(name)
+        return pack.get(key) is not None
+
+    def size(self, name):
+        pack, key = self.get_pack(name)
+        entry = pack.get(key)
+        if entry is None:
+            raise OSError(errno.ENOENT, 'No such file: %s' % name)
+        return entry[1]
+
+    def delete(self, name):
+        pack, key = self.get_pack(name)
+        pack.delete(key)
+        with self.lock:
+            self.dirty.add(get_pack_name(name))
+
+    def compact(self, min_garbage=0.5):
+        """Compacts the packs files were deleted from, when over
+        `min_garbage` of the pack is garbage. Returns the bytes freed."""
+        with self.lock:
+            names, self.dirty = self.dirty, set()
+        freed = 0
+        for pack_name in names:
+            pack = self.load(pack_name)
+            with pack.lock:
+                pack.refresh()
+                size = len(pack.map) if pack.map else 0
+                garbage = pack.garbage
+            if garbage and garbage >= size * min_garbage:
+                freed += pack.compact()
+        return freed
+
+
+class PackWriter(object):
+    """A file to write to a PackStorage, appended to its pack on close."""
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.name = name
+        self.f = StringIO()
+        self.closed = False
+
+    def write(self, data):
+        self.f.write(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        pack, key = self.storage.get_pack(self.name)
+        pack.append(key, self.f.getvalue())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+STORAGE = None
+STORAGE_LOCK = threading.Lock()
+
+
+def get_storage():
+    """Returns the storage for Image and Video files, an instance of the
+    FILE_STORAGE class."""
+    global STORAGE
+    with STORAGE_LOCK:
+        if STORAGE is None:
+            STORAGE = get_storage_class(getattr(
+                settings, 'FILE_STORAGE',
+                'main.storage.ShardedFileSystemStorage'))()
+    return STORAGE
+
+
+IMAGE_STORAGE = None
+
+
+def get_image_storage():
+    """Returns the storage for Image files, an instance of the IMAGE_STORAGE
+    class, or the storage of get_storage() without one."""
+    global IMAGE_STORAGE
+    path = getattr(settings, 'IMAGE_STORAGE', None)
+    if not path:
+        return get_storage()
+    with STORAGE_LOCK:
+        if IMAGE_STORAGE is None:
+            IMAGE_STORAGE = get_storage_class(path)()
+    return IMAGE_STORAGE
+
+
+class MemoryObjectStore(object):
+    """An S3-like object store kept in memory, for development and tests."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.uploads = {}
+        self.sequence = 0
+
+    def put(self, key, data):
+        with self.lock:
+            self.objects[key] = data
+
+    def exists(self, key):
+        return key in self.objects
+
+    def open(self, key):
+        return StringIO(self.objects[key])
+
+    def delete(self, key):
+        with self.lock:
+            self.objects.pop(key, None)
+
+    def create_multipart(self, key):
+        with self.lock:
+            self.sequence += 1
+            upload_id = str(self.sequence)
+            self.uploads[upload_id] = (key, {})
+        return upload_id
+
+    def upload_part(self, key, upload_id, number, data):
+        with self.lock:
+            self.uploads[upload_id][1][number] = data
+
+    def list_parts(self, key, upload_id):
+        """Returns the size of each part uploaded so far, by number."""
+        with self.lock:
+            parts = self.uploads[upload_id][1]
+            return dict((n, len(d)) for n, d in parts.items())
+
+    def complete(self, key, upload_id):
+        with self.lock:
+            key, parts = self.uploads.pop(upload_id)
+            self.objects[key] = ''.join(parts[n] for n in sorted(parts))
+
+    def abort(self, key, upload_id):
+        with self.lock:
+            self.uploads.pop(upload_id, None)
+
+
+class S3ObjectStore(object):
+    """Objects in the UPLOAD_BUCKET S3 bucket, or a bucket of any S3
+    compatible store given UPLOAD_HOST. Needs boto, credentials are found
+    as boto finds them. Each thread gets its own connection."""
+    def __init__(self, bucket=None, **kwargs):
+        self.bucket_name = bucket or settings.UPLOAD_BUCKET
+        self.kwargs = kwargs
+        if 'host' not in kwargs and getattr(settings, 'UPLOAD_HOST', None):
+            self.kwargs['host'] = settings.UPLOAD_HOST
+        self.local = threading.local()
+
+    @property
+    def bucket(self):
+        bucket = getattr(self.local, 'bucket', None)
+        if bucket is None:
+            import boto
+            bucket = self.local.bucket = boto.connect_s3(**self.kwargs) \
+                .get_bucket(self.bucket_name, validate=False)
+        return bucket
+
+    def get_upload(self, key, upload_id):
+        from boto.s3.multipart import MultiPartUpload
+        upload = MultiPartUpload(self.bucket)
+        upload.key_name, upload.id = key, upload_id
+        return upload
+
+    def put(self, key, data):
+        self.bucket.new_key(key).set_contents_from_string(data)
+
+    def exists(self, key):
+        return self.bucket.get_key(key) is not None
+
+    def open(self, key):
+        return self.bucket.get_key(key)
+
+    def delete(self, key):
+        self.bucket.delete_key(key)
+
+    def create_multipart(self, key):
+        return self.bucket.initiate_multipart_upload(key).id
+
+    def upload_part(self, key, upload_id, number, data):
+        self.get_upload(key, upload_id).upload_part_from_file(StringIO(data),
+                                                              number)
+
+    def list_parts(self, key, upload_id):
+        return dict((p.part_number, p.size) for p in
+                    self.get_upload(key, upload_id))
+
+    def complete(self, key, upload_id):
+        self.get_upload(key, upload_id).complete_upload()
+
+    def abort(self, key, upload_id):
+        self.get_upload(key, upload_id).cancel_upload()
+
+
+OBJECT_STORE = None
+
+
+def get_object_store():
+    """Returns the store files are uploaded to, an instance of the
+    UPLOAD_STORE class, or None if uploads are disabled."""
+    global OBJECT_STORE
+    path = getattr(settings, 'UPLOAD_STORE', None)
+    if not path:
+        return None
+    with STORAGE_LOCK:
+        if OBJECT_STORE is None:
+            OBJECT_STORE = get_storage_class(path)()
+    return OBJECT_STORE
@@ -0,0 +1,318 @@
+import os
+import time
+import signal
+import shutil
+import tempfile
+
+from datetime import datetime
+
+from django.test import SimpleTestCase
+from django.core.files.base import ContentFile
+from django.utils import timezone
+from django.test import TransactionTestCase
+
+from main.models import Blob
+from main.models import Image
+from main.models import Video
+from main.models import Camera
+from main.cameras import Registry
+from main.cameras import NotSupportedError
+from main.cameras import get_backend
+from main.cameras.base import BaseCamera
+from main.cameras.process import WATCHER
+from main.cameras.process import ProcessWatcher
+from main.cameras.foscam import Camera as Foscam
+from main import storage
+from main.storage import PackStorage
+from main.storage import ShardedFileSystemStorage
+from main.storage import get_storage
+from main.storage import get_blob_name
+from main.storage import get_sharded_name
+
+
+class FakeCamera(BaseCamera):
+    make = 'Acme'
+    models = ['CAM 100', 'cam200']
+
+
+class StreamCamera(BaseCamera):
+    codec = 'mjpeg'
+
+    def get_input_args(self):
+        return ['-f', 'mjpeg', '-i', 'http://camera/stream']
+
+
+class MPEG4StreamCamera(StreamCamera):
+    codec = 'mpeg4'
+
+
+class StaticRegistry(Registry):
+    """Registry that does not look for installed backends."""
+    def load(self):
+        return {}
+
+
+class RegistryTest(SimpleTestCase):
+    def setUp(self):
+        self.registry = StaticRegistry()
+        self.registry.register(FakeCamera)
+
+    def test_get(self):
+        """Ensure lookups ignore case and extra whitespace."""
+        self.assertIs(self.registry.get('Acme', 'CAM 100'), FakeCamera)
+        self.assertIs(self.registry.get(' acme', 'cam  100 '), FakeCamera)
+        self.assertIs(self.registry.get('ACME', 'CAM200'), FakeCamera)
+        self.assertIsNone(self.registry.get('Acme', 'CAM 300'))
+        self.assertIsNone(self.registry.get(None, None))
+
+    def test_supported(self):
+        self.assertEqual(self.registry.supported(),
+                         [('Acme', 'CAM 100'), ('Acme', 'cam200')])
+
+    def test_load_once(self):
+        """Ensure backends are only looked for once."""
+        calls = []
+
+        class CountingRegistry(Registry):
+            def load(self):
+                calls.append(1)
+                return {}
+        registry = CountingRegistry()
+        registry.get('Acme', 'CAM 100')
+        registry.get('Acme', 'CAM 100')
+        registry.supported()
+        self.assertEqual(len(calls), 1)
+
+    def test_not_supported(self):
+        self.assertRaises(NotSupportedError, get_backend,
+                          Camera(make='Nobody', model='Nothing'))
+
+
+class RecordArgsTest(SimpleTestCase):
+    def test_segmented(self):
+        """Ensure segments stream copy when the codec allows."""
+        video = Video(camera_id=1, mime='video/x-matroska', segmented=True)
+        args = StreamCamera(None).get_record_args(video)
+        self.assertEqual(args[args.index('-c') + 1], 'copy')
+        self.assertEqual(args[args.index('-segment_format') + 1], 'matroska')
+        self.assertIn(video.get_segment_list(), args)
+        self.assertTrue(args[-1].endswith('%05d.mkv'))
+        args = MPEG4StreamCamera(None).get_record_args(video)
+        self.assertNotIn('copy', args)
+        self.assertEqual(args[args.index('-segment_format') + 1], 'mpegts')
+
+    def test_single(self):
+        video = Video(camera_id=1, mime='video/x-msvideo')
+        self.assertEqual(StreamCamera(None).get_record_args(video)[-1],
+                         video.get_path())
+
+
+class SyncCamera(BaseCamera):
+    def health(self, timeout=5):
+        return timeout
+
+
+class AsyncTest(SimpleTestCase):
+    def test_shim(self):
+        """Ensure blocking backends get asynchronous operations."""
+        camera = SyncCamera(None)
+        self.assertEqual(camera.health_async(timeout=1).result(1), 1)
+        self.assertRaises(Exception, camera.capture_async().result, 1)
+
+
+class ProcessWatcherTest(SimpleTestCase):
+    def setUp(self):
+        self.watcher = ProcessWatcher()
+
+    def test_exit(self):
+        process, exited = self.watcher.spawn(['sh', '-c', 'exit 3'])
+        self.assertEqual(exited.result(5), 3)
+
+    def test_stop(self):
+        """Ensure a process is interrupted, and terminated if it ignores
+        SIGINT."""
+        process, exited = self.watcher.spawn(['sleep', '30'])
+        self.assertFalse(exited.done())
+        self.assertEqual(self.watcher.stop(process, exited).result(5),
+                         -signal.SIGINT)
+        process, exited = self.watcher.spawn(['sh', '-c',
+                                              'trap "" INT; exec sleep 30'])
+        # Give the shell time to ignore SIGINT.
+        time.sleep(0.2)
+        started = time.time()
+        self.watcher.stop(process, exited, terminate_after=0.2,
+                          kill_after=5)
+        self.assertEqual(exited.result(5), -signal.SIGTERM)
+        self.assertLess(time.time() - started, 2)
+
+    def test_many(self):
+        """Ensure one watcher waits on many processes."""
+        futures = [self.watcher.spawn(['sleep', '0.1'])[1] for i in range(20)]
+        self.assertEqual([f.result(5) for f in futures], [0] * 20)
+
+
+class FoscamTest(SimpleTestCase):
+    def test_build_url(self):
+        camera = Foscam(Camera(url='http://192.168.1.89:88/', username='a b',
+                               password='p&w'))
+        url = camera.build_url('snapshot')
+        self.assertTrue(url.startswith('http://192.168.1.89:88/cgi-bin/CGIProxy.fcgi?'))
+        self.assertIn('usr=a+b', url)
+        self.assertIn('pwd=p%26w', url)
+        self.assertIn('cmd=snapPicture2', url)
+
+
+class FoscamRecordTest(TransactionTestCase):
+    fixtures = ('unittest', )
+
+    def test_record(self):
+        """Ensure video is recorded in segments, as by the recorder."""
+        spawned = []
+
+        def spawn(args):
+            spawned.append(args)
+            return spawn_process(['sleep', '30'])
+        spawn_process, WATCHER.spawn = WATCHER.spawn, spawn
+        try:
+            camera = Foscam(Camera.objects.get(pk=1))
+            video = camera.record_async().result(1)
+        finally:
+            del WATCHER.spawn
+        self.assertTrue(video.segmented)
+        self.assertIn('-segment_list', spawned[0])
+        self.assertEqual(camera.stop_async().result(5), video)
+        self.assertIsNotNone(Video.objects.get(pk=video.pk).closed)
+
+
+class StorageTest(SimpleTestCase):
+    def setUp(self):
+        self.storage = ShardedFileSystemStorage(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(self.storage.location)
+
+    def test_name(self):
+        when = timezone.make_aware(datetime(2014, 2, 1, 12),
+                                   timezone.get_current_timezone())
+        self.assertEqual(get_sharded_name(3, 'abcdef', '.jpg', when),
+                         '3/2014/02/01/ab/abcdef.jpg')
+
+    def test_open(self):
+        """Ensure directories are created on write, and remembered."""
+        name = get_sharded_name(1, 'abcdef', '.jpg')
+        with self.storage.open(name, 'wb') as f:
+            f.write('data')
+        with self.storage.open(name) as f:
+            self.assertEqual(f.read(), 'data')
+        directory = os.path.dirname(self.storage.path(name))
+        self.assertIn(directory, self.storage.directories)
+        shutil.rmtree(directory)
+        self.assertEqual(self.storage.makedirs(os.path.dirname(name)), directory)
+        self.assertFalse(os.path.isdir(directory))
+
+
+class PackStorageTest(TransactionTestCase):
+    fixtures = ('unittest', )
+
+    def setUp(self):
+        self.storage = PackStorage(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(self.storage.location)
+
+    def read(self, name, storage=None):
+        with (storage or self.storage).open(name) as f:
+            return f.read()
+
+    def test_pack(self):
+        """Ensure files of a camera and day share a pack, seen by others."""
+        names = [get_sharded_name(1, '%02d' % i, '.jpg') for i in range(3)]
+        for i, name in enumerate(names):
+            with self.storage.open(name, 'wb') as f:
+                f.write('data%s' % i)
+        self.assertEqual(len(os.listdir(os.path.dirname(
+            self.storage.get_pack(names[0])[0].path))), 1)
+        other = PackStorage(self.storage.location)
+        self.assertEqual(self.read(names[1], other), 'data1')
+        other.delete(names[1])
+        self.assertFalse(self.storage.exists(names[1]))
+        self.assertEqual(self.storage.size(names[2]), 5)
+        self.assertRaises(IOError, self.read, names[1])
+
+    def test_compact(self):
+        names = [get_sharded_name(1, '%02d' % i, '.jpg') for i in range(4)]
+        for name in names:
+            self.storage.save(name, ContentFile(name))
+        other = PackStorage(self.storage.location)
+        self.assertEqual(self.read(names[0], other), names[0])
+        pack = self.storage.get_pack(names[0])[0]
+        size = os.path.getsize(pack.path)
+        self.storage.delete(names[0])
+        self.assertEqual(self.storage.compact(), 0)
+        self.storage.delete(names[1])
+        self.assertGreater(self.storage.compact(), 2 * len(names[0]))
+        self.assertEqual(os.path.getsize(pack.path), size / 2)
+        self.assertEqual(self.read(names[3], other), names[3])
+        other.save(names[0], ContentFile('new'))
+        self.assertEqual(self.read(names[0]), 'new')
+
+    def test_image(self):
+        """Ensure images are stored in packs when configured."""
+        storage.IMAGE_STORAGE = self.storage
+        try:
+            with self.settings(IMAGE_STORAGE='main.storage.PackStorage'):
+                image = Image(camera_id=1, mime='image/jpeg')
+                image.write('data')
+                image.save()
+                with Image.objects.get(id=image.id).open('rb') as f:
+                    self.assertEqual(f.read(), 'data')
+                self.assertTrue(self.storage.exists(image.get_name()))
+        finally:
+            storage.IMAGE_STORAGE = None
+
+
+class FileBackedModelTest(TransactionTestCase):
+    fixtures = ('unittest', )
+
+    def test_filename(self):
+        """Ensure new files are sharded, and older ones still found."""
+        image = Image(camera_id=1, mime='image/png')
+        with self.settings(IMAGE_DEDUPLICATE=False):
+            image.write('data')
+        image.save()
+        image = Image.objects.get(id=image.id)
+        self.assertTrue(image.filename.startswith('1/'))
+        self.assertEqual(image.filename.count('/'), 5)
+        with image.open('rb') as f:
+            self.assertEqual(f.read(), 'data')
+        Image.objects.filter(id=image.id).update(filename='')
+        image = Image.objects.get(id=image.id)
+        self.assertEqual(image.get_name(), '1/%s.png' % image.id)
+        image.save()
+        self.assertEqual(Image.objects.get(id=image.id).filename, '')
+
+    def test_blob(self):
+        """Ensure identical images share a blob, counted once per image."""
+        images = []
+        for i in range(2):
+            image = Image(camera_id=1, mime='image/jpeg')
+            with image.open('wb') as f:
+                f.write('da')
+                f.write('ta')
+            image.save()
+            images.append(image)
+        blob = Blob.objects.get()
+        self.assertEqual((blob.size, blob.refs), (4, 2))
+        self.assertEqual(images[0].filename, images[1].filename)
+        self.assertEqual(images[0].filename, get_blob_name(blob.digest))
+        with Image.objects.get(id=images[0].id).open('rb') as f:
+            self.assertEqual(f.read(), 'data')
+        self.assertEqual(os.listdir(get_storage().path('blobs/tmp')), [])
+        images[0].delete()
+        self.assertEqual(Blob.objects.get().refs, 1)
+        # Written, but never inserted.
+        image = Image(camera_id=1, mime='image/jpeg')
+        image.write('data')
+        self.assertEqual(Blob.objects.get().refs, 2)
+        image.delete_file()
+        self.assertEqual(Blob.objects.get().refs, 1)
@@ -1,3 +1,6 @@
+import json
+import collections
+
 try:
     import cPickle as pickle
 except ImportError:
@@ -7,6 +10,7 @@ from gearman import DataEncoder
 from gearman.client import GearmanClient as BaseGearmanClient
 
 from django.conf import settings
+from django.db import models
 
 
 class PickleDataEncoder(DataEncoder):
@@ -19,8 +23,88 @@ class PickleDataEncoder(DataEncoder):
         return pickle.loads(encoded)
 
 
+class ModelRef(object):
+    """A model instance in a decoded payload, by primary key. resolve()
+    replaces these with the current rows."""
+    __slots__ = ('model', 'pk')
+
+    def __init__(self, model, pk):
+        self.model = model
+        self.pk = pk
+
+    def __repr__(self):
+        return '<ModelRef %s %r>' % (self.model.__name__, self.pk)
+
+
+def encode_model(obj):
+    if isinstance(obj, models.Model):
+        return {'@': '%s.%s' % (obj._meta.app_label, obj._meta.object_name),
+                'pk': obj.pk}
+    raise TypeError('%r is not JSON serializable' % obj)
+
+
+def decode_model(d):
+    if '@' in d:
+        return ModelRef(models.get_model(*d['@'].split('.')), d['pk'])
+    return d
+
+
+class JSONDataEncoder(DataEncoder):
+    """Encodes task arguments as JSON, model instances are sent as their
+    primary key and loaded again by the worker."""
+    @classmethod
+    def encode(cls, obj):
+        return json.dumps(obj, default=encode_model, separators=(',', ':'))
+
+    @classmethod
+    def decode(cls, encoded):
+        if encoded[:1] == '\x80':
+            # Pickled by a client that has not been upgraded yet.
+            return pickle.loads(encoded)
+        return json.loads(encoded, object_hook=decode_model)
+
+
+def walk(obj, f):
+    """Calls `f` on each leaf of nested lists and dicts, returning the
+    structure with the leaves replaced by the results."""
+    if isinstance(obj, (list, tuple)):
+        return [walk(o, f) for o in obj]
+    if isinstance(obj, dict):
+        return dict((k, walk(v, f)) for k, v in obj.items())
+    return f(obj)
+
+
+class MissingRow(Exception):
+    pass
+
+
+def resolve(obj):
+    """Replaces every ModelRef within `obj` by its row, with one query per
+    model. Raises MissingRow if a row no longer exists."""
+    pks = collections.defaultdict(set)
+
+    def collect(o):
+        if isinstance(o, ModelRef):
+            pks[o.model].add(o.pk)
+    walk(obj, collect)
+    if not pks:
+        return obj
+    rows = dict((model, model._default_manager.in_bulk(list(ids)))
+                for model, ids in pks.items())
+
+    def replace(o):
+        if isinstance(o, ModelRef):
+            try:
+                return rows[o.model][o.pk]
+            except KeyError:
+                raise MissingRow('%s %r no longer exists' % (
+                                 o.model.__name__, o.pk))
+        return o
+    return walk(obj, replace)
+
+
 class GearmanClient(BaseGearmanClient):
-    data_encoder = PickleDataEncoder
+    data_encoder = JSONDataEncoder
 
 
 GEARMAN = GearmanClient(getattr(settings, 'GEARMAN_SERVERS', ['localhost']))
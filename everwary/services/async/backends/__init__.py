@@ -0,0 +1,54 @@
+from django.conf import settings
+from django.utils.importlib import import_module
+
+
+# Priorities, lower runs first. Motion starts recordings so it goes ahead of
+# alerts, which go ahead of housekeeping.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+DEFAULT_BACKEND = 'services.async.backends.gearmand.GearmanBackend'
+
+
+class TaskError(Exception):
+    """A task waited on with apply_wait() failed or timed out."""
+
+
+class BaseBackend(object):
+    """Runs tasks submitted by Task.delay() and Task.apply_wait()."""
+    def submit(self, task, data, unique=None):
+        """Queues `task` to run with `data` (args and kwargs) without
+        waiting for it. Submitting a `unique` key that is already queued is
+        a no-op."""
+        raise NotImplementedError()
+
+    def submit_wait(self, task, data, timeout=None):
+        """Runs `task` and returns its result."""
+        raise NotImplementedError()
+
+    def stop(self):
+        """Waits for queued tasks, called when a process exits."""
+        pass
+
+
+class EagerBackend(BaseBackend):
+    """Runs tasks immediately in the calling thread, used for testing."""
+    def submit(self, task, data, unique=None):
+        self.submit_wait(task, data)
+
+    def submit_wait(self, task, data, timeout=None):
+        return task.apply(*data.get('args', ()), **data.get('kwargs', {}))
+
+
+_backend = None
+
+
+def get_backend():
+    """Returns the backend named by the TASK_BACKEND setting."""
+    global _backend
+    if _backend is None:
+        path = getattr(settings, 'TASK_BACKEND', DEFAULT_BACKEND)
+        module, name = path.rsplit('.', 1)
+        _backend = getattr(import_module(module), name)()
+    return _backend
@@ -0,0 +1,41 @@
+import threading
+
+from gearman import PRIORITY_LOW
+from gearman import PRIORITY_HIGH
+from gearman import PRIORITY_NONE
+from gearman import JOB_COMPLETE
+
+from services.async import GEARMAN
+from services.async import backends
+from services.async.backends import TaskError
+from services.async.backends import BaseBackend
+
+
+PRIORITIES = {
+    backends.PRIORITY_HIGH: PRIORITY_HIGH,
+    backends.PRIORITY_NORMAL: PRIORITY_NONE,
+    backends.PRIORITY_LOW: PRIORITY_LOW,
+}
+
+
+class GearmanBackend(BaseBackend):
+    """Submits tasks to gearmand, they are run by `manage.py worker`."""
+    def __init__(self):
+        # The Gearman client is not thread safe.
+        self.lock = threading.Lock()
+
+    def submit(self, task, data, unique=None):
+        with self.lock:
+            GEARMAN.submit_job(task.name, data=data, unique=unique,
+                               priority=PRIORITIES[task.priority],
+                               background=True, wait_until_complete=False)
+
+    def submit_wait(self, task, data, timeout=None):
+        with self.lock:
+            request = GEARMAN.submit_job(task.name, data=data,
+                                         priority=PRIORITIES[task.priority],
+                                         poll_timeout=timeout)
+        if request.state != JOB_COMPLETE:
+            raise TaskError('%s did not complete: %s' % (task.name,
+                            request.state))
+        return request.result
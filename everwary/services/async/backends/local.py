@@ -0,0 +1,88 @@
+import Queue
+import logging
+import itertools
+import threading
+
+from concurrent.futures import Future
+
+from django.conf import settings
+
+from services.async import JSONDataEncoder
+from services.async.backends import TaskError
+from services.async.backends import BaseBackend
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class LocalBackend(BaseBackend):
+    """Runs tasks on a pool of threads within this process, for single node
+    installs that do without gearmand.
+
+    Queued tasks run in order of priority, then submission. Arguments are
+    encoded as they would be for gearmand, so tasks see the same fresh rows
+    whichever backend runs them."""
+    def __init__(self, workers=None):
+        self.workers = workers or getattr(settings, 'TASK_WORKERS', 4)
+        self.queue = Queue.PriorityQueue()
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        # Unique keys of queued tasks.
+        self.queued = set()
+        self.threads = []
+
+    def start(self):
+        # Caller holds the lock.
+        for i in range(self.workers):
+            t = threading.Thread(target=self.work, name='task-%s' % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def put(self, task, data, unique=None):
+        future = Future()
+        with self.lock:
+            if unique is not None:
+                if unique in self.queued:
+                    return
+                self.queued.add(unique)
+            if not self.threads:
+                self.start()
+            self.queue.put((task.priority, next(self.counter), task,
+                            JSONDataEncoder.encode(data), unique, future))
+        return future
+
+    def work(self):
+        while True:
+            priority, seq, task, encoded, unique, future = self.queue.get()
+            if task is None:
+                return
+            if unique is not None:
+                with self.lock:
+                    self.queued.discard(unique)
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(task.run_data(JSONDataEncoder.decode(encoded)))
+            except Exception, e:
+                LOGGER.exception('Error running %s', task.name)
+                future.set_exception(e)
+
+    def submit(self, task, data, unique=None):
+        self.put(task, data, unique=unique)
+
+    def submit_wait(self, task, data, timeout=None):
+        try:
+            return self.put(task, data).result(timeout)
+        except Exception, e:
+            raise TaskError('%s failed: %s' % (task.name, e))
+
+    def stop(self):
+        with self.lock:
+            threads, self.threads = self.threads, []
+        for t in threads:
+            # Sorts after every queued task.
+            self.queue.put((float('inf'), next(self.counter), None, None,
+                            None, None))
+        for t in threads:
+            t.join()
@@ -1,14 +1,24 @@
 import time
+import socket
 import logging
 
 from functools import wraps
 
 from django.utils import timezone
 
-from main.models import Camera
 from main.models import Event
 
-from services.async import GEARMAN
+from services import recorder
+from services.state import STATE
+from services.usage import QUOTAS
+from services.usage import QuotaExceeded
+from services.async import resolve
+from services.async import MissingRow
+from services.async import JSONDataEncoder
+from services.async.backends import get_backend
+from services.async.backends import PRIORITY_LOW
+from services.async.backends import PRIORITY_HIGH
+from services.async.backends import PRIORITY_NORMAL
 
 
 # TODO: this should be configurable per camera / account.
@@ -19,61 +29,121 @@ ALERT_INTERVAL = 300
 LOGGER = logging.getLogger(__name__)
 
 
-def task(f):
-    # TODO: Replace the function with a class that provides:
-    # An apply() method, which when TESTING = True executes
-    # the task immediately (not using gearman), and also an
-    # apply_wait() that will return the result.
-    @wraps(f)
-    def decorator(worker, job):
-        args = job.data.get('args', ())
-        kwargs = job.data.get('kwargs', {})
-        return f(*args, **kwargs)
-    setattr(decorator, 'task', True)
-    return decorator
+class Task(object):
+    """A function that can be run asynchronously by the configured backend
+    (see TASK_BACKEND).
+
+    Calling the task runs the function directly. delay() queues it and
+    returns at once, apply() runs it immediately as a backend would, and
+    apply_wait() runs it via the backend and returns the result. Arguments
+    must be JSON serializable, models are passed by key and loaded again
+    when the task runs. A Gearman worker runs at most `concurrency` jobs of
+    the task at once."""
+    def __init__(self, f, priority=PRIORITY_NORMAL, concurrency=None):
+        self.f = f
+        self.name = f.__name__
+        self.priority = priority
+        self.concurrency = concurrency
+        wraps(f)(self)
+
+    def __call__(self, *args, **kwargs):
+        return self.f(*args, **kwargs)
+
+    def delay(self, *args, **kwargs):
+        self.submit(args, kwargs)
+
+    def submit(self, args=(), kwargs=None, unique=None):
+        """Queues the task. A task with the same `unique` key that is still
+        queued is not queued again."""
+        get_backend().submit(self, {'args': args, 'kwargs': kwargs or {},
+                             'submitted': time.time()}, unique=unique)
+
+    def apply(self, *args, **kwargs):
+        data = {'args': args, 'kwargs': kwargs}
+        return self.run_data(JSONDataEncoder.decode(JSONDataEncoder.encode(data)))
+
+    def apply_wait(self, *args, **kwargs):
+        return get_backend().submit_wait(self, {'args': args, 'kwargs': kwargs,
+                                         'submitted': time.time()})
+
+    def run(self, worker, job):
+        """Called by the Gearman worker."""
+        return self.run_data(job.data)
+
+    def run_data(self, data):
+        try:
+            # Load the models referenced by the job, as they are now.
+            args, kwargs = resolve((data.get('args', ()),
+                                    data.get('kwargs', {})))
+        except MissingRow, e:
+            LOGGER.warning('Skipping %s: %s', self.name, e)
+            return
+        return self.f(*args, **kwargs)
+
+
+def task(f=None, **kwargs):
+    if f is None:
+        return lambda f: Task(f, **kwargs)
+    return Task(f, **kwargs)
 
 
 @task
-def alert(event):
+def alert(camera, image=None):
     """Sends an alert when motion is detected."""
-    LOGGER.info('Sending alert for %s', event.camera)
-    event.camera.events.create(event=Event.CAMERA_EVENT_ALERT, image=event.image)
+    LOGGER.info('Sending alert for %s', camera)
+    camera.events.create(event=Event.CAMERA_EVENT_ALERT, image=image)
 
 
-@task
-def motion(event):
-    """Handles motion detection for a camera."""
+@task(priority=PRIORITY_HIGH)
+def motion(camera, images):
+    """Handles motion detection for a camera. `images` are the stills
+    received during a burst of motion, oldest first."""
     # Discard stale motion events
-    if (timezone.now() - event.created).seconds >= RECORDING_DURATION:
+    if (timezone.now() - images[-1].created).seconds >= RECORDING_DURATION:
         return
-    # if last alert was sent more than ALERT_THRESHOLD ago, send another
-    if not event.camera.events.filter(event=Event.CAMERA_EVENT_ALERT,
-                                      timeago=ALERT_INTERVAL).count():
+    # if last alert was sent more than ALERT_INTERVAL ago, send another
+    if STATE.claim_alert(camera.id, ALERT_INTERVAL):
         # Send a new alert asynchronously, without waiting.
-        GEARMAN.submit_job('alert', data={'args': (event, ), 'kwargs':
-                           {}}, background=True, wait_until_complete=False)
-    # if already recording, nothing left to do.
-    if event.camera.state == Camera.CAMERA_STATE_RECORDING:
-        LOGGER.info('Already recording for %s', event.camera)
+        alert.delay(camera, images[0])
+    disabled = STATE.is_disabled(camera.id)
+    if disabled is None:
+        disabled = camera.disabled
+    if disabled or not camera.record:
+        return
+    # The recorder starts recording, or extends the current recording.
+    try:
+        recorder.record(camera, RECORDING_DURATION)
+    except socket.error:
+        LOGGER.exception('Could not reach the recorder for %s', camera)
+
+
+@task(priority=PRIORITY_LOW)
+def capture(camera):
+    """Captures a still image, run by capture periods."""
+    if camera.disabled:
         return
-    LOGGER.info('Recording for %s', event.camera)
-    event.camera.set_state(Camera.CAMERA_STATE_RECORDING)
     try:
-        be = event.camera.get_backend()
-        be.record()
+        QUOTAS.check(camera)
+    except QuotaExceeded, e:
+        LOGGER.warning('Not capturing: %s', e)
+        return
+    camera.get_backend().capture()
+
+
+@task(priority=PRIORITY_LOW, concurrency=1)
+def health(camera=None):
+    """Checks the health of a camera, or of all cameras."""
+    # Imported here, health sends alerts using tasks in this module.
+    from services.health import HealthChecker
+    if camera is None:
+        checker = HealthChecker()
+        try:
+            checker.sweep()
+        finally:
+            checker.shutdown()
+    else:
+        checker = HealthChecker(workers=1, spread=0, jitter=0)
         try:
-            while True:
-                # Check camera is still enabled
-                if event.camera.disabled:
-                    break
-                # Check that there is recent detected motion
-                if not event.camera.events.filter(event=Event.CAMERA_EVENT_MOTION,
-                                                  timeago=RECORDING_DURATION).count():
-                    break
-                time.sleep(10.0)
+            checker.save(checker.check([camera]))
         finally:
-            event.camera.events.create(event=Event.CAMERA_EVENT_RECORDING,
-                                       video=be.stop())
-    finally:
-        event.camera.set_state(Camera.CAMERA_STATE_OK)
-    LOGGER.info('Done recording for %s', event.camera)
+            checker.shutdown()
@@ -0,0 +1,103 @@
+import time
+import logging
+import urlparse
+import threading
+import collections
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from main.models import Zone
+from main.models import Image
+from main.models import Camera
+from main.models import Usage
+
+from services.usage import QUOTAS
+from services.sessions import SessionPool
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def get_zone_cameras(zone):
+    """Returns the cameras in a zone and the zones nested in it."""
+    zones, parents = [zone.id], [zone.id]
+    while parents:
+        parents = list(Zone.objects.filter(parent__in=parents)
+                       .values_list('id', flat=True))
+        zones.extend(parents)
+    return Camera.objects.filter(zone__in=zones, disabled=False)
+
+
+class Capturer(object):
+    """Grabs stills from many cameras at once.
+
+    Cameras are grouped by host, and each host gets at most `per_host`
+    jobs on the pool of `workers` threads, each job capturing its share of
+    the host's cameras one after the other. Jobs thus never wait on each
+    other, and connections to a host are kept alive from one capture to the
+    next. Images are written by the jobs and inserted in one query."""
+    def __init__(self, workers=None, per_host=None, timeout=None):
+        self.workers = workers or getattr(settings, 'CAPTURE_WORKERS', 64)
+        self.per_host = per_host or getattr(settings, 'CAPTURE_PER_HOST', 2)
+        self.timeout = timeout or getattr(settings, 'CAPTURE_TIMEOUT', 10)
+        self.pool = ThreadPoolExecutor(self.workers)
+        self.sessions = SessionPool(maxsize=self.per_host)
+
+    def grab(self, cameras):
+        results = []
+        for camera in cameras:
+            try:
+                QUOTAS.check(camera)
+                image, content = camera.get_backend().snapshot(
+                    session=self.sessions.get(camera.url),
+                    timeout=self.timeout)
+                image.write(content)
+            except Exception, e:
+                LOGGER.warning('Could not capture %s: %s', camera, e)
+                results.append((camera, e))
+            else:
+                results.append((camera, image))
+        return results
+
+    def capture(self, cameras):
+        """Captures a still from each camera. Returns the Images created,
+        and a list of (camera, exception) for the cameras that failed."""
+        hosts = collections.defaultdict(list)
+        for camera in cameras:
+            hosts[urlparse.urlsplit(camera.url).netloc].append(camera)
+        start = time.time()
+        jobs = []
+        for host_cameras in hosts.values():
+            for i in range(min(self.per_host, len(host_cameras))):
+                jobs.append(self.pool.submit(self.grab,
+                                             host_cameras[i::self.per_host]))
+        images, failed = [], []
+        for job in jobs:
+            for camera, result in job.result():
+                if isinstance(result, Image):
+                    images.append(result)
+                else:
+                    failed.append((camera, result))
+        Image.objects.bulk_create(images)
+        Usage.objects.record(images)
+        LOGGER.info('Captured %s stills in %.1fs, %s failed', len(images),
+                    time.time() - start, len(failed))
+        return images, failed
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+
+CAPTURER = None
+CAPTURER_LOCK = threading.Lock()
+
+
+def get_capturer():
+    """Returns the Capturer shared by the process."""
+    global CAPTURER
+    with CAPTURER_LOCK:
+        if CAPTURER is None:
+            CAPTURER = Capturer()
+    return CAPTURER
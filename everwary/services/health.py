@@ -0,0 +1,152 @@
+import time
+import zlib
+import random
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from main.models import Camera
+from main.models import Event
+from main.cameras import NotSupportedError
+from main.cameras.base import BaseCamera
+
+from services.async import tasks
+from services.sessions import SessionPool
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Rows per UPDATE ... WHERE id IN (...), keeps under SQLite's variable limit.
+CHUNK_SIZE = 500
+
+
+def chunks(l, size):
+    for i in range(0, len(l), size):
+        yield l[i:i + size]
+
+
+class HealthChecker(object):
+    """Probes cameras on a pool of `workers` threads, and tracks outages,
+    see save().
+
+    Each camera is probed at a fixed offset within the first `spread`
+    seconds of a sweep, derived from its id, plus up to `jitter` seconds
+    at random. Cameras are thus probed about once per sweep and a fleet is
+    not hit all at once. Cameras on the same host share a requests session,
+    so connections are reused from one sweep to the next."""
+    def __init__(self, workers=None, timeout=None, spread=None, jitter=1.0,
+                 alert_after=None):
+        self.workers = workers or getattr(settings, 'HEALTH_WORKERS', 256)
+        self.timeout = timeout or getattr(settings, 'HEALTH_TIMEOUT', 2)
+        if spread is None:
+            spread = getattr(settings, 'HEALTH_SPREAD', 30)
+        self.spread = spread
+        self.jitter = jitter
+        self.alert_after = alert_after or getattr(settings, 'HEALTH_ALERT_AFTER', 3)
+        self.pool = ThreadPoolExecutor(self.workers)
+        self.sessions = SessionPool()
+
+    def get_offset(self, camera):
+        phase = (zlib.crc32(str(camera.id)) & 0xffffffff) % 1000 / 1000.0
+        return phase * self.spread + random.uniform(0, self.jitter)
+
+    def probe(self, camera):
+        backend = None
+        if camera.make:
+            try:
+                backend = camera.get_backend()
+            except NotSupportedError:
+                pass
+        if backend is None:
+            # Unknown cameras get a plain HTTP probe.
+            backend = BaseCamera(camera)
+        try:
+            return backend.health(session=self.sessions.get(camera.url),
+                                  timeout=self.timeout)
+        except Exception:
+            LOGGER.exception('Health check failed for %s', camera)
+            return False
+
+    def check(self, cameras):
+        """Probes `cameras`, returning a list of (camera, reachable)."""
+        start = time.time()
+        schedule = sorted(((start + self.get_offset(c), c) for c in cameras),
+                          key=lambda s: s[0])
+        futures = []
+        for when, camera in schedule:
+            delay = when - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append((camera, self.pool.submit(self.probe, camera)))
+        return [(camera, f.result()) for camera, f in futures]
+
+    def save(self, results):
+        """Records the outcome of a sweep. A camera that becomes unreachable
+        gets an open UNREACHABLE event, its `count` is incremented on each
+        failed probe after that and the event is closed when the camera
+        recovers, so there is one event per outage. An alert is sent when
+        the count reaches `alert_after`. All of this takes a few bulk queries
+        whatever the number of cameras."""
+        failed, still_failing, recovered = [], [], []
+        for camera, reachable in results:
+            if not reachable:
+                if camera.state == Camera.CAMERA_STATE_UNREACHABLE:
+                    still_failing.append(camera)
+                else:
+                    failed.append(camera)
+            elif camera.state in (Camera.CAMERA_STATE_UNKNOWN,
+                                  Camera.CAMERA_STATE_UNREACHABLE):
+                recovered.append(camera)
+        now = timezone.now()
+        outages = Event.objects.filter(event=Event.CAMERA_EVENT_UNREACHABLE,
+                                       closed__isnull=True)
+        # Cameras left unreachable without an open outage (from before
+        # outages were counted, or whose event was expired) get a new one.
+        open_outages = set()
+        for chunk in chunks([c.id for c in still_failing], CHUNK_SIZE):
+            open_outages.update(outages.filter(camera_id__in=chunk)
+                                .values_list('camera_id', flat=True))
+        failed.extend(c for c in still_failing if c.id not in open_outages)
+        still_failing = [c for c in still_failing if c.id in open_outages]
+        # Close outages that ended, or that were left open.
+        for chunk in chunks([c.id for c in recovered + failed], CHUNK_SIZE):
+            outages.filter(camera_id__in=chunk).update(closed=now)
+        for chunk in chunks([c.id for c in still_failing], CHUNK_SIZE):
+            outages.filter(camera_id__in=chunk).update(count=F('count') + 1)
+        Event.objects.bulk_create([Event(camera=c, count=1,
+                                   event=Event.CAMERA_EVENT_UNREACHABLE)
+                                   for c in failed])
+        for cameras, state in ((failed, Camera.CAMERA_STATE_UNREACHABLE),
+                               (recovered, Camera.CAMERA_STATE_OK)):
+            for chunk in chunks([c.id for c in cameras], CHUNK_SIZE):
+                Camera.objects.filter(id__in=chunk).update(state=state)
+        # Alert on the nth failure.
+        alerting = []
+        if self.alert_after == 1:
+            alerting.extend(failed)
+        else:
+            cameras = dict((c.id, c) for c in still_failing)
+            for chunk in chunks(cameras.keys(), CHUNK_SIZE):
+                alerting.extend(cameras[i] for i in outages.filter(
+                    camera_id__in=chunk, count=self.alert_after).values_list(
+                    'camera_id', flat=True))
+        for camera in alerting:
+            if camera.alerts:
+                tasks.alert.delay(camera)
+        return failed, recovered
+
+    def sweep(self):
+        """Checks every camera that has health checks enabled."""
+        cameras = list(Camera.objects.filter(health=True, disabled=False))
+        timestamp = time.time()
+        failed, recovered = self.save(self.check(cameras))
+        LOGGER.info('Checked %s cameras in %.1fs, %s failed, %s recovered',
+                    len(cameras), time.time() - timestamp, len(failed),
+                    len(recovered))
+
+    def shutdown(self):
+        self.pool.shutdown()
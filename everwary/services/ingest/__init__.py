@@ -0,0 +1,49 @@
+import atexit
+
+from django.conf import settings
+
+from main.models import Event
+
+from services.state import STATE
+from services.async import tasks
+from services.async.backends import get_backend
+from services.ingest.writer import WRITER
+from services.ingest.coalesce import MotionCoalescer
+
+
+def image_received(image):
+    """Called with an unsaved Image for a still received from a camera. The
+    image and a motion event are queued for insertion, once they are
+    committed the image is handed to the motion coalescer."""
+    if not image.size:
+        # Streamed to storage without a blob, see Image.open().
+        image.size = image.get_size()
+    m = Event(camera=image.camera, event=Event.CAMERA_EVENT_MOTION, image=image)
+    WRITER.add(image, m, callback=motion_committed, args=(image.camera, image))
+    return m
+
+
+def motion_committed(camera, image):
+    # The recorder extends recordings while motion continues.
+    STATE.touch_motion(camera.id)
+    COALESCER.add(camera, image)
+
+
+def dispatch_motion(camera, images):
+    """Submits a single motion task for a burst of stills. The unique key
+    lets the backend drop duplicates submitted by other ingest processes
+    while one is still queued."""
+    tasks.motion.submit((camera, images), unique='motion-%s' % camera.id)
+
+
+def stop():
+    """Writes out queued rows and dispatches held stills, called when an
+    ingest server exits."""
+    WRITER.stop()
+    COALESCER.stop()
+    get_backend().stop()
+
+
+COALESCER = MotionCoalescer(getattr(settings, 'MOTION_COALESCE_WINDOW', 10),
+                            dispatch_motion)
+atexit.register(stop)
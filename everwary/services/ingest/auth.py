@@ -0,0 +1,94 @@
+import time
+import threading
+import collections
+
+from django.conf import settings
+from django.db.models.signals import post_save
+from django.db.models.signals import post_delete
+
+from main.models import Camera
+
+
+class CameraCache(object):
+    """In-process cache of cameras keyed by their `auth` name, used by the
+    ingest servers to authenticate and identify cameras without a query per
+    login or upload.
+
+    Entries expire after `ttl` seconds and the least recently used entry is
+    evicted once `size` is reached. Unknown names are cached as well, so
+    repeated bad logins do not reach the database either. Saving or deleting
+    a camera invalidates its entry immediately within this process, other
+    processes pick up the change once the entry expires."""
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        # Maps camera id to auth, so a changed auth can be invalidated.
+        self.auths = {}
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, auth):
+        """Returns the camera with the given auth name, or None."""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.pop(auth, None)
+            if entry is not None and entry[0] > now:
+                # Re-insert to mark as most recently used.
+                self.entries[auth] = entry
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        try:
+            camera = Camera.objects.get(auth=auth)
+        except Camera.DoesNotExist:
+            camera = None
+        with self.lock:
+            self.entries.pop(auth, None)
+            self.entries[auth] = (now + self.ttl, camera)
+            if camera is not None:
+                self.auths[camera.id] = auth
+            while len(self.entries) > self.size:
+                evicted, (expires, c) = self.entries.popitem(last=False)
+                if c is not None:
+                    self.auths.pop(c.id, None)
+                self.evictions += 1
+        return camera
+
+    def authenticate(self, auth, key):
+        """Returns the camera if the credentials are valid and the camera is
+        enabled."""
+        camera = self.get(auth)
+        if camera is not None and camera.key == key and not camera.disabled:
+            return camera
+
+    def invalidate(self, camera):
+        with self.lock:
+            for auth in (self.auths.pop(camera.id, None), camera.auth):
+                self.entries.pop(auth, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.auths.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+CAMERAS = CameraCache(getattr(settings, 'CAMERA_CACHE_SIZE', 10000),
+                      getattr(settings, 'CAMERA_CACHE_TTL', 60))
+
+
+def invalidate_camera(sender, instance, **kwargs):
+    CAMERAS.invalidate(instance)
+
+
+post_save.connect(invalidate_camera, sender=Camera)
+post_delete.connect(invalidate_camera, sender=Camera)
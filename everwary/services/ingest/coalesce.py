@@ -0,0 +1,90 @@
+import time
+import heapq
+import logging
+import threading
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class MotionCoalescer(threading.Thread):
+    """Collapses bursts of stills from a camera into as few motion tasks as
+    possible.
+
+    The first still from a camera is dispatched right away, so recording
+    starts without delay, and opens a window of `window` seconds. Stills
+    arriving within the window are held, when it closes they are dispatched
+    together as a single task, and a new window opens. A camera sending a
+    steady stream of stills thus produces one task per window."""
+    def __init__(self, window, dispatch):
+        super(MotionCoalescer, self).__init__(name='motion-coalescer')
+        self.daemon = True
+        self.window = window
+        self.dispatch = dispatch
+        self.cond = threading.Condition()
+        # Open windows, camera id -> (camera, held images)
+        self.bursts = {}
+        # Heap of (deadline, camera id)
+        self.deadlines = []
+        self.running = False
+        self.stopped = False
+
+    def add(self, camera, image):
+        with self.cond:
+            if camera.id in self.bursts:
+                self.bursts[camera.id][1].append(image)
+                return
+            if self.window > 0 and not self.stopped:
+                if not self.running:
+                    self.running = True
+                    self.start()
+                self.bursts[camera.id] = (camera, [])
+                heapq.heappush(self.deadlines, (time.time() + self.window, camera.id))
+                self.cond.notify()
+        self.send(camera, [image])
+
+    def send(self, camera, images):
+        try:
+            self.dispatch(camera, images)
+        except Exception:
+            LOGGER.exception('Could not dispatch motion for %s', camera)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.running:
+                    if self.deadlines:
+                        remaining = self.deadlines[0][0] - time.time()
+                        if remaining <= 0:
+                            break
+                        self.cond.wait(remaining)
+                    else:
+                        self.cond.wait()
+                if not self.running:
+                    return
+                ready = []
+                now = time.time()
+                while self.deadlines and self.deadlines[0][0] <= now:
+                    deadline, camera_id = heapq.heappop(self.deadlines)
+                    camera, images = self.bursts.pop(camera_id)
+                    if images:
+                        # Motion continues, start a new window.
+                        ready.append((camera, images))
+                        self.bursts[camera_id] = (camera, [])
+                        heapq.heappush(self.deadlines, (now + self.window, camera_id))
+            for camera, images in ready:
+                self.send(camera, images)
+
+    def stop(self):
+        """Stops the background thread and dispatches held stills."""
+        with self.cond:
+            running, self.running = self.running, False
+            self.stopped = True
+            self.cond.notify()
+            bursts, self.bursts = self.bursts, {}
+            self.deadlines = []
+        if running:
+            self.join()
+        for camera, images in bursts.values():
+            if images:
+                self.send(camera, images)
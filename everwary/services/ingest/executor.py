@@ -0,0 +1,72 @@
+import os
+import errno
+import fcntl
+import asyncore
+import collections
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Wakeup(asyncore.file_dispatcher):
+    """The read end of a pipe, used to wake the asyncore loop when a call
+    completes on another thread."""
+    def __init__(self, executor, map=None):
+        r, w = os.pipe()
+        asyncore.file_dispatcher.__init__(self, r, map)
+        # file_dispatcher works on a copy of the descriptor.
+        os.close(r)
+        fcntl.fcntl(w, fcntl.F_SETFL, fcntl.fcntl(w, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.executor = executor
+        self.wfd = w
+
+    def wake(self):
+        try:
+            os.write(self.wfd, 'x')
+        except OSError, e:
+            # A full pipe will wake the loop just the same.
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+        self.executor.run_callbacks()
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self.wfd)
+
+
+class LoopExecutor(object):
+    """Runs blocking calls (database, disk, Gearman) on a bounded pool of
+    threads so that they do not stall the asyncore loop. Callbacks are
+    invoked from the loop with the completed future."""
+    def __init__(self, workers, map=None):
+        self.pool = ThreadPoolExecutor(workers)
+        self.done = collections.deque()
+        self.wakeup = Wakeup(self, map)
+
+    def submit(self, callback, fn, *args, **kwargs):
+        future = self.pool.submit(fn, *args, **kwargs)
+        future.add_done_callback(lambda f: self.complete(callback, f))
+        return future
+
+    def complete(self, callback, future):
+        # Called on the pool thread, deque.append() is thread safe.
+        self.done.append((callback, future))
+        self.wakeup.wake()
+
+    def run_callbacks(self):
+        while self.done:
+            callback, future = self.done.popleft()
+            callback(future)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+        self.wakeup.close()
@@ -0,0 +1,173 @@
+import re
+import binascii
+
+from email.parser import HeaderParser
+
+
+# Parser states.
+HEADERS = 0
+BODY = 1
+SKIP = 2
+DONE = 3
+
+# The most header data that will be buffered for a single MIME entity.
+MAX_HEADER_SIZE = 64 * 1024
+
+BASE64_JUNK = re.compile(r'[^A-Za-z0-9+/=]')
+
+
+class Base64Decoder(object):
+    """Decodes base64 a line at a time. Only a partial quantum (less than
+    four characters) is carried between lines."""
+    def __init__(self, f):
+        self.f = f
+        self.pending = ''
+
+    def feed(self, line):
+        data = self.pending + BASE64_JUNK.sub('', line)
+        n = len(data) - len(data) % 4
+        self.pending = data[n:]
+        if n:
+            self.f.write(binascii.a2b_base64(data[:n]))
+
+    def close(self):
+        if not self.pending:
+            return
+        try:
+            self.f.write(binascii.a2b_base64(self.pending + '=' * (4 - len(self.pending))))
+        except binascii.Error:
+            pass
+        self.pending = ''
+
+
+class QuotedPrintableDecoder(object):
+    """Decodes quoted-printable a line at a time. The line break before a
+    boundary belongs to the boundary, so line breaks are written lazily."""
+    def __init__(self, f):
+        self.f = f
+        self.newline = False
+
+    def feed(self, line):
+        if self.newline:
+            self.f.write('\n')
+        if line.endswith('='):
+            # Soft line break.
+            self.f.write(binascii.a2b_qp(line[:-1]))
+            self.newline = False
+        else:
+            self.f.write(binascii.a2b_qp(line))
+            self.newline = True
+
+    def close(self):
+        pass
+
+
+class PlainDecoder(object):
+    """Writes 7bit, 8bit and binary content as is."""
+    def __init__(self, f):
+        self.f = f
+        self.newline = False
+
+    def feed(self, line):
+        if self.newline:
+            self.f.write('\n')
+        self.f.write(line)
+        self.newline = True
+
+    def close(self):
+        pass
+
+
+DECODERS = {
+    'base64': Base64Decoder,
+    'quoted-printable': QuotedPrintableDecoder,
+}
+
+
+class ImageExtractor(object):
+    """Incremental MIME parser that writes the first image/* part of a
+    message to a file while the message is being received.
+
+    Lines are fed one at a time, without line endings. Only the headers of
+    the current entity and the open boundaries are kept in memory, so memory
+    use does not depend on the size of the message or its attachments.
+
+    Subclasses implement open_image() to provide the destination file."""
+    def __init__(self):
+        self.state = HEADERS
+        self.headers = []
+        self.header_size = 0
+        self.boundaries = []
+        self.decoder = None
+        self.file = None
+        self.mime = None
+
+    def open_image(self, mime):
+        """Returns a writable file for an image of the given type."""
+        raise NotImplementedError()
+
+    def feed(self, line):
+        if self.state == DONE:
+            return
+        if self.boundaries and line.startswith('--'):
+            marker = line[2:].rstrip()
+            # A boundary closes any entities nested within it, including
+            # those whose own closing boundary never arrived.
+            for i in range(len(self.boundaries) - 1, -1, -1):
+                boundary = self.boundaries[i]
+                if marker == boundary:
+                    self.end_part()
+                    del self.boundaries[i + 1:]
+                    self.state = HEADERS
+                    return
+                if marker == boundary + '--':
+                    self.end_part()
+                    del self.boundaries[i:]
+                    self.state = SKIP
+                    return
+        if self.state == HEADERS:
+            if line:
+                self.header_size += len(line)
+                if self.header_size <= MAX_HEADER_SIZE:
+                    self.headers.append(line)
+                return
+            self.start_part()
+        elif self.state == BODY:
+            self.decoder.feed(line)
+
+    def start_part(self):
+        headers = HeaderParser().parsestr('\n'.join(self.headers) + '\n\n')
+        self.headers, self.header_size = [], 0
+        self.state = SKIP
+        mime = headers.get_content_type()
+        if headers.get_content_maintype() == 'multipart':
+            boundary = headers.get_param('boundary')
+            if boundary:
+                self.boundaries.append(boundary)
+        elif mime.startswith('image/') and self.mime is None:
+            self.file = self.open_image(mime)
+            self.mime = mime
+            encoding = headers.get('content-transfer-encoding', '').strip().lower()
+            self.decoder = DECODERS.get(encoding, PlainDecoder)(self.file)
+            self.state = BODY
+
+    def end_part(self):
+        if self.decoder is None:
+            return
+        self.decoder.close()
+        self.decoder = None
+        self.file.close()
+
+    def close(self):
+        """Finishes parsing, returns True if an image was written."""
+        self.end_part()
+        self.state = DONE
+        return self.mime is not None
+
+    def abort(self):
+        """Stops parsing a message that was not completely received."""
+        self.decoder = None
+        if self.file is not None:
+            self.file.close()
+        self.mime = None
+        self.state = DONE
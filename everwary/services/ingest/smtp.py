@@ -0,0 +1,479 @@
+import socket
+import base64
+import logging
+import asyncore
+import asynchat
+import collections
+
+from functools import wraps
+
+from main.models import Image
+
+from services.ingest import image_received
+from services.ingest.auth import CAMERAS
+from services.usage import QUOTAS
+from services.usage import QuotaExceeded
+from services.ingest.mime import ImageExtractor
+from services.ingest.executor import LoopExecutor
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Longest line accepted, RFC 5321 only requires 1000 octets.
+MAX_LINE_LENGTH = 4096
+# Decoded image data is handed to the executor in chunks of this size.
+CHUNK_SIZE = 64 * 1024
+# A client is not read from while this much data waits to be written.
+MAX_QUEUED = 4 * CHUNK_SIZE
+# Number of threads performing database and disk work.
+DEFAULT_WORKERS = 8
+BACKLOG = 128
+# Linux value, the socket module does not expose it on Python 2.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+# Answer to a message from a user over quota, a permanent failure so that
+# cameras do not retry it.
+QUOTA_EXCEEDED = '552 Error: exceeded storage allocation'
+
+# White list of operations that are allowed prior to AUTH.
+UNAUTHENTICATED = ('AUTH', 'EHLO', 'HELO', 'NOOP', 'RSET', 'QUIT')
+
+# Channel states.
+COMMAND = 0
+AUTH_USERNAME = 1
+AUTH_PASSWORD = 2
+DATA = 3
+
+
+def guarded(f):
+    """Once a message has failed, further work on it is skipped."""
+    @wraps(f)
+    def wrapper(self, *args):
+        if self.error is not None:
+            return
+        try:
+            return f(self, *args)
+        except QuotaExceeded, e:
+            LOGGER.warning('Refused image from %s: %s', self.username, e)
+            self.error = e
+        except Exception, e:
+            LOGGER.exception('Error saving image from %s', self.username)
+            self.error = e
+    return wrapper
+
+
+class ImageSink(object):
+    """File-like object the parser writes the image to. Data is buffered
+    and written out in chunks by the executor."""
+    def __init__(self, message):
+        self.message = message
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        data = ''.join(self.buffer)
+        self.buffer, self.buffered = [], 0
+        self.message.channel.defer(self.message.append, data, size=len(data))
+
+    def close(self):
+        self.flush()
+        self.message.channel.defer(self.message.close_file)
+
+
+class SMTPMessage(ImageExtractor):
+    """Saves the first image of a message sent by a camera. Parsing happens
+    in the loop, methods marked as guarded run on the executor."""
+    def __init__(self, channel):
+        super(SMTPMessage, self).__init__()
+        self.channel = channel
+        self.username = channel.username
+        self.image = None
+        self.f = None
+        self.error = None
+
+    def open_image(self, mime):
+        self.channel.defer(self.create, mime)
+        return ImageSink(self)
+
+    def abort(self):
+        super(SMTPMessage, self).abort()
+        self.channel.defer(self.discard)
+
+    @guarded
+    def create(self, mime):
+        camera = CAMERAS.get(self.username)
+        QUOTAS.check(camera)
+        # The row is inserted by image_received() once the data is saved.
+        self.image = Image(camera=camera, mime=mime)
+        self.f = self.image.open('wb')
+
+    @guarded
+    def append(self, data):
+        self.f.write(data)
+
+    @guarded
+    def close_file(self):
+        self.f.close()
+        self.f = None
+
+    def discard(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+        if self.image is not None:
+            try:
+                self.image.delete_file()
+            except OSError:
+                pass
+            self.image = None
+
+
+class SMTPChannel(asynchat.async_chat):
+    """A single SMTP session. Lines are handled in the loop, anything that
+    may block is deferred to the server's executor one call at a time, so
+    the work for a session happens in order."""
+    def __init__(self, server, conn, addr):
+        asynchat.async_chat.__init__(self, conn)
+        self.server = server
+        self.peer = addr
+        self.state = COMMAND
+        self.line = []
+        self.length = 0
+        # Lines received while waiting on the executor.
+        self.pending = collections.deque()
+        self.waiting = False
+        # Calls waiting to be run on the executor.
+        self.jobs = collections.deque()
+        self.running = False
+        self.queued = 0
+        self.greeting = None
+        self.username = None
+        self.authenticated = False
+        self.mailfrom = None
+        self.rcpttos = []
+        self.message = None
+        self.toolong = False
+        self.set_terminator('\r\n')
+        self.push('220 %s EverWary ESMTP' % server.fqdn)
+
+    def push(self, msg):
+        if self.connected:
+            asynchat.async_chat.push(self, msg + '\r\n')
+
+    def readable(self):
+        return not self.waiting and self.queued < MAX_QUEUED
+
+    def defer(self, fn, *args, **kwargs):
+        """Queues a call for the executor, callback is invoked in the loop
+        with the resulting future."""
+        callback = kwargs.pop('callback', None)
+        size = kwargs.pop('size', 0)
+        self.queued += size
+        self.jobs.append((fn, args, callback, size))
+        if not self.running:
+            self.next_job()
+
+    def next_job(self):
+        if not self.jobs:
+            self.running = False
+            return
+        self.running = True
+        fn, args, callback, size = self.jobs.popleft()
+        self.server.executor.submit(
+            lambda future: self.job_done(future, callback, size), fn, *args)
+
+    def job_done(self, future, callback, size):
+        self.queued -= size
+        if callback is not None:
+            callback(future)
+        elif future.exception() is not None:
+            LOGGER.error('Error processing %s: %s', self.peer, future.exception())
+        self.next_job()
+        self.run()
+
+    def collect_incoming_data(self, data):
+        # Discard anything past the line length limit, so a peer can not
+        # make us buffer an unbounded amount of data.
+        self.length += len(data)
+        if self.length <= MAX_LINE_LENGTH:
+            self.line.append(data)
+
+    def found_terminator(self):
+        line = ''.join(self.line)
+        if self.length > MAX_LINE_LENGTH:
+            line = None
+        self.line, self.length = [], 0
+        self.pending.append(line)
+        self.run()
+
+    def run(self):
+        while self.pending and not self.waiting:
+            line = self.pending.popleft()
+            if self.state == DATA:
+                self.data(line)
+            elif line is None:
+                self.push('500 Error: line too long')
+            elif self.state == AUTH_USERNAME:
+                self.auth_username(line)
+            elif self.state == AUTH_PASSWORD:
+                self.auth_password(line)
+            else:
+                self.command(line)
+
+    def command(self, line):
+        if not line:
+            self.push('500 Error: bad syntax')
+            return
+        i = line.find(' ')
+        if i < 0:
+            command, arg = line.upper(), None
+        else:
+            command, arg = line[:i].upper(), line[i + 1:].strip()
+        if command not in UNAUTHENTICATED and not self.authenticated:
+            self.push('530 Authentication required')
+            return
+        method = getattr(self, 'smtp_' + command, None)
+        if not method:
+            self.push('502 Error: command "%s" not implemented' % command)
+            return
+        method(arg)
+
+    def data(self, line):
+        if line is None:
+            if not self.toolong:
+                self.toolong = True
+                self.message.abort()
+            return
+        if line != '.':
+            # De-transparency according to RFC 821, Section 4.5.2.
+            if line[:1] == '.':
+                line = line[1:]
+            self.message.feed(line)
+            return
+        if self.toolong:
+            self.push('552 Error: line too long')
+            self.reset()
+            return
+        self.message.close()
+        self.waiting = True
+        self.defer(self.server.process_message, self.username, self.peer,
+                   self.mailfrom, self.rcpttos, self.message,
+                   callback=self.message_done)
+
+    def message_done(self, future):
+        self.waiting = False
+        if future.exception() is not None:
+            LOGGER.error('Error processing message from %s: %s', self.peer,
+                         future.exception())
+            self.push('451 Error: local error in processing')
+        else:
+            self.push(future.result() or '250 Ok')
+        self.reset()
+
+    def reset(self):
+        self.state = COMMAND
+        self.mailfrom = None
+        self.rcpttos = []
+        self.message = None
+        self.toolong = False
+
+    def handle_close(self):
+        if self.message is not None:
+            self.message.abort()
+            self.message = None
+        self.close()
+
+    def getaddr(self, keyword, arg):
+        if not arg or arg[:len(keyword)].upper() != keyword:
+            return
+        address = arg[len(keyword):].strip()
+        if address.startswith('<') and address.endswith('>') and address != '<>':
+            address = address[1:-1]
+        return address
+
+    def smtp_HELO(self, arg):
+        if not arg:
+            self.push('501 Syntax: HELO hostname')
+            return
+        if self.greeting:
+            self.push('503 Duplicate HELO/EHLO')
+            return
+        self.greeting = arg
+        self.push('250 %s' % self.server.fqdn)
+
+    def smtp_EHLO(self, arg):
+        if not arg:
+            self.push('501 Syntax: EHLO hostname')
+            return
+        if self.greeting:
+            self.push('503 Duplicate HELO/EHLO')
+            return
+        self.greeting = arg
+        self.push('250-%s Hello %s' % (self.server.fqdn, arg))
+        self.push('250-AUTH LOGIN')
+        self.push('250 8BITMIME')
+
+    def smtp_NOOP(self, arg):
+        self.push('250 Ok')
+
+    def smtp_QUIT(self, arg):
+        self.push('221 Bye')
+        self.close_when_done()
+
+    def smtp_RSET(self, arg):
+        self.reset()
+        self.push('250 Ok')
+
+    def smtp_AUTH(self, arg):
+        if self.authenticated:
+            self.push('503 Already authenticated')
+            return
+        args = (arg or '').split()
+        if not args:
+            self.push('501 Syntax: AUTH mechanism')
+            return
+        if args[0].upper() != 'LOGIN':
+            self.push('504 Unrecognized authentication type')
+            return
+        # Some implementations of 'LOGIN' provide the username along with
+        # the 'LOGIN' stanza, hence both situations are handled.
+        if len(args) == 2:
+            self.auth_username(args[1])
+        else:
+            self.state = AUTH_USERNAME
+            self.push('334 ' + base64.b64encode('Username:'))
+
+    def auth_username(self, arg):
+        self.state = COMMAND
+        try:
+            self.username = base64.b64decode(arg)
+        except TypeError:
+            self.push('501 Error: invalid base64 data')
+            return
+        self.state = AUTH_PASSWORD
+        self.push('334 ' + base64.b64encode('Password:'))
+
+    def auth_password(self, arg):
+        self.state = COMMAND
+        try:
+            password = base64.b64decode(arg)
+        except TypeError:
+            self.push('501 Error: invalid base64 data')
+            return
+        self.waiting = True
+        self.defer(self.server.authenticate, self.username, password,
+                   callback=self.auth_done)
+
+    def auth_done(self, future):
+        self.waiting = False
+        if future.exception() is None and future.result():
+            self.authenticated = True
+            self.push('235 Authentication successful.')
+        else:
+            self.username = None
+            self.push('535 Authentication credentials invalid.')
+
+    def smtp_MAIL(self, arg):
+        address = self.getaddr('FROM:', arg)
+        if not address:
+            self.push('501 Syntax: MAIL FROM:<address>')
+            return
+        if self.mailfrom:
+            self.push('503 Error: nested MAIL command')
+            return
+        self.mailfrom = address
+        self.push('250 Ok')
+
+    def smtp_RCPT(self, arg):
+        if not self.mailfrom:
+            self.push('503 Error: need MAIL command')
+            return
+        address = self.getaddr('TO:', arg)
+        if not address:
+            self.push('501 Syntax: RCPT TO: <address>')
+            return
+        self.rcpttos.append(address)
+        self.push('250 Ok')
+
+    def smtp_DATA(self, arg):
+        if not self.rcpttos:
+            self.push('503 Error: need RCPT command')
+            return
+        if arg:
+            self.push('501 Syntax: DATA')
+            return
+        self.state = DATA
+        self.message = self.server.open_message(self)
+        self.push('354 End data with <CR><LF>.<CR><LF>')
+
+
+class SMTPServer(asyncore.dispatcher):
+    """SMTP server that accepts still images from cameras. The protocol is
+    handled by a single asyncore loop, while database, disk and Gearman
+    calls are made on a bounded pool of threads.
+
+    Several processes can serve the same port, either by sharing an
+    inherited listening socket (circus --fd) or by binding with
+    SO_REUSEPORT, in which case the kernel balances connections."""
+    channel_class = SMTPChannel
+
+    def __init__(self, address_or_socket, workers=DEFAULT_WORKERS,
+                 reuse_port=False):
+        asyncore.dispatcher.__init__(self)
+        if callable(getattr(address_or_socket, 'listen', None)):
+            address_or_socket.setblocking(0)
+            self.set_socket(address_or_socket)
+        else:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.set_reuse_addr()
+            if reuse_port:
+                self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+            self.bind(address_or_socket)
+            self.listen(BACKLOG)
+        self.fqdn = socket.getfqdn()
+        self.executor = LoopExecutor(workers)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            conn, addr = pair
+            LOGGER.debug('Incoming connection from %r', addr)
+            self.channel_class(self, conn, addr)
+
+    def authenticate(self, username, password):
+        """Called on the executor."""
+        return CAMERAS.authenticate(unicode(username),
+                                    unicode(password)) is not None
+
+    def open_message(self, channel):
+        """Returns the parser that message data is fed into."""
+        return SMTPMessage(channel)
+
+    def process_message(self, username, peer, mailfrom, rcpttos, message):
+        """Called on the executor once the message has been received and
+        the image saved."""
+        if isinstance(message.error, QuotaExceeded):
+            return QUOTA_EXCEEDED
+        if message.error is not None:
+            return '451 Error: local error in processing'
+        if message.image is None:
+            return
+        image_received(message.image)
+
+    def start(self):
+        try:
+            asyncore.loop(timeout=30.0, use_poll=True)
+        except KeyboardInterrupt:
+            return
+
+    def stop(self):
+        self.close()
+        self.executor.shutdown()
@@ -0,0 +1,140 @@
+import time
+import logging
+import threading
+import collections
+
+from django.conf import settings
+from django.db import transaction
+
+from main.models import Image
+from main.models import Event
+from main.models import Usage
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Models are inserted in this order, so rows only reference rows that were
+# inserted before them.
+MODELS = (Image, Event)
+
+
+class WriteBehind(threading.Thread):
+    """Collects rows created by the ingest servers and inserts them with
+    bulk_create() from a background thread, once `size` rows are waiting or
+    the oldest has waited `interval` seconds.
+
+    Rows are inserted in the order they were added (per model), so events for
+    a camera keep their order. A callback can be attached to a group of rows,
+    it is called once they are committed, and not at all if any of them could
+    not be inserted."""
+    def __init__(self, size, interval):
+        super(WriteBehind, self).__init__(name='write-behind')
+        self.daemon = True
+        self.size = size
+        self.interval = interval
+        self.cond = threading.Condition()
+        # Serializes flushes, so batches are committed in order.
+        self.flush_lock = threading.Lock()
+        self.rows = []
+        self.callbacks = []
+        self.oldest = None
+        self.running = False
+        self.stopped = False
+
+    def add(self, *rows, **kwargs):
+        """Queues model instances for insertion. `callback` is called with
+        `args` once they are committed."""
+        callback = kwargs.get('callback')
+        with self.cond:
+            if not self.running and not self.stopped:
+                self.running = True
+                self.start()
+            if not self.rows:
+                self.oldest = time.time()
+            self.rows.extend(rows)
+            if callback is not None:
+                self.callbacks.append((rows, callback,
+                                       kwargs.get('args', ())))
+            if len(self.rows) >= self.size:
+                self.cond.notify()
+        if self.stopped:
+            # Shutting down, write synchronously.
+            self.flush()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.running:
+                    if len(self.rows) >= self.size:
+                        break
+                    if self.rows:
+                        remaining = self.oldest + self.interval - time.time()
+                        if remaining <= 0:
+                            break
+                        self.cond.wait(remaining)
+                    else:
+                        self.cond.wait()
+                if not self.running:
+                    return
+            self.flush()
+
+    def flush(self):
+        """Writes out all queued rows."""
+        with self.flush_lock:
+            with self.cond:
+                rows, self.rows = self.rows, []
+                callbacks, self.callbacks = self.callbacks, []
+            if not rows:
+                return
+            batches = collections.OrderedDict((m, []) for m in MODELS)
+            for row in rows:
+                batches[type(row)].append(row)
+            failed = set()
+            try:
+                with transaction.commit_on_success():
+                    for model, batch in batches.items():
+                        if batch:
+                            model.objects.bulk_create(batch)
+                    Usage.objects.record(batches[Image])
+            except Exception:
+                LOGGER.exception('Bulk insert of %s rows failed, inserting '
+                                 'individually', len(rows))
+                failed = self.insert(batches)
+            for group, callback, args in callbacks:
+                if any(row in failed for row in group):
+                    continue
+                try:
+                    callback(*args)
+                except Exception:
+                    LOGGER.exception('Error in write-behind callback')
+
+    def insert(self, batches):
+        """Inserts rows one at a time, skipping the events of images that
+        could not be inserted. Returns the rows that were not inserted."""
+        failed = set()
+        for model, batch in batches.items():
+            for row in batch:
+                if isinstance(row, Event) and row.image_id is not None and \
+                        Image(id=row.image_id) in failed:
+                    failed.add(row)
+                    continue
+                try:
+                    row.save(force_insert=True)
+                except Exception:
+                    LOGGER.exception('Could not insert %r', row)
+                    failed.add(row)
+        return failed
+
+    def stop(self):
+        """Stops the background thread and writes out anything queued."""
+        with self.cond:
+            running, self.running = self.running, False
+            self.stopped = True
+            self.cond.notify()
+        if running:
+            self.join()
+        self.flush()
+
+
+WRITER = WriteBehind(getattr(settings, 'INGEST_BATCH_SIZE', 100),
+                     getattr(settings, 'INGEST_BATCH_INTERVAL', 1.0))
@@ -0,0 +1,76 @@
+import sys
+import time
+import logging
+
+from optparse import make_option
+
+from django.conf import settings
+from django.db import close_connection
+from django.core.management.base import BaseCommand
+
+
+class LoopCommand(BaseCommand):
+    """A command that runs once, as it would from cron, or every `--interval`
+    seconds with `--loop`. Subclasses implement run(), and may override
+    setup() and shutdown().
+
+    A failed run is logged and the next one goes ahead. The database
+    connection is closed after each run, so that the next run reconnects
+    after a server restart or an idle timeout."""
+    # The setting holding the default interval, and its default.
+    interval_setting = None
+    interval = 60
+    # Logged with the traceback of a failed run.
+    failure = 'Run failed'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--loop',
+                    action='store_true',
+                    default=False,
+                    help='Keep running, instead of being started by cron'),
+        make_option('--interval',
+                    type='int',
+                    default=None,
+                    help='Seconds between the start of each run with --loop'),
+    )
+
+    def setup(self):
+        pass
+
+    def run(self):
+        raise NotImplementedError()
+
+    def shutdown(self):
+        pass
+
+    def get_interval(self):
+        if self.interval_setting is None:
+            return self.interval
+        return getattr(settings, self.interval_setting, self.interval)
+
+    def handle(self, *args, **options):
+        # Configure the root logger, so that we can see ALL logging output
+        logging.basicConfig(level=logging.INFO,
+                            format='%(asctime)s %(name)-12s: %(levelname)-8s %(message)s',
+                            handlers=[logging.StreamHandler()])
+
+        # Logged as the command.
+        logger = logging.getLogger(self.__module__)
+        interval = options['interval'] or self.get_interval()
+        self.setup()
+        try:
+            while True:
+                started = time.time()
+                try:
+                    self.run()
+                except Exception:
+                    logger.exception(self.failure)
+                close_connection()
+                if not options['loop']:
+                    break
+                time.sleep(max(0, started + interval - time.time()))
+        except KeyboardInterrupt:
+            logger.info('Interrupted, exiting')
+            sys.exit(0)
+        finally:
+            self.shutdown()
@@ -0,0 +1,251 @@
+import os
+import time
+import socket
+import smtplib
+import asyncore
+import threading
+
+from email.mime.image import MIMEImage
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+
+from optparse import make_option
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer
+from BaseHTTPServer import BaseHTTPRequestHandler
+
+from django.utils import timezone
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from main.models import Camera
+from main.models import Image
+
+from services.async import JSONDataEncoder
+from services.async import PickleDataEncoder
+from services.health import HealthChecker
+from services.capture import Capturer
+from services.ingest.smtp import SMTPServer
+from services.management.commands.smtp import SMTPServer as LegacySMTPServer
+
+
+def make_message(size):
+    """Builds a message resembling what a camera sends on motion."""
+    message = MIMEMultipart()
+    message['Subject'] = 'Motion detected'
+    message.attach(MIMEText('Motion was detected.'))
+    message.attach(MIMEImage(os.urandom(size), 'jpeg'))
+    return message.as_string()
+
+
+class HealthHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class SnapshotHandler(HealthHandler):
+    """Answers every request with a small JPEG, like a camera's snapshot
+    URL."""
+    snapshot = '\xff\xd8' + '\0' * 4096 + '\xff\xd9'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(self.snapshot)))
+        self.end_headers()
+        self.wfile.write(self.snapshot)
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class Command(BaseCommand):
+    args = '<smtp|encoder|health|capture ...>'
+    help = 'Runs performance benchmarks against the configured database.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--messages',
+                    type='int',
+                    default=1000,
+                    help='Number of messages to send'),
+        make_option('--clients',
+                    type='int',
+                    default=10,
+                    help='Number of concurrent connections'),
+        make_option('--size',
+                    type='int',
+                    default=256,
+                    help='Size of each image in KB'),
+        make_option('--camera',
+                    type='int',
+                    help='Camera to send images as (default is the first)'),
+        make_option('--iterations',
+                    type='int',
+                    default=10000,
+                    help='Number of payloads to encode and decode'),
+        make_option('--images',
+                    type='int',
+                    default=10,
+                    help='Number of images in each motion payload'),
+        make_option('--cameras',
+                    type='int',
+                    default=5000,
+                    help='Number of cameras to health check or capture'),
+    )
+
+    def handle(self, *args, **kwargs):
+        for name in args or ('smtp', ):
+            benchmark = getattr(self, 'benchmark_%s' % name, None)
+            if benchmark is None:
+                raise CommandError('Unknown benchmark %s' % name)
+            benchmark(**kwargs)
+
+    def benchmark_smtp(self, **kwargs):
+        """Compares messages per second for the smtpd based server and the
+        executor based server."""
+        camera = self.get_camera(**kwargs)
+        message = make_message(kwargs['size'] * 1024)
+        clients, count = kwargs['clients'], kwargs['messages']
+        engines = (
+            ('smtpd', LegacySMTPServer),
+            ('executor', SMTPServer),
+        )
+        for name, server_class in engines:
+            started = timezone.now()
+            server = server_class(('127.0.0.1', 0))
+            loop = threading.Thread(target=asyncore.loop,
+                                    kwargs={'timeout': 0.1, 'use_poll': True})
+            loop.start()
+            port = server.socket.getsockname()[1]
+            errors = []
+            threads = [threading.Thread(target=self.send_messages,
+                                        args=(port, camera, message,
+                                              count / clients, errors))
+                       for i in range(clients)]
+            timestamp = time.time()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.time() - timestamp
+            server.stop()
+            loop.join()
+            sent = count / clients * clients
+            self.stdout.write('%-10s %d messages in %.2fs, %.1f msg/s, %d errors\n' % (
+                              name, sent, elapsed, sent / elapsed, len(errors)))
+            self.cleanup(camera, started)
+
+    def benchmark_encoder(self, **kwargs):
+        """Compares payload size and encode / decode rate of motion task
+        arguments for the pickle and JSON encoders."""
+        camera = self.get_camera(**kwargs)
+        images = [Image(camera=camera, mime='image/jpeg')
+                  for i in range(kwargs['images'])]
+        data = {'args': (camera, images), 'kwargs': {}}
+        count = kwargs['iterations']
+        for name, encoder in (('pickle', PickleDataEncoder),
+                              ('json', JSONDataEncoder)):
+            encoded = encoder.encode(data)
+            timestamp = time.time()
+            for i in range(count):
+                encoder.encode(data)
+            encoding = time.time() - timestamp
+            timestamp = time.time()
+            for i in range(count):
+                encoder.decode(encoded)
+            decoding = time.time() - timestamp
+            self.stdout.write('%-10s %6d bytes, %.0f encodes/s, %.0f decodes/s\n' % (
+                              name, len(encoded), count / encoding,
+                              count / decoding))
+
+    def benchmark_health(self, **kwargs):
+        """Times a health check sweep of cameras spread over 250 local
+        addresses, one in ten of them refusing connections. The database is
+        not touched."""
+        server = ThreadedHTTPServer(('', 0), HealthHandler)
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        port = server.server_address[1]
+        cameras = []
+        for i in range(kwargs['cameras']):
+            url = 'http://127.0.0.%s:%s/' % (i % 250 + 1,
+                                             1 if i % 10 == 0 else port)
+            cameras.append(Camera(id=i, url=url, make='', model=''))
+        checker = HealthChecker(spread=0, jitter=0)
+        timestamp = time.time()
+        results = checker.check(cameras)
+        elapsed = time.time() - timestamp
+        checker.shutdown()
+        server.shutdown()
+        self.stdout.write('%d cameras in %.2fs, %.0f checks/s, %d unreachable\n' % (
+                          len(results), elapsed, len(results) / elapsed,
+                          len([r for c, r in results if not r])))
+
+    def benchmark_capture(self, **kwargs):
+        """Compares capturing a still from cameras spread over 250 local
+        addresses one at a time, and with a Capturer."""
+        server = ThreadedHTTPServer(('', 0), SnapshotHandler)
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        port = server.server_address[1]
+        camera = self.get_camera(**kwargs)
+        cameras = []
+        for i in range(kwargs['cameras']):
+            cameras.append(Camera(id=camera.id, zone_id=camera.zone_id,
+                                  url='http://127.0.0.%s:%s/' % (i % 250 + 1, port),
+                                  make='Foscam', model='FI9805W'))
+        engines = (
+            ('serial', Capturer(workers=1, per_host=1)),
+            ('pooled', Capturer()),
+        )
+        for name, capturer in engines:
+            started = timezone.now()
+            timestamp = time.time()
+            images, failed = capturer.capture(cameras)
+            elapsed = time.time() - timestamp
+            capturer.shutdown()
+            self.stdout.write('%-10s %d stills in %.2fs, %.0f stills/s, %d failed\n' % (
+                              name, len(images), elapsed, len(images) / elapsed,
+                              len(failed)))
+            self.cleanup(camera, started)
+        server.shutdown()
+
+    def get_camera(self, **kwargs):
+        if kwargs.get('camera'):
+            return Camera.objects.get(pk=kwargs['camera'])
+        return Camera.objects.all()[0]
+
+    def send_messages(self, port, camera, message, count, errors):
+        client = None
+        for i in range(count):
+            try:
+                if client is None:
+                    client = smtplib.SMTP('127.0.0.1', port)
+                    client.login(camera.auth, camera.key)
+                client.sendmail('benchmark@example.org',
+                                ['benchmark@example.org'], message)
+            except (smtplib.SMTPException, socket.error), e:
+                errors.append(e)
+                client = None
+        if client is not None:
+            client.quit()
+
+    def cleanup(self, camera, started):
+        images = Image.objects.filter(camera=camera, created__gte=started)
+        for image in images:
+            try:
+                image.delete_file()
+            except OSError:
+                pass
+        images.delete()
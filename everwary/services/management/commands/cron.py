@@ -1,8 +1,19 @@
-from django.core.management.base import BaseCommand
+from services.health import HealthChecker
+from services.management.base import LoopCommand
 
 
-class Command(BaseCommand):
+class Command(LoopCommand):
     help = 'Runs EverWary scheduled operations.'
 
-    def handle(self, *args, **kwargs):
-        pass
+    interval_setting = 'HEALTH_INTERVAL'
+    interval = 60
+    failure = 'Health check sweep failed'
+
+    def setup(self):
+        self.checker = HealthChecker()
+
+    def run(self):
+        self.checker.sweep()
+
+    def shutdown(self):
+        self.checker.shutdown()
@@ -1,5 +1,6 @@
 import os
 import socket
+import logging
 import mimetypes
 
 from optparse import make_option
@@ -13,13 +14,16 @@ from pyftpdlib.servers import FTPServer
 from pyftpdlib.filesystems import AbstractedFS
 from pyftpdlib.authorizers import AuthenticationFailed
 
-from main.models import Camera
 from main.models import Image
-from main.models import Event
 
-from services.async import GEARMAN
+from services import ingest
+from services.ingest import image_received
+from services.ingest.auth import CAMERAS
+from services.usage import QUOTAS
 
 
+LOGGER = logging.getLogger(__name__)
+
 # Allow:
 #  * Directory creation (m)
 #  * Directory navigation (e)
@@ -31,7 +35,7 @@ class FTPAuth(object):
     """Simple class to perform authentication and authorization for FTP
     clients."""
     def has_user(self, username):
-        return Camera.objects.filter(id=username).exists()
+        return CAMERAS.get(username) is not None
 
     def has_perm(self, username, perm, path=None):
         return perm in FTP_PERMISSIONS
@@ -40,7 +44,7 @@ class FTPAuth(object):
         return FTP_PERMISSIONS
 
     def validate_authentication(self, username, password, handler):
-        if Camera.objects.authenticate(username, password):
+        if CAMERAS.authenticate(username, password):
             return True
         raise AuthenticationFailed()
 
@@ -69,24 +73,35 @@ class FTPImageStorageFS(AbstractedFS):
 
     def open(self, filename, mode):
         mime, enc = mimetypes.guess_type(filename)
-        c = Camera.objects.get(auth=self.cmd_channel.username)
-        i = Image.objects.create(camera=c, mime=mime)
-        return i.open(mode)
+        c = CAMERAS.get(self.cmd_channel.username)
+        QUOTAS.check(c)
+        # The row is inserted by image_received() once the upload completes.
+        i = Image(camera=c, mime=mime)
+        f = i.open(mode)
+        self.cmd_channel.uploads[f.name] = i
+        return f
 
 
 class FTPHandler(BaseFTPHandler):
     """pyftpdlib.handlers.FTPHandler subclass that fires off motion events
     when an image is uploaded."""
+    def __init__(self, *args, **kwargs):
+        BaseFTPHandler.__init__(self, *args, **kwargs)
+        # Images being uploaded, by path.
+        self.uploads = {}
+
     def on_file_received(self, filename):
-        fn = os.path.basename(filename)
-        fn = os.path.splitext(fn)[0]
-        try:
-            image = Image.objects.get(id=fn)
-        except Image.DoesNotExist:
-            return
-        m = image.camera.events.create(event=Event.CAMERA_EVENT_MOTION, image=image)
-        GEARMAN.submit_job('motion', data={'args': (m, ), 'kwargs':
-                           {}}, background=True, wait_until_complete=False)
+        image = self.uploads.pop(filename, None)
+        if image is not None:
+            image_received(image)
+
+    def on_incomplete_file_received(self, filename):
+        image = self.uploads.pop(filename, None)
+        if image is not None:
+            try:
+                image.delete_file()
+            except OSError:
+                pass
 
 
 class Command(BaseCommand):
@@ -118,4 +133,8 @@ class Command(BaseCommand):
             raise CommandError('Must specify addr/port or fd for listening')
 
         server = FTPServer(sock, handler)
-        server.serve_forever()
+        try:
+            server.serve_forever()
+        finally:
+            ingest.stop()
+            LOGGER.info('Camera cache: %s', CAMERAS.stats())
@@ -0,0 +1,49 @@
+import sys
+import signal
+import logging
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from services.metrics import StatsServer
+from services.recorder import Recorder
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def terminate(signum, frame):
+    # Stop recordings cleanly when circus stops us.
+    raise KeyboardInterrupt()
+
+
+class Command(BaseCommand):
+    help = 'Records video for cameras on behalf of the motion task.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--stats-port',
+                    type='int',
+                    default=getattr(settings, 'RECORDER_STATS_PORT', None),
+                    help='Serve recordings and pre-roll memory use as JSON on this local port'),
+    )
+
+    def handle(self, *args, **options):
+        # Configure the root logger, so that we can see ALL logging output
+        logging.basicConfig(level=logging.DEBUG,
+                            format='%(asctime)s %(name)-12s: %(levelname)-8s %(message)s',
+                            handlers=[logging.StreamHandler()])
+
+        signal.signal(signal.SIGTERM, terminate)
+        recorder = Recorder()
+        if options['stats_port'] is not None:
+            stats = StatsServer(('127.0.0.1', options['stats_port']), recorder)
+            stats.start()
+            LOGGER.info('Serving stats on port %s', stats.server_port)
+        LOGGER.info('Listening on %s', recorder.address)
+        try:
+            recorder.serve_forever()
+        except KeyboardInterrupt:
+            LOGGER.info('Interrupted, exiting')
+            sys.exit(0)
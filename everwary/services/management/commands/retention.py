@@ -0,0 +1,16 @@
+from services.retention import Expirer
+from services.management.base import LoopCommand
+
+
+class Command(LoopCommand):
+    help = 'Deletes EverWary images, videos and events past their retention.'
+
+    interval_setting = 'RETENTION_INTERVAL'
+    interval = 3600
+    failure = 'Retention run failed'
+
+    def setup(self):
+        self.expirer = Expirer()
+
+    def run(self):
+        self.expirer.expire()
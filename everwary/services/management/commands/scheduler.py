@@ -0,0 +1,31 @@
+import sys
+import signal
+import logging
+
+from django.core.management.base import BaseCommand
+
+from services.scheduler import Scheduler
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def terminate(signum, frame):
+    raise KeyboardInterrupt()
+
+
+class Command(BaseCommand):
+    help = 'Runs periodic actions (see main.models.Period) on time.'
+
+    def handle(self, *args, **options):
+        # Configure the root logger, so that we can see ALL logging output
+        logging.basicConfig(level=logging.INFO,
+                            format='%(asctime)s %(name)-12s: %(levelname)-8s %(message)s',
+                            handlers=[logging.StreamHandler()])
+
+        signal.signal(signal.SIGTERM, terminate)
+        try:
+            Scheduler().serve_forever()
+        except KeyboardInterrupt:
+            LOGGER.info('Interrupted, exiting')
+            sys.exit(0)
@@ -1,12 +1,10 @@
+import os
 import base64
 import socket
 import logging
 import asyncore
 
-from email.parser import Parser
-
 import smtpd
-from smtpd import NEWLINE
 from smtpd import EMPTYSTRING
 from smtpd import SMTPChannel as BaseSMTPChannel
 from smtpd import SMTPServer as BaseSMTPServer
@@ -16,15 +14,24 @@ from optparse import make_option
 from django.core.management.base import BaseCommand
 from django.core.management.base import CommandError
 
-from main.models import Camera
 from main.models import Image
-from main.models import Event
-from services.async import GEARMAN
+from services import ingest
+from services.ingest import image_received
+from services.ingest.auth import CAMERAS
+from services.ingest.mime import ImageExtractor
+from services.ingest.smtp import SMTPServer as IngestSMTPServer
+from services.ingest.smtp import DEFAULT_WORKERS
+from services.ingest.smtp import QUOTA_EXCEEDED
+from services.usage import QUOTAS
+from services.usage import QuotaExceeded
 
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(logging.StreamHandler())
 
+# Longest line accepted, RFC 5321 only requires 1000 octets.
+MAX_LINE_LENGTH = 4096
+
 
 class SMTPLogger(object):
     """Simple class that logs via logging module."""
@@ -39,25 +46,73 @@ smtpd.DEBUGSTREAM = SMTPLogger()
 class SMTPAuth(object):
     """Simple class that performs authentication of a camera."""
     def validate(self, username, password):
-        if Camera.objects.authenticate(unicode(username), unicode(password)):
+        if CAMERAS.authenticate(unicode(username), unicode(password)):
             return True
 
 
+class SMTPMessage(ImageExtractor):
+    """Saves the first image of a message sent by a camera while the
+    message is being received."""
+    def __init__(self, username):
+        super(SMTPMessage, self).__init__()
+        self.username = username
+        self.image = None
+        self.over_quota = False
+
+    def open_image(self, mime):
+        camera = CAMERAS.get(self.username)
+        try:
+            QUOTAS.check(camera)
+        except QuotaExceeded, e:
+            LOGGER.warning('Refused image from %s: %s', self.username, e)
+            # The rest of the message is read and discarded.
+            self.over_quota = True
+            return open(os.devnull, 'wb')
+        # The row is inserted by image_received() once the data is saved.
+        self.image = Image(camera=camera, mime=mime)
+        return self.image.open('wb')
+
+    def abort(self):
+        super(SMTPMessage, self).abort()
+        if self.image is not None:
+            try:
+                self.image.delete_file()
+            except OSError:
+                pass
+            self.image = None
+
+
 class SMTPChannel(BaseSMTPChannel):
-    """smtpd.SMTPChannel subclass that supports AUTH."""
+    """smtpd.SMTPChannel subclass that supports AUTH, and parses message
+    data as it arrives instead of buffering it."""
     def __init__(self, *args, **kwargs):
         self.username = None
         self.password = None
         self.authenticator = kwargs.pop('authenticator', None)
         self.authenticated = False
         self.authenticating = False
+        self.__message = None
+        self.__length = 0
+        self.__toolong = False
         BaseSMTPChannel.__init__(self, *args, **kwargs)
 
+    def collect_incoming_data(self, data):
+        # Discard anything past the line length limit, so a peer can not
+        # make us buffer an unbounded amount of data.
+        self.__length += len(data)
+        if self.__length <= MAX_LINE_LENGTH:
+            self.__line.append(data)
+
     def found_terminator(self):
         line = EMPTYSTRING.join(self.__line)
-        print >> smtpd.DEBUGSTREAM, 'Data:', repr(line)
+        toolong = self.__length > MAX_LINE_LENGTH
         self.__line = []
+        self.__length = 0
         if self.__state == self.COMMAND:
+            print >> smtpd.DEBUGSTREAM, 'Data:', repr(line)
+            if toolong:
+                self.push('500 Error: line too long')
+                return
             if not line:
                 self.push('500 Error: bad syntax')
                 return
@@ -90,29 +145,52 @@ class SMTPChannel(BaseSMTPChannel):
             if self.__state != self.DATA:
                 self.push('451 Internal confusion')
                 return
-            # Remove extraneous carriage returns and de-transparency according
-            # to RFC 821, Section 4.5.2.
-            data = []
-            for text in line.split('\r\n'):
-                if text and text[0] == '.':
-                    data.append(text[1:])
-                else:
-                    data.append(text)
-            self.__data = NEWLINE.join(data)
-            status = self.__server.process_message(self.username,
-                                                   self.__peer,
-                                                   self.__mailfrom,
-                                                   self.__rcpttos,
-                                                   self.__data)
+            if line != '.':
+                if toolong:
+                    self.__toolong = True
+                    self.__message.abort()
+                # De-transparency according to RFC 821, Section 4.5.2.
+                if line[:1] == '.':
+                    line = line[1:]
+                self.__message.feed(line)
+                return
+            if self.__toolong:
+                status = '552 Error: line too long'
+            else:
+                status = self.__server.process_message(self.username,
+                                                       self.__peer,
+                                                       self.__mailfrom,
+                                                       self.__rcpttos,
+                                                       self.__message)
+            self.__message = None
+            self.__toolong = False
             self.__rcpttos = []
             self.__mailfrom = None
             self.__state = self.COMMAND
-            self.set_terminator('\r\n')
             if not status:
                 self.push('250 Ok')
             else:
                 self.push(status)
 
+    def smtp_DATA(self, arg):
+        if not self.__rcpttos:
+            self.push('503 Error: need RCPT command')
+            return
+        if arg:
+            self.push('501 Syntax: DATA')
+            return
+        self.__state = self.DATA
+        self.__message = self.__server.open_message(self.username)
+        # The terminator stays at CRLF, the message is fed to the parser
+        # a line at a time until the lone '.' is received.
+        self.push('354 End data with <CR><LF>.<CR><LF>')
+
+    def handle_close(self):
+        if self.__message is not None:
+            self.__message.abort()
+            self.__message = None
+        BaseSMTPChannel.handle_close(self)
+
     def smtp_EHLO(self, arg):
         if not arg:
             self.push('501 Syntax: HELO hostname')
@@ -153,7 +231,10 @@ class SMTPChannel(BaseSMTPChannel):
 
 class SMTPServer(BaseSMTPServer):
     """smtpd.SMTPServer subclass that supports AUTH and processes images
-    from message bodies."""
+    from message bodies.
+
+    This is the original server, it makes blocking calls from within the
+    asyncore loop. The default is services.ingest.smtp.SMTPServer."""
     def __init__(self, address_or_socket, authenticator=SMTPAuth()):
         if callable(getattr(address_or_socket, 'listen', None)):
             asyncore.dispatcher.__init__(self)
@@ -162,7 +243,6 @@ class SMTPServer(BaseSMTPServer):
         else:
             BaseSMTPServer.__init__(self, address_or_socket, None)
         self.authenticator = authenticator
-        self.parser = Parser()
 
     def handle_accept(self):
         pair = self.accept()
@@ -171,24 +251,18 @@ class SMTPServer(BaseSMTPServer):
             print >> smtpd.DEBUGSTREAM, 'Incoming connection from %s' % repr(addr)
             SMTPChannel(self, conn, addr, authenticator=self.authenticator)
 
-    def process_message(self, username, peer, mailfrom, rcpttos, data):
-        """Parses the message body, then saves the first encountered image.
-        Other images are ignored."""
-        m = self.parser.parsestr(data)
-        for p in m.walk():
-            if p.get_content_maintype() == 'multipart':
-                continue
-            mime = p.get_content_type()
-            if not mime.startswith('image/'):
-                continue
-            camera = Camera.objects.get(auth=username)
-            image = Image.objects.create(camera=camera, mime=mime)
-            image.write(p.get_payload(decode=True))
-            m = camera.events.create(event=Event.CAMERA_EVENT_MOTION,
-                                     image=image)
-            GEARMAN.submit_job('motion', data={'args': (m, ), 'kwargs':
-                               {}}, background=True, wait_until_complete=False)
-            break
+    def open_message(self, username):
+        """Returns the parser that message data is fed into."""
+        return SMTPMessage(username)
+
+    def process_message(self, username, peer, mailfrom, rcpttos, message):
+        """Called once the message is received. The first encountered image
+        has already been saved by the parser, other images are ignored."""
+        if not message.close():
+            return
+        if message.over_quota:
+            return QUOTA_EXCEEDED
+        image_received(message.image)
 
     def start(self):
         try:
@@ -213,6 +287,18 @@ class Command(BaseCommand):
         make_option('--fd',
                     type='int',
                     help='File descriptor of open listening socket'),
+        make_option('--reuse-port',
+                    action='store_true',
+                    default=False,
+                    help='Bind with SO_REUSEPORT so several processes can share addr/port'),
+        make_option('--workers',
+                    type='int',
+                    default=DEFAULT_WORKERS,
+                    help='Threads performing database and disk work'),
+        make_option('--legacy',
+                    action='store_true',
+                    default=False,
+                    help='Use the smtpd based server'),
     )
 
     def handle(self, *args, **kwargs):
@@ -223,5 +309,13 @@ class Command(BaseCommand):
         else:
             raise CommandError('Must specify addr/port or fd for listening')
 
-        server = SMTPServer(sock)
-        server.start()
+        if kwargs.get('legacy'):
+            server = SMTPServer(sock)
+        else:
+            server = IngestSMTPServer(sock, workers=kwargs['workers'],
+                                      reuse_port=kwargs['reuse_port'])
+        try:
+            server.start()
+        finally:
+            ingest.stop()
+            LOGGER.info('Camera cache: %s', CAMERAS.stats())
@@ -0,0 +1,34 @@
+import logging
+
+from main.storage import get_object_store
+
+from services.upload import Uploader
+from services.management.base import LoopCommand
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Command(LoopCommand):
+    help = 'Uploads finished EverWary recordings and stills to the object store.'
+
+    interval_setting = 'UPLOAD_INTERVAL'
+    interval = 10
+    failure = 'Upload run failed'
+
+    def setup(self):
+        self.uploader = None
+        if get_object_store() is None:
+            # Idle rather than exit, so the watcher can stay enabled.
+            LOGGER.info('Uploads are disabled, set UPLOAD_STORE to enable '
+                        'them')
+        else:
+            self.uploader = Uploader()
+
+    def run(self):
+        if self.uploader is not None:
+            self.uploader.sync()
+
+    def shutdown(self):
+        if self.uploader is not None:
+            self.uploader.shutdown()
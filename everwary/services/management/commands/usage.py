@@ -0,0 +1,24 @@
+import logging
+
+from services.usage import backfill
+from services.usage import reconcile
+from services.management.base import LoopCommand
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Command(LoopCommand):
+    help = 'Recounts the files stored for EverWary cameras and users.'
+
+    interval_setting = 'USAGE_RECONCILE_INTERVAL'
+    interval = 86400
+    failure = 'Usage reconciliation failed'
+
+    def setup(self):
+        # Kept between runs, see backfill().
+        self.cursors = {}
+
+    def run(self):
+        LOGGER.info('Measured %s files, corrected %s usage rows',
+                    backfill(self.cursors), reconcile())
@@ -1,33 +1,188 @@
 import os
 import sys
 import time
+import Queue
+import signal
 import socket
 import logging
+import tempfile
+import threading
+import collections
+
+from optparse import make_option
+
+from concurrent.futures import ThreadPoolExecutor
 
 from gearman.worker import GearmanWorker as BaseGearmanWorker
+from gearman.worker_handler import GearmanWorkerCommandHandler as \
+    BaseGearmanWorkerCommandHandler
 from gearman.errors import ServerUnavailable
+from gearman.protocol import GEARMAN_COMMAND_CAN_DO
+from gearman.protocol import GEARMAN_COMMAND_CANT_DO
 
 from django.conf import settings
+from django.db import close_connection
 from django.core.management.base import BaseCommand
 
-from services.async import PickleDataEncoder
+from services.async import JSONDataEncoder
 from services.async import tasks
+from services.metrics import Metrics
+from services.metrics import Profiler
+from services.metrics import StatsServer
 
 
 LOGGER = logging.getLogger(__name__)
 HOSTNAME = socket.gethostname()
+# How often, in seconds, completed jobs are checked for while jobs run.
+COMPLETION_POLL = 0.05
+# How often, in seconds, metrics are written to --stats-file.
+STATS_INTERVAL = 10
+
+
+class GearmanWorkerCommandHandler(BaseGearmanWorkerCommandHandler):
+    def decode_data(self, data):
+        # Size of the job being assigned, see GearmanWorker.create_job()
+        self.payload_size = len(data)
+        return super(GearmanWorkerCommandHandler, self).decode_data(data)
+
+    def recv_noop(self):
+        if self.connection_manager.is_full():
+            # Grab a job once one of ours completes.
+            self.connection_manager.waiting.add(self)
+            return True
+        return super(GearmanWorkerCommandHandler, self).recv_noop()
 
 
 class GearmanWorker(BaseGearmanWorker):
-    data_encoder = PickleDataEncoder
+    """Runs up to `workers` jobs at a time on a thread pool.
 
-    def __init__(self, *args, **kwargs):
-        super(GearmanWorker, self).__init__(*args, **kwargs)
+    Jobs are handed to the pool as they are assigned, and no more are grabbed
+    while the pool is busy. Results are sent from the polling thread, as the
+    Gearman connections are not thread safe. A task registered with a `limit`
+    runs at most that many jobs at once: once it reaches the limit the worker
+    tells gearmand it can no longer do it, so other tasks are not stuck
+    behind it. Each job runs with its own database connection, closed when
+    the job is done.
+
+    Queue latency, run time and payload size of each job are recorded in
+    `metrics`, and a sample of jobs is profiled if `profiler` is given."""
+    command_handler_class = GearmanWorkerCommandHandler
+    data_encoder = JSONDataEncoder
+
+    def __init__(self, host_list=None, workers=1, profiler=None):
+        super(GearmanWorker, self).__init__(host_list)
         self.quit = False
+        self.metrics = Metrics()
+        self.profiler = profiler
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(workers)
+        self.completed = Queue.Queue()
+        self.limits = {}
+        self.running = collections.defaultdict(int)
+        # Jobs assigned while their task was at its limit.
+        self.held = collections.defaultdict(collections.deque)
+        self.active = 0
+        # Handlers told there is work while we were full.
+        self.waiting = set()
+
+    def register_task(self, task, callback_function, limit=None):
+        if limit is not None:
+            self.limits[task] = limit
+        return super(GearmanWorker, self).register_task(task, callback_function)
+
+    def is_full(self):
+        return self.quit or self.active >= self.workers
+
+    def set_ability(self, task, can_do):
+        command = GEARMAN_COMMAND_CAN_DO if can_do else GEARMAN_COMMAND_CANT_DO
+        for handler in self.handler_to_connection_map.keys():
+            handler.send_command(command, task=task)
+
+    def create_job(self, command_handler, job_handle, task, unique, data):
+        job = super(GearmanWorker, self).create_job(command_handler,
+                                                    job_handle, task, unique,
+                                                    data)
+        job.size = getattr(command_handler, 'payload_size', None)
+        return job
 
     def on_job_execute(self, job):
+        if self.running[job.task] >= self.limits.get(job.task, self.workers):
+            # Assigned before gearmand learned we were at the limit.
+            self.held[job.task].append(job)
+        else:
+            self.start_job(job)
+        return True
+
+    def start_job(self, job):
         LOGGER.info('Execution of %r starting', job.task)
-        return super(GearmanWorker, self).on_job_execute(job)
+        self.active += 1
+        self.running[job.task] += 1
+        if self.running[job.task] == self.limits.get(job.task):
+            self.set_ability(job.task, False)
+        latency = None
+        if isinstance(job.data, dict) and 'submitted' in job.data:
+            latency = time.time() - job.data['submitted']
+        self.metrics.job_started(job.task, latency=latency,
+                                 size=getattr(job, 'size', None))
+        self.pool.submit(self.execute, job)
+
+    def execute(self, job):
+        # Runs on the pool.
+        started, failed = time.time(), False
+        try:
+            f = self.worker_abilities[job.task]
+            if self.profiler is not None:
+                result = self.profiler.run(job.task, f, self, job)
+            else:
+                result = f(self, job)
+        except Exception:
+            failed = True
+            self.completed.put((job, None, sys.exc_info()))
+        else:
+            self.completed.put((job, result, None))
+        finally:
+            self.metrics.job_finished(job.task, time.time() - started,
+                                      failed=failed)
+            close_connection()
+
+    def job_done(self, job):
+        self.active -= 1
+        self.running[job.task] -= 1
+        if self.held[job.task]:
+            self.start_job(self.held[job.task].popleft())
+        elif self.running[job.task] + 1 == self.limits.get(job.task):
+            self.set_ability(job.task, True)
+
+    def poll_connections_once(self, submitted_connections, timeout=None):
+        if self.active:
+            # Report completed jobs promptly.
+            if timeout is None or timeout > COMPLETION_POLL:
+                timeout = COMPLETION_POLL
+        return super(GearmanWorker, self).poll_connections_once(
+            submitted_connections, timeout=timeout)
+
+    def after_poll(self, any_activity):
+        while True:
+            try:
+                job, result, exc_info = self.completed.get_nowait()
+            except Queue.Empty:
+                break
+            self.job_done(job)
+            if job.connection not in self.connection_to_handler_map:
+                # Lost the connection, gearmand will give the job to another
+                # worker.
+                LOGGER.warning('Dropping result of %r', job.task)
+            elif exc_info is not None:
+                self.on_job_exception(job, exc_info)
+            else:
+                self.on_job_complete(job, result)
+        if not self.is_full():
+            waiting, self.waiting = self.waiting, set()
+            for handler in waiting:
+                if handler in self.handler_to_connection_map:
+                    handler.recv_noop()
+        # Once stopped, wait for running jobs before leaving the work loop.
+        return not self.quit or self.active > 0
 
     def on_job_complete(self, job, result):
         LOGGER.info('Execution of %r complete', job.task)
@@ -40,24 +195,68 @@ class GearmanWorker(BaseGearmanWorker):
     def stop(self):
         self.quit = True
 
+    def shutdown(self):
+        super(GearmanWorker, self).shutdown()
+        self.pool.shutdown()
+
 
 class Command(BaseCommand):
     help = 'Gearman worker that exposes async tasks.'
 
+    option_list = BaseCommand.option_list + (
+        make_option('--concurrency',
+                    type='int',
+                    default=getattr(settings, 'WORKER_CONCURRENCY', 8),
+                    help='Number of jobs to run at once'),
+        make_option('--stats-port',
+                    type='int',
+                    default=getattr(settings, 'WORKER_STATS_PORT', None),
+                    help='Serve metrics as JSON on this local port (0 picks a free port)'),
+        make_option('--stats-file',
+                    default=getattr(settings, 'WORKER_STATS_FILE', None),
+                    help='Write metrics as JSON to this file, %(pid)s is replaced'),
+        make_option('--profile',
+                    action='append',
+                    default=[],
+                    help='Profile a sample of a task\'s jobs, as task:fraction'),
+        make_option('--profile-dir',
+                    default=tempfile.gettempdir(),
+                    help='Directory to write profiles to'),
+    )
+
     def handle(self, *args, **options):
         # Configure the root logger, so that we can see ALL logging output
         logging.basicConfig(level=logging.DEBUG,
                             format='%(asctime)s %(name)-12s: %(levelname)-8s %(message)s',
                             handlers=[logging.StreamHandler()])
 
-        worker = GearmanWorker(getattr(settings, 'GEARMAN_SERVERS', ['localhost']))
+        profiler = None
+        if options['profile']:
+            rates = dict((name, float(rate)) for name, rate in
+                         (p.split(':') for p in options['profile']))
+            profiler = Profiler(rates, options['profile_dir'])
+        worker = GearmanWorker(getattr(settings, 'GEARMAN_SERVERS', ['localhost']),
+                               workers=options['concurrency'], profiler=profiler)
+        if options['stats_port'] is not None:
+            stats = StatsServer(('127.0.0.1', options['stats_port']),
+                                worker.metrics)
+            stats.start()
+            LOGGER.info('Serving metrics on port %s', stats.server_port)
+        if options['stats_file']:
+            t = threading.Thread(target=worker.metrics.dump_forever,
+                                 args=(options['stats_file'] % {'pid': os.getpid()},
+                                       STATS_INTERVAL), name='stats-file')
+            t.daemon = True
+            t.start()
+        # Finish running jobs when circus stops us.
+        signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
         worker.set_client_id('%s:%s' % (HOSTNAME, os.getpid()))
         # Walk the tasks module and register any callables as tasks
         for n in dir(tasks):
             t = getattr(tasks, n)
-            if callable(t) and getattr(t, 'task', False):
-                LOGGER.debug('Registering task %s', t.__name__)
-                worker.register_task(t.__name__, t)
+            if isinstance(t, tasks.Task):
+                LOGGER.debug('Registering task %s', t.name)
+                worker.register_task(t.name, t.run, limit=t.concurrency)
         while not worker.quit:
             try:
                 worker.work()
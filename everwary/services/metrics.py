@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import random
+import pstats
+import logging
+import cProfile
+import threading
+import collections
+
+from BaseHTTPServer import HTTPServer
+from BaseHTTPServer import BaseHTTPRequestHandler
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Histogram(object):
+    """Counts values into exponential buckets, each twice the size of the
+    previous, so percentiles are approximate but memory is constant."""
+    def __init__(self, smallest=0.001, buckets=32):
+        self.bounds = [smallest * 2 ** i for i in range(buckets)]
+        self.counts = [0] * (buckets + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = self.max = None
+
+    def add(self, value):
+        i = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, p):
+        """Returns the upper bound of the bucket holding the p'th
+        percentile."""
+        if not self.count:
+            return None
+        wanted, seen = self.count * p / 100.0, 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+        }
+
+
+class TaskMetrics(object):
+    def __init__(self):
+        # Seconds between submission and start.
+        self.latency = Histogram()
+        # Seconds spent running.
+        self.run_time = Histogram()
+        # Encoded payload size in bytes.
+        self.size = Histogram(smallest=64)
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+
+    def snapshot(self):
+        finished = self.completed + self.failed
+        return {
+            'latency': self.latency.snapshot(),
+            'run_time': self.run_time.snapshot(),
+            'size': self.size.snapshot(),
+            'in_flight': self.in_flight,
+            'completed': self.completed,
+            'failed': self.failed,
+            'error_rate': float(self.failed) / finished if finished else 0.0,
+        }
+
+
+class Metrics(object):
+    """Per task metrics for the jobs run by a worker, safe to update from
+    any thread."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tasks = collections.defaultdict(TaskMetrics)
+        self.started = time.time()
+
+    def job_started(self, task, latency=None, size=None):
+        with self.lock:
+            metrics = self.tasks[task]
+            metrics.in_flight += 1
+            if latency is not None:
+                metrics.latency.add(max(latency, 0))
+            if size is not None:
+                metrics.size.add(size)
+
+    def job_finished(self, task, run_time, failed=False):
+        with self.lock:
+            metrics = self.tasks[task]
+            metrics.in_flight -= 1
+            metrics.run_time.add(run_time)
+            if failed:
+                metrics.failed += 1
+            else:
+                metrics.completed += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'uptime': time.time() - self.started,
+                'tasks': dict((name, m.snapshot()) for name, m in
+                              self.tasks.items()),
+            }
+
+    def dump(self, path):
+        """Writes a snapshot to `path` as JSON."""
+        with open(path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+    def dump_forever(self, path, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.dump(path)
+            except IOError:
+                LOGGER.exception('Could not write metrics to %s', path)
+
+
+class Profiler(object):
+    """Profiles a random sample of the runs of some tasks, `rates` maps a
+    task name to the fraction of runs to profile. The accumulated profile
+    of each task is written to `directory`/<task>.prof after each sample,
+    for use with pstats."""
+    def __init__(self, rates, directory):
+        self.rates = rates
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def run(self, task, f, *args, **kwargs):
+        if random.random() >= self.rates.get(task, 0):
+            return f(*args, **kwargs)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(f, *args, **kwargs)
+        finally:
+            with self.lock:
+                stats = self.stats.get(task)
+                if stats is None:
+                    stats = self.stats[task] = pstats.Stats(profile)
+                else:
+                    stats.add(profile)
+                stats.dump_stats(os.path.join(self.directory, '%s.prof' % task))
+
+
+class StatsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps(self.server.metrics.snapshot(), indent=2)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOGGER.debug(format, *args)
+
+
+class StatsServer(HTTPServer):
+    """Serves a JSON snapshot of `metrics` over HTTP from a background
+    thread, `metrics` can be anything with a snapshot() method."""
+    def __init__(self, address, metrics):
+        HTTPServer.__init__(self, address, StatsHandler)
+        self.metrics = metrics
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever, name='stats')
+        t.daemon = True
+        t.start()
@@ -0,0 +1,17 @@
+from django.db.models.signals import post_save
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from main.models import Camera
+
+from services.state import STATE
+
+
+@receiver(post_save, sender=Camera)
+def camera_saved(sender, instance, **kwargs):
+    STATE.set_disabled(instance.id, instance.disabled)
+
+
+@receiver(post_delete, sender=Camera)
+def camera_deleted(sender, instance, **kwargs):
+    STATE.forget(instance.id)
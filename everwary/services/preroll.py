@@ -0,0 +1,100 @@
+import collections
+
+from django.conf import settings
+
+
+# A few seconds of a camera's video, `data` is a complete segment file.
+Chunk = collections.namedtuple('Chunk', ('timestamp', 'duration', 'ext',
+                                         'data'))
+
+
+class RingBuffer(object):
+    """The last `seconds` of a camera's video as whole chunks, holding at
+    most `max_bytes`; older chunks are dropped as new ones arrive."""
+    def __init__(self, seconds, max_bytes):
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self.chunks = collections.deque()
+        self.size = 0
+        self.length = 0.0
+        # Chunks dropped because of max_bytes.
+        self.dropped = 0
+
+    def add(self, chunk):
+        self.chunks.append(chunk)
+        self.size += len(chunk.data)
+        self.length += chunk.duration
+        while self.chunks and self.length - self.chunks[0].duration >= self.seconds:
+            self.pop()
+        while self.size > self.max_bytes:
+            self.pop()
+            self.dropped += 1
+
+    def pop(self):
+        chunk = self.chunks.popleft()
+        self.size -= len(chunk.data)
+        self.length -= chunk.duration
+        return chunk
+
+    def flush(self):
+        """Removes and returns all chunks, oldest first."""
+        chunks = list(self.chunks)
+        self.chunks.clear()
+        self.size = 0
+        self.length = 0.0
+        return chunks
+
+
+class Preroll(object):
+    """The pre-roll buffers of every camera the recorder buffers, see
+    Camera.preroll. Each buffer holds at most `camera_max_bytes`, and all
+    of them at most `max_bytes`: past that the oldest chunk of the largest
+    buffer is dropped."""
+    def __init__(self, max_bytes=None, camera_max_bytes=None):
+        self.max_bytes = max_bytes or \
+            getattr(settings, 'RECORD_PREROLL_MAX_BYTES', 256 * 1024 * 1024)
+        self.camera_max_bytes = camera_max_bytes or \
+            getattr(settings, 'RECORD_PREROLL_CAMERA_MAX_BYTES', 16 * 1024 * 1024)
+        self.buffers = {}
+        self.size = 0
+        # Chunks dropped because of max_bytes.
+        self.dropped = 0
+
+    def add(self, camera_id, seconds, chunk):
+        ring = self.buffers.get(camera_id)
+        if ring is None:
+            ring = self.buffers[camera_id] = RingBuffer(seconds,
+                                                        self.camera_max_bytes)
+        ring.seconds = seconds
+        self.size -= ring.size
+        ring.add(chunk)
+        self.size += ring.size
+        while self.size > self.max_bytes:
+            largest = max(self.buffers.values(), key=lambda b: b.size)
+            self.size -= len(largest.pop().data)
+            self.dropped += 1
+
+    def flush(self, camera_id):
+        """Removes and returns the chunks buffered for a camera."""
+        ring = self.buffers.get(camera_id)
+        if ring is None:
+            return []
+        self.size -= ring.size
+        return ring.flush()
+
+    def discard(self, camera_id):
+        self.flush(camera_id)
+        self.buffers.pop(camera_id, None)
+
+    def snapshot(self):
+        return {
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'dropped': self.dropped,
+            'cameras': dict((camera_id, {
+                'bytes': b.size,
+                'seconds': b.length,
+                'chunks': len(b.chunks),
+                'dropped': b.dropped,
+            }) for camera_id, b in self.buffers.items()),
+        }
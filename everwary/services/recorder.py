@@ -0,0 +1,459 @@
+import os
+import json
+import time
+import errno
+import signal
+import socket
+import select
+import shutil
+import logging
+import tempfile
+
+from django.conf import settings
+from django.db import close_connection
+
+from main.models import Camera
+from main.models import Event
+from main.models import Segment
+from main.cameras.process import WATCHER
+from main.cameras.process import send_signal
+
+from services.state import STATE
+from services.preroll import Chunk
+from services.preroll import Preroll
+
+
+LOGGER = logging.getLogger(__name__)
+
+# How often recordings are checked, in seconds.
+TICK = 1.0
+# How often, in seconds, cameras to buffer for pre-roll are looked up.
+PREROLL_RELOAD = 30
+# Ticks on which finishing a recording is tried before it is dropped.
+FINISH_ATTEMPTS = 5
+
+
+def get_address():
+    return getattr(settings, 'RECORDER_SOCKET', '/tmp/everwary-recorder.sock')
+
+
+def send(command, camera, **kwargs):
+    """Sends a command to the recorder without waiting for it."""
+    kwargs.update({'command': command, 'camera': camera.id})
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(json.dumps(kwargs), get_address())
+    finally:
+        sock.close()
+
+
+def record(camera, duration):
+    """Starts recording, or extends the current recording, so that it
+    continues for at least `duration` more seconds."""
+    send('record', camera, duration=duration)
+
+
+def stop(camera):
+    """Stops recording."""
+    send('stop', camera)
+
+
+def read_segments(path, offset):
+    """Reads the segments ffmpeg listed in the segment list at `path` past
+    `offset`. Returns a list of (filename, start, end), and the offset to
+    read from next."""
+    try:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return [], offset
+    # A line is appended as each segment is closed, leave any partial line
+    # for the next look.
+    data = data[:data.rfind('\n') + 1]
+    segments = []
+    for line in data.splitlines():
+        filename, start, end = line.rsplit(',', 2)
+        segments.append((filename, float(start), float(end)))
+    return segments, offset + len(data)
+
+
+class Recording(object):
+    """A running ffmpeg process, the future of its exit status (see
+    main.cameras.process), the video it is writing and when it should stop.
+    A recording fed by a `spool` shares its process, and leaves it running
+    when it stops."""
+    def __init__(self, camera, video, process, exited, deadline, duration,
+                 spool=None):
+        self.camera = camera
+        self.video = video
+        self.process = process
+        self.exited = exited
+        self.deadline = deadline
+        # Recording continues for this long after the last motion.
+        self.duration = duration
+        self.spool = spool
+        self.stopping = None
+        self.restart = 0
+        # Segments registered so far, how much of ffmpeg's segment list has
+        # been read, and the length of the video so far.
+        self.segments = 0
+        self.offset = 0
+        self.position = 0.0
+        # Failed attempts at finishing the recording.
+        self.failures = 0
+
+    def is_done(self):
+        if self.spool is not None and self.stopping is not None:
+            return True
+        return self.exited.done()
+
+    def stop(self):
+        if self.stopping is None:
+            self.stopping = time.time()
+            if self.spool is not None:
+                self.spool.recording = None
+            else:
+                # Ask ffmpeg nicely to stop recording, it finalizes the file.
+                # The watcher terminates, then kills, it if it does not.
+                WATCHER.stop(self.process, self.exited)
+
+
+class Spool(object):
+    """An ffmpeg process writing short segments of a camera's video to
+    `directory`. The segments are buffered in memory for pre-roll, or go to
+    `recording` while the camera records."""
+    def __init__(self, camera, process, exited, directory):
+        self.camera = camera
+        self.process = process
+        self.exited = exited
+        self.directory = directory
+        self.offset = 0
+        self.recording = None
+
+    def get_segment_list(self):
+        return os.path.join(self.directory, 'segments.csv')
+
+    def kill(self):
+        # Nothing is lost, whatever is being written is not buffered yet.
+        send_signal(self.process, signal.SIGKILL)
+        self.exited.result()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class Recorder(object):
+    """Supervises the ffmpeg processes for every recording on this host.
+
+    Commands arrive as datagrams on a UNIX socket (see record() and stop()),
+    so the motion task returns as soon as it has sent one. A single process
+    handles any number of concurrent recordings. The processes are spawned
+    and stopped through main.cameras.process.WATCHER, which reaps them and
+    escalates signals to those that do not stop, and the recorder notices
+    they exited on its next TICK. Segmented recordings have their finished
+    segments registered on each tick.
+
+    Cameras with pre-roll are buffered all the time by a spool (see Spool
+    and services.preroll). When such a camera starts recording, the video
+    begins with the buffered footage and the spool's segments are added to
+    it from then on, so there is no wait for ffmpeg to connect."""
+    def __init__(self, address=None, backend=None, segmented=None,
+                 spool_dir=None, preroll=None):
+        self.address = address or get_address()
+        # Returns the camera backend, replaceable for testing.
+        self.backend = backend or (lambda camera: camera.get_backend())
+        if segmented is None:
+            segmented = getattr(settings, 'RECORD_SEGMENTED', True)
+        self.segmented = segmented
+        self.spool_dir = spool_dir or getattr(
+            settings, 'RECORD_PREROLL_DIR',
+            os.path.join(tempfile.gettempdir(), 'everwary-preroll'))
+        self.preroll = preroll or Preroll()
+        self.recordings = {}
+        self.spools = {}
+        self.next_spool_load = 0
+        self.sock = None
+
+    def bind(self):
+        try:
+            os.remove(self.address)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.address)
+        self.sock.setblocking(0)
+
+    def serve_forever(self):
+        self.bind()
+        try:
+            while True:
+                self.poll(TICK)
+        finally:
+            self.shutdown()
+
+    def poll(self, timeout):
+        """Handles any commands that arrive within `timeout`, then checks on
+        the recordings."""
+        try:
+            r, w, x = select.select([self.sock], [], [], timeout)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            r = None
+        if r:
+            self.receive()
+        self.tick()
+
+    def receive(self):
+        while True:
+            try:
+                data = self.sock.recv(4096)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            try:
+                self.handle(json.loads(data))
+            except Exception:
+                LOGGER.exception('Error handling %r', data)
+                close_connection()
+
+    def handle(self, message):
+        command, camera_id = message['command'], message['camera']
+        recording = self.recordings.get(camera_id)
+        if command == 'record':
+            duration = message['duration']
+            deadline = time.time() + duration
+            if recording is None:
+                self.start(camera_id, deadline, duration)
+            elif recording.stopping is None:
+                recording.deadline = max(recording.deadline, deadline)
+                recording.duration = duration
+            else:
+                # Start a new recording once this one is done.
+                recording.restart = max(recording.restart, deadline)
+        elif command == 'stop':
+            if recording is not None:
+                recording.stop()
+        else:
+            LOGGER.warning('Unknown command %r', command)
+
+    def is_disabled(self, camera):
+        disabled = STATE.is_disabled(camera.id)
+        if disabled is None:
+            return camera.disabled
+        return disabled
+
+    def spawn(self, args):
+        """Returns the process, and the future of its exit status."""
+        return WATCHER.spawn(args)
+
+    def start(self, camera_id, deadline, duration):
+        camera = Camera.objects.get(id=camera_id)
+        if self.is_disabled(camera):
+            return
+        backend = self.backend(camera)
+        spool = self.spools.get(camera_id)
+        if spool is not None:
+            video = backend.get_video(segmented=True)
+            recording = Recording(camera, video, spool.process, spool.exited,
+                                  deadline, duration, spool=spool)
+            chunks = self.preroll.flush(camera_id)
+            for chunk in chunks:
+                self.append(recording, chunk)
+            spool.recording = recording
+            LOGGER.info('Recording for %s, with %.1fs of pre-roll', camera,
+                        recording.position)
+        else:
+            video = backend.get_video(segmented=self.segmented)
+            process, exited = self.spawn(backend.get_record_args(video))
+            recording = Recording(camera, video, process, exited, deadline,
+                                  duration)
+            LOGGER.info('Recording for %s', camera)
+        camera.set_state(Camera.CAMERA_STATE_RECORDING)
+        self.recordings[camera_id] = recording
+
+    def load_spools(self):
+        """Starts spools for cameras with pre-roll, and stops those of
+        cameras that no longer have it."""
+        cameras = {}
+        if self.segmented:
+            cameras = dict((c.id, c) for c in Camera.objects.filter(
+                           preroll__gt=0, disabled=False))
+        for camera_id in cameras.keys():
+            if self.is_disabled(cameras[camera_id]):
+                del cameras[camera_id]
+        for camera_id, spool in self.spools.items():
+            camera = cameras.pop(camera_id, None)
+            if camera is None:
+                self.stop_spool(spool)
+            else:
+                spool.camera.preroll = camera.preroll
+        for camera in cameras.values():
+            try:
+                self.start_spool(camera)
+            except Exception:
+                LOGGER.exception('Could not buffer %s', camera)
+
+    def start_spool(self, camera):
+        directory = os.path.join(self.spool_dir, str(camera.id))
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        spool = Spool(camera, None, None, directory)
+        segment_time = getattr(settings, 'RECORD_PREROLL_SEGMENT_TIME', 2)
+        spool.process, spool.exited = self.spawn(
+            self.backend(camera).get_segment_args(
+                directory, spool.get_segment_list(),
+                segment_time=segment_time))
+        self.spools[camera.id] = spool
+        LOGGER.info('Buffering %ss of pre-roll for %s', camera.preroll, camera)
+
+    def stop_spool(self, spool):
+        del self.spools[spool.camera.id]
+        if spool.recording is not None:
+            spool.recording.stop()
+        spool.kill()
+        self.preroll.discard(spool.camera.id)
+
+    def drain(self, spool):
+        """Buffers the segments the spool closed since the last look, or
+        adds them to its recording."""
+        segments, spool.offset = read_segments(spool.get_segment_list(),
+                                               spool.offset)
+        for filename, start, end in segments:
+            path = os.path.join(spool.directory, os.path.basename(filename))
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.remove(path)
+            chunk = Chunk(time.time(), end - start, os.path.splitext(path)[1],
+                          data)
+            if spool.recording is not None:
+                self.append(spool.recording, chunk)
+            else:
+                self.preroll.add(spool.camera.id, spool.camera.preroll, chunk)
+
+    def tick(self):
+        now = time.time()
+        # A failure with one camera must not stop the others.
+        failed = False
+        for camera_id, spool in self.spools.items():
+            try:
+                self.check_spool(spool)
+            except Exception:
+                LOGGER.exception('Could not check pre-roll for %s',
+                                 spool.camera)
+                failed = True
+        if now >= self.next_spool_load:
+            self.next_spool_load = now + PREROLL_RELOAD
+            try:
+                self.load_spools()
+            except Exception:
+                LOGGER.exception('Could not load cameras with pre-roll')
+                failed = True
+        for camera_id, recording in self.recordings.items():
+            try:
+                self.check(camera_id, recording, now)
+            except Exception:
+                LOGGER.exception('Could not check recording for %s',
+                                 recording.camera)
+                failed = True
+        if failed:
+            # Reconnect on the next tick, in case the database went away.
+            close_connection()
+
+    def check_spool(self, spool):
+        self.drain(spool)
+        if spool.exited.done():
+            LOGGER.warning('Pre-roll for %s exited', spool.camera)
+            self.stop_spool(spool)
+
+    def check(self, camera_id, recording, now):
+        if recording.video.segmented and recording.spool is None:
+            self.collect(recording)
+        if recording.is_done():
+            try:
+                self.finish(recording)
+            except Exception:
+                # Tried again on the next tick, up to FINISH_ATTEMPTS times.
+                recording.failures += 1
+                if recording.failures < FINISH_ATTEMPTS:
+                    raise
+                LOGGER.exception('Giving up on finishing recording for %s',
+                                 recording.camera)
+            del self.recordings[camera_id]
+            if recording.restart > now:
+                self.start(camera_id, recording.restart, recording.duration)
+        elif recording.stopping is not None:
+            # Left to the watcher until ffmpeg exits.
+            pass
+        elif self.is_disabled(recording.camera):
+            recording.stop()
+        elif now >= recording.deadline:
+            # Keep recording while the ingest servers receive stills.
+            motion = STATE.last_motion(camera_id)
+            if motion is not None and motion + recording.duration > now:
+                recording.deadline = motion + recording.duration
+            else:
+                recording.stop()
+
+    def add_segment(self, recording, filename, start, duration):
+        Segment.objects.create(video=recording.video,
+                               sequence=recording.segments,
+                               filename=filename, start=start,
+                               duration=duration)
+        recording.segments += 1
+        recording.position = start + duration
+
+    def append(self, recording, chunk):
+        """Adds a chunk from a spool to a recording, as its next segment."""
+        filename = '%05d%s' % (recording.segments, chunk.ext)
+        path = os.path.join(recording.video.get_segment_dir(), filename)
+        with open(path, 'wb') as f:
+            f.write(chunk.data)
+        self.add_segment(recording, filename, recording.position,
+                         chunk.duration)
+
+    def collect(self, recording):
+        """Registers the segments ffmpeg closed since the last look."""
+        segments, recording.offset = read_segments(
+            recording.video.get_segment_list(), recording.offset)
+        for filename, start, end in segments:
+            self.add_segment(recording, os.path.basename(filename), start,
+                             end - start)
+
+    def finish(self, recording):
+        video, camera = recording.video, recording.camera
+        if video.segmented and recording.spool is None:
+            # The last segment is closed as ffmpeg exits.
+            self.collect(recording)
+        if video.closed is None:
+            video.close()
+        camera.events.create(event=Event.CAMERA_EVENT_RECORDING, video=video)
+        camera.set_state(Camera.CAMERA_STATE_OK)
+        LOGGER.info('Done recording for %s', camera)
+
+    def shutdown(self):
+        """Stops all recordings, waiting for them to finish."""
+        # Spooled recordings stop with their spool.
+        self.next_spool_load = float('inf')
+        for spool in self.spools.values():
+            self.stop_spool(spool)
+        for recording in self.recordings.values():
+            recording.restart = 0
+            recording.stop()
+        while self.recordings:
+            time.sleep(0.1)
+            self.tick()
+        if self.sock is not None:
+            self.sock.close()
+            os.remove(self.address)
+            self.sock = None
+
+    def snapshot(self):
+        return {
+            'recordings': len(self.recordings),
+            'spools': len(self.spools),
+            'preroll': self.preroll.snapshot(),
+        }
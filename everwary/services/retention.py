@@ -0,0 +1,179 @@
+import os
+import time
+import logging
+import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from main.models import Blob
+from main.models import Event
+from main.models import Image
+from main.models import Video
+from main.models import Camera
+from main.models import Retention
+from main.storage import get_image_storage
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def get_local_size(o):
+    """Returns the bytes an Image or Video takes in local storage."""
+    # Blobs are reclaimed once no image references them.
+    if o.uploaded or getattr(o, 'blob_id', None):
+        return 0
+    storage = o.get_storage()
+    name = o.get_name()
+    try:
+        if isinstance(o, Video) and o.segmented:
+            path = storage.path(os.path.splitext(name)[0])
+            return sum(os.path.getsize(os.path.join(path, f))
+                       for f in os.listdir(path))
+        return storage.size(name)
+    except OSError:
+        return 0
+
+
+class Expirer(object):
+    """Deletes the images, videos and events that are older than their
+    camera's retention policy, see Retention.
+
+    Rows are deleted `batch_size` at a time, oldest first, each batch in its
+    own transaction and followed by a `pause`, so that tables are never
+    locked for long. The files of a batch are deleted before its rows, a
+    batch that fails is picked up again by the next run."""
+    def __init__(self, batch_size=None, pause=None):
+        self.batch_size = batch_size or getattr(settings,
+                                                'RETENTION_BATCH_SIZE', 500)
+        self.pause = pause if pause is not None else \
+            getattr(settings, 'RETENTION_BATCH_PAUSE', 0.1)
+
+    def get_policies(self):
+        """Returns (days, alert_days) by camera id, for the cameras that
+        have a policy."""
+        default = (getattr(settings, 'RETENTION_DAYS', None),
+                   getattr(settings, 'RETENTION_ALERT_DAYS', None))
+        users, cameras = {}, {}
+        for r in Retention.objects.all():
+            policies = users if r.camera_id is None else cameras
+            policies[r.camera_id or r.user_id] = (r.days, r.alert_days)
+        policies = {}
+        for camera_id, user_id in Camera.objects.values_list('id',
+                                                             'zone__user'):
+            policy = cameras.get(camera_id) or users.get(user_id) or default
+            if policy[0] is not None:
+                policies[camera_id] = policy
+        return policies
+
+    def expire(self, now=None):
+        """Applies the policy of every camera, then deletes unreferenced
+        blobs. Returns the number of rows deleted by model, and the local
+        bytes reclaimed."""
+        now = now or timezone.now()
+        stats = {'events': 0, 'images': 0, 'videos': 0, 'bytes': 0}
+        start = time.time()
+        for camera_id, (days, alert_days) in self.get_policies().items():
+            for key, value in self.expire_camera(camera_id, days, alert_days,
+                                                 now).items():
+                stats[key] += value
+        stats['blobs'], reclaimed = self.expire_blobs()
+        stats['bytes'] += reclaimed
+        # Packs (see main.storage.PackStorage) free deleted stills as they
+        # are compacted.
+        storage = get_image_storage()
+        if hasattr(storage, 'compact'):
+            LOGGER.info('Compacted packs, freed %s bytes', storage.compact())
+        LOGGER.info('Expired %(events)s events, %(images)s images, '
+                    '%(videos)s videos and %(blobs)s blobs, reclaimed '
+                    '%(bytes)s bytes', stats)
+        LOGGER.debug('Expired in %.1fs', time.time() - start)
+        return stats
+
+    def expire_camera(self, camera_id, days, alert_days, now):
+        cutoff = now - datetime.timedelta(days=days)
+        alert_cutoff = now - datetime.timedelta(days=max(days,
+                                                         alert_days or 0))
+        # Alerts past `days` but within `alert_days` keep their image and
+        # video.
+        kept = Event.objects.filter(camera=camera_id,
+                                    event=Event.CAMERA_EVENT_ALERT,
+                                    created__gte=alert_cutoff,
+                                    created__lt=cutoff)
+        events = Event.objects.filter(camera=camera_id, created__lt=cutoff) \
+            .exclude(event=Event.CAMERA_EVENT_ALERT,
+                     created__gte=alert_cutoff)
+        images = Image.objects.filter(camera=camera_id, created__lt=cutoff) \
+            .exclude(id__in=kept.filter(image__isnull=False).values('image'))
+        # Videos still recording are left to the recorder.
+        videos = Video.objects.filter(camera=camera_id, created__lt=cutoff,
+                                      closed__isnull=False) \
+            .exclude(id__in=kept.filter(video__isnull=False).values('video'))
+        stats = {'bytes': 0}
+        stats['events'] = self.delete(events)[0]
+        for key, queryset in (('videos', videos), ('images', images)):
+            count, reclaimed = self.delete(queryset, files=True)
+            stats[key] = count
+            stats['bytes'] += reclaimed
+        return stats
+
+    def expire_blobs(self):
+        """Deletes the blobs no image references. Returns their number and
+        the bytes reclaimed."""
+        count, reclaimed, last = 0, 0, ''
+        while True:
+            digests = list(Blob.objects.filter(refs__lte=0, digest__gt=last)
+                           .order_by('digest')
+                           .values_list('digest', flat=True)[:self.batch_size])
+            for digest in digests:
+                try:
+                    # Locked against Blob.add() until the file is gone.
+                    with transaction.commit_on_success():
+                        blob = Blob.objects.select_for_update() \
+                            .get(digest=digest, refs__lte=0)
+                        blob.delete_file()
+                        blob.delete()
+                except Blob.DoesNotExist:
+                    continue
+                except Exception, e:
+                    LOGGER.warning('Could not delete blob %s: %s', digest, e)
+                    continue
+                count += 1
+                reclaimed += blob.size
+            if len(digests) < self.batch_size:
+                break
+            last = digests[-1]
+            time.sleep(self.pause)
+        return count, reclaimed
+
+    def delete(self, queryset, files=False):
+        """Deletes the rows of `queryset`, and their files, in batches.
+        Returns the number of rows and bytes deleted."""
+        count, reclaimed = 0, 0
+        queryset = queryset.order_by('created')
+        while True:
+            if files:
+                batch = list(queryset[:self.batch_size])
+                ids = [o.pk for o in batch]
+            else:
+                ids = list(queryset.values_list('pk', flat=True)
+                           [:self.batch_size])
+            if not ids:
+                break
+            if files:
+                for o in batch:
+                    size = get_local_size(o)
+                    try:
+                        o.delete_file()
+                    except Exception, e:
+                        LOGGER.warning('Could not delete the file of %s %s: '
+                                       '%s', type(o).__name__, o.pk, e)
+                    else:
+                        reclaimed += size
+            queryset.model.objects.filter(pk__in=ids).delete()
+            count += len(ids)
+            if len(ids) < self.batch_size:
+                break
+            time.sleep(self.pause)
+        return count, reclaimed
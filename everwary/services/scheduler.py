@@ -0,0 +1,134 @@
+import time
+import heapq
+import logging
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_connection
+from django.utils import timezone
+
+from main.models import Camera
+from main.models import Period
+
+from services.async import tasks
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Subtracted from the time of the last look at changes, so rows saved in the
+# same second are not missed by databases without sub-second precision.
+SLACK = timedelta(seconds=1)
+
+
+def dispatch(period):
+    """Queues the task for a period. The unique key keeps runs from piling
+    up behind slow workers."""
+    unique = 'period-%s' % period.id
+    if period.action == Period.PERIOD_ACTION_CAPTURE:
+        tasks.capture.submit((period.camera, ), unique=unique)
+    elif period.action == Period.PERIOD_ACTION_HEALTH:
+        tasks.health.submit((period.camera, ), unique=unique)
+    else:
+        LOGGER.warning('Unknown action for %s', period)
+
+
+class Scheduler(object):
+    """Runs periods on time, with one second resolution.
+
+    Periods are kept in a heap ordered by their next run, so each tick only
+    looks at periods that are due. Every `reload_interval` seconds periods
+    and cameras updated since the last look are loaded again, changed
+    periods simply replace their heap entry. Deleted periods are noticed by
+    a full reload every `full_reload_interval` seconds."""
+    def __init__(self, dispatch=dispatch, reload_interval=None,
+                 full_reload_interval=300):
+        self.dispatch = dispatch
+        self.reload_interval = reload_interval or \
+            getattr(settings, 'SCHEDULER_RELOAD_INTERVAL', 5)
+        self.full_reload_interval = full_reload_interval
+        # Period id -> period, entries in the heap for periods not in here
+        # or for older versions of a period are skipped.
+        self.periods = {}
+        # Heap of (next run, period id, period)
+        self.heap = []
+        self.since = None
+        self.next_reload = self.next_full_reload = 0
+
+    def get_next_run(self, period, now):
+        # Runs are aligned to the interval, offset per period so periods
+        # with the same interval do not all run in the same second.
+        interval = max(period.interval, 1)
+        offset = period.id % interval
+        return ((now - offset) // interval + 1) * interval + offset
+
+    def add(self, period, now):
+        if period.disabled or (period.camera and period.camera.disabled):
+            self.periods.pop(period.id, None)
+            return
+        self.periods[period.id] = period
+        heapq.heappush(self.heap, (self.get_next_run(period, now), period.id,
+                                   period))
+
+    def load(self, now):
+        """Loads all periods."""
+        started = timezone.now()
+        self.periods, self.heap = {}, []
+        for period in Period.objects.filter(disabled=False).select_related('camera'):
+            self.add(period, now)
+        self.since = started - SLACK
+        LOGGER.info('Loaded %s periods', len(self.periods))
+
+    def reload(self, now):
+        """Loads periods that changed since the last load."""
+        started = timezone.now()
+        changed = set(Period.objects.filter(updated__gte=self.since)
+                      .values_list('id', flat=True))
+        changed.update(Period.objects.filter(camera__in=Camera.objects.filter(
+                       updated__gte=self.since)).values_list('id', flat=True))
+        if changed:
+            for period_id in changed:
+                self.periods.pop(period_id, None)
+            for period in Period.objects.filter(id__in=changed).select_related('camera'):
+                self.add(period, now)
+            LOGGER.info('Reloaded %s periods', len(changed))
+        self.since = started - SLACK
+
+    def tick(self, now):
+        """Reloads if needed and runs the periods that are due. Returns the
+        time of the next run or reload."""
+        if now >= self.next_full_reload:
+            self.load(now)
+            self.next_full_reload = now + self.full_reload_interval
+            self.next_reload = now + self.reload_interval
+        elif now >= self.next_reload:
+            self.reload(now)
+            self.next_reload = now + self.reload_interval
+        while self.heap and self.heap[0][0] <= now:
+            when, period_id, period = heapq.heappop(self.heap)
+            if self.periods.get(period_id) is not period:
+                continue
+            heapq.heappush(self.heap, (self.get_next_run(period, now),
+                                       period_id, period))
+            if not period.in_window(timezone.localtime(timezone.now()).time()):
+                continue
+            try:
+                self.dispatch(period)
+            except Exception:
+                LOGGER.exception('Could not run %s', period)
+        next_run = min(self.next_reload, self.next_full_reload)
+        if self.heap:
+            next_run = min(next_run, self.heap[0][0])
+        return next_run
+
+    def serve_forever(self):
+        while True:
+            try:
+                next_run = self.tick(time.time())
+            except Exception:
+                LOGGER.exception('Scheduler tick failed')
+                # Reconnect after a server restart or an idle timeout, and
+                # try again after a pause.
+                close_connection()
+                next_run = time.time() + self.reload_interval
+            time.sleep(max(0, next_run - time.time()))
@@ -0,0 +1,25 @@
+import threading
+import urlparse
+
+import requests
+
+
+class SessionPool(object):
+    """A requests session per camera host, so connections to a host are
+    kept alive and reused, up to `maxsize` at once."""
+    def __init__(self, maxsize=4):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def get(self, url):
+        host = urlparse.urlsplit(url).netloc
+        with self.lock:
+            session = self.sessions.get(host)
+            if session is None:
+                session = self.sessions[host] = requests.Session()
+                for prefix in ('http://', 'https://'):
+                    session.mount(prefix, requests.adapters.HTTPAdapter(
+                                  pool_connections=1,
+                                  pool_maxsize=self.maxsize))
+            return session
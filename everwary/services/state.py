@@ -0,0 +1,137 @@
+import time
+import sqlite3
+import threading
+
+from django.conf import settings
+
+# Camera state read on every motion task and recording tick: the time of the
+# last still and of the last alert (seconds since the epoch) and whether the
+# camera is disabled. Unknown values are None.
+
+
+class MemoryStore(object):
+    """Keeps camera state in this process only, used when running tests or
+    when ingest, workers and the recorder share a process."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cameras = {}
+
+    def state(self, camera_id):
+        # Caller holds the lock.
+        return self.cameras.setdefault(camera_id, {'motion': None,
+                                       'alert': None, 'disabled': None})
+
+    def get(self, camera_id):
+        with self.lock:
+            return dict(self.state(camera_id))
+
+    def touch_motion(self, camera_id, when=None):
+        when = when or time.time()
+        with self.lock:
+            state = self.state(camera_id)
+            state['motion'] = max(state['motion'], when)
+
+    def last_motion(self, camera_id):
+        return self.get(camera_id)['motion']
+
+    def claim_alert(self, camera_id, interval, now=None):
+        now = now or time.time()
+        with self.lock:
+            state = self.state(camera_id)
+            if state['alert'] is not None and state['alert'] > now - interval:
+                return False
+            state['alert'] = now
+            return True
+
+    def set_disabled(self, camera_id, disabled):
+        with self.lock:
+            self.state(camera_id)['disabled'] = disabled
+
+    def is_disabled(self, camera_id):
+        return self.get(camera_id)['disabled']
+
+    def forget(self, camera_id):
+        with self.lock:
+            self.cameras.pop(camera_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.cameras.clear()
+
+
+class SqliteStore(object):
+    """Keeps camera state in an SQLite database, shared by every process on
+    this host. Each thread has its own connection, writes are single
+    statements so no transaction is held open between them."""
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    @property
+    def db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute('CREATE TABLE IF NOT EXISTS camera_state ('
+                       'camera_id INTEGER PRIMARY KEY, motion REAL, '
+                       'alert REAL, disabled INTEGER)')
+            self.local.db = db
+        return db
+
+    def get(self, camera_id):
+        row = self.db.execute('SELECT motion, alert, disabled FROM camera_state '
+                              'WHERE camera_id = ?', (camera_id, )).fetchone()
+        if row is None:
+            return {'motion': None, 'alert': None, 'disabled': None}
+        disabled = None if row[2] is None else bool(row[2])
+        return {'motion': row[0], 'alert': row[1], 'disabled': disabled}
+
+    def upsert(self, camera_id):
+        self.db.execute('INSERT OR IGNORE INTO camera_state (camera_id) '
+                        'VALUES (?)', (camera_id, ))
+
+    def touch_motion(self, camera_id, when=None):
+        when = when or time.time()
+        self.upsert(camera_id)
+        self.db.execute('UPDATE camera_state SET motion = ? WHERE camera_id = ? '
+                        'AND (motion IS NULL OR motion < ?)',
+                        (when, camera_id, when))
+
+    def last_motion(self, camera_id):
+        return self.get(camera_id)['motion']
+
+    def claim_alert(self, camera_id, interval, now=None):
+        now = now or time.time()
+        self.upsert(camera_id)
+        # Compare and set, only one process wins.
+        c = self.db.execute('UPDATE camera_state SET alert = ? WHERE camera_id '
+                            '= ? AND (alert IS NULL OR alert <= ?)',
+                            (now, camera_id, now - interval))
+        return c.rowcount == 1
+
+    def set_disabled(self, camera_id, disabled):
+        self.upsert(camera_id)
+        self.db.execute('UPDATE camera_state SET disabled = ? WHERE camera_id = ?',
+                        (int(disabled), camera_id))
+
+    def is_disabled(self, camera_id):
+        return self.get(camera_id)['disabled']
+
+    def forget(self, camera_id):
+        self.db.execute('DELETE FROM camera_state WHERE camera_id = ?',
+                        (camera_id, ))
+
+    def clear(self):
+        self.db.execute('DELETE FROM camera_state')
+
+
+def get_store():
+    path = getattr(settings, 'STATE_DB', None)
+    if not path:
+        return MemoryStore()
+    return SqliteStore(path)
+
+
+STATE = get_store()
@@ -1,23 +1,94 @@
+import os
+import time
+import base64
+import tempfile
+import requests
 import ftplib
 import smtplib
+import email
 import asyncore
 import threading
 
+from datetime import timedelta
+from datetime import time as time_of_day
+
 try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
 
+from django.test import SimpleTestCase
+from django.utils import timezone
 from django.test import TransactionTestCase
+from django.contrib.auth.models import User
 
+from main.models import Zone
 from main.models import Image
+from main.models import Video
+from main.models import Event
 from main.models import Camera
+from main.models import Period
+from main.models import Blob
+from main.models import Usage
+from main.models import Segment
+from main.models import Retention
+from main import storage
+from main.storage import MemoryObjectStore
 
 from services.management.commands.ftp import FTPAuth
 from services.management.commands.ftp import FTPServer
 from services.management.commands.ftp import FTPHandler
 from services.management.commands.ftp import FTPImageStorageFS
 from services.management.commands.smtp import SMTPServer
+from services.ingest.smtp import SMTPServer as IngestSMTPServer
+from services.ingest.mime import ImageExtractor
+from services.ingest.auth import CAMERAS
+from services.ingest.auth import CameraCache
+from services.ingest.writer import WRITER
+from services.ingest.writer import WriteBehind
+from services.ingest.coalesce import MotionCoalescer
+from services import usage
+from services.management.base import LoopCommand
+from services.management.commands import uploader
+from services import recorder
+from services.preroll import Chunk
+from services.preroll import Preroll
+from services.preroll import RingBuffer
+from services.async import tasks
+from services.async import resolve
+from services.async import ModelRef
+from services.async import MissingRow
+from services.async import JSONDataEncoder
+from services.async.tasks import Task
+from services.async.backends import TaskError
+from services.async.backends import PRIORITY_LOW
+from services.async.backends import PRIORITY_HIGH
+from services.async.backends.local import LocalBackend
+from services.management.commands.worker import GearmanWorker
+from services.health import HealthChecker
+from services.capture import Capturer
+from services.capture import get_zone_cameras
+from services.scheduler import Scheduler
+from services.upload import Uploader
+from services.retention import Expirer
+from services.usage import backfill
+from services.usage import QUOTAS
+from services.usage import QuotaCache
+from services.usage import QuotaExceeded
+from services.usage import reconcile
+from services.upload import RateLimiter
+from services.management.commands.benchmark import HealthHandler
+from services.management.commands.benchmark import SnapshotHandler
+from services.management.commands.benchmark import ThreadedHTTPServer
+from services.metrics import Metrics
+from services.metrics import Profiler
+from services.metrics import Histogram
+from services.metrics import StatsServer
+from services.recorder import Recorder
+from services.state import STATE
+from services.state import MemoryStore
+from services.state import SqliteStore
+from main.cameras.base import BaseCamera
 
 
 TEST_USERNAME = '8f55a2ea-4b9d-4133-b89b-d5874d652544'
@@ -61,6 +132,1132 @@ a25qbW9nNXRwbF0nemVycHpvemlnc3k5aDZqcm9wdHo7amlodDhpOTA4N3U5Nnkwb2tqMm9sd3An
 LGZ2cDBbZWRzcm85eWo1Zmtsc2xrZ3g='''
 
 
+class UnclosableStringIO(object):
+    """Keeps its contents around after close()."""
+    def __init__(self):
+        self.buffer = StringIO()
+        self.write = self.buffer.write
+        self.getvalue = self.buffer.getvalue
+
+    def close(self):
+        pass
+
+
+class StringImageExtractor(ImageExtractor):
+    def open_image(self, mime):
+        self.image = UnclosableStringIO()
+        return self.image
+
+
+class ImageExtractorTest(SimpleTestCase):
+    def feed(self, message):
+        parser = StringImageExtractor()
+        for line in message.split('\n'):
+            parser.feed(line)
+        return parser
+
+    def test_multipart(self):
+        """Ensure the image matches what the email package would decode."""
+        parser = self.feed(TEST_MULTIPART)
+        self.assertTrue(parser.close())
+        self.assertEqual(parser.mime, 'image/png')
+        expected = [p for p in email.message_from_string(TEST_MULTIPART).walk()
+                    if p.get_content_type() == 'image/png'][0]
+        self.assertEqual(parser.image.getvalue(),
+                         expected.get_payload(decode=True))
+
+    def test_noimage(self):
+        parser = self.feed('Subject: Example Email\n\nNo image here.\n')
+        self.assertFalse(parser.close())
+
+    def test_abort(self):
+        parser = self.feed(TEST_MULTIPART[:len(TEST_MULTIPART) / 2])
+        parser.abort()
+        self.assertFalse(parser.close())
+
+
+class CameraCacheTest(TransactionTestCase):
+    fixtures = ('unittest', )
+
+    def setUp(self):
+        self.cache = CameraCache(1, 60)
+
+    def test_hit(self):
+        self.assertEqual(self.cache.get(TEST_USERNAME).auth, TEST_USERNAME)
+        with self.assertNumQueries(0):
+            self.assertIsNotNone(self.cache.authenticate(TEST_USERNAME, TEST_PASSWORD))
+            self.assertIsNone(self.cache.authenticate(TEST_USERNAME, ''))
+        stats = self.cache.stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_unknown(self):
+        self.assertIsNone(self.cache.get('unknown'))
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.cache.get('unknown'))
+
+    def test_evict(self):
+        self.cache.get(TEST_USERNAME)
+        self.cache.get('unknown')
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+        with self.assertNumQueries(1):
+            self.cache.get(TEST_USERNAME)
+
+    def test_expire(self):
+        self.cache.ttl = 0
+        self.cache.get(TEST_USERNAME)
+        with self.assertNumQueries(1):
+            self.cache.get(TEST_USERNAME)
+
+    def test_invalidate(self):
+        """Ensure saving a camera drops the cached copy."""
+        camera = CAMERAS.get(TEST_USERNAME)
+        camera.disabled = True
+        camera.save()
+        self.assertIsNone(CAMERAS.authenticate(TEST_USERNAME, TEST_PASSWORD))
+
+
+class WriteBehindTest(TransactionTestCase):
+    fixtures = ('unittest', )
+
+    def setUp(self):
+        self.camera = Camera.objects.get(auth=TEST_USERNAME)
+        self.committed = []
+
+    def add(self, writer):
+        image = Image(camera=self.camera, mime='image/jpeg')
+        event = Event(camera=self.camera, event=Event.CAMERA_EVENT_MOTION,
+                      image=image)
+        writer.add(image, event, callback=self.committed.append, args=(image.id, ))
+        return image
+
+    def test_size(self):
+        """Ensure a full batch is inserted at once, in order."""
+        writer = WriteBehind(3, 60)
+        images = [self.add(writer) for i in range(3)]
+        writer.stop()
+        self.assertEqual(self.committed, [i.id for i in images])
+        self.assertEqual(Image.objects.count(), 3)
+        events = Event.objects.order_by('id').values_list('image_id', flat=True)
+        self.assertEqual(list(events), [i.id for i in images])
+
+    def test_interval(self):
+        """Ensure rows are inserted once the interval passes."""
+        writer = WriteBehind(100, 0.05)
+        self.add(writer)
+        writer.join(0.5)
+        self.assertEqual(len(self.committed), 1)
+        writer.stop()
+
+    def test_failure(self):
+        """Ensure a row that fails to insert does not keep the others from
+        being inserted, and that its event and callback are skipped."""
+        existing = Image.objects.create(camera=self.camera, mime='image/jpeg')
+        writer = WriteBehind(100, 60)
+        image = Image(id=existing.id, camera=self.camera, mime='image/jpeg')
+        writer.add(image, Event(camera=self.camera, image=image,
+                                event=Event.CAMERA_EVENT_MOTION),
+                   callback=self.committed.append, args=(image.id, ))
+        image = self.add(writer)
+        writer.stop()
+        self.assertEqual(self.committed, [image.id])
+        self.assertEqual(list(Event.objects.values_list('image', flat=True)),
+                         [image.id])
+
+    def test_stop(self):
+        writer = WriteBehind(100, 60)
+        self.add(writer)
+        self.assertEqual(Image.objects.count(), 0)
+        writer.stop()
+        self.assertEqual(Image.objects.count(), 1)
+
+
+class MotionCoalescerTest(SimpleTestCase):
+    def setUp(self):
+        self.dispatched = []
+        self.camera = Camera(id=1)
+
+    def dispatch(self, camera, images):
+        self.dispatched.append((camera.id, images))
+
+    def test_burst(self):
+        """Ensure the first still is dispatched at once, and the rest of the
+        burst as one task when the window closes."""
+        coalescer = MotionCoalescer(0.05, self.dispatch)
+        for i in range(5):
+            coalescer.add(self.camera, i)
+        self.assertEqual(self.dispatched, [(1, [0])])
+        coalescer.add(Camera(id=2), 0)
+        self.assertEqual(len(self.dispatched), 2)
+        time.sleep(0.2)
+        self.assertEqual(self.dispatched[2:], [(1, [1, 2, 3, 4])])
+        coalescer.stop()
+
+    def test_stop(self):
+        """Ensure held stills are dispatched on shutdown."""
+        coalescer = MotionCoalescer(60, self.dispatch)
+        coalescer.add(self.camera, 0)
+        coalescer.add(self.camera, 1)
+        coalescer.stop()
+        self.assertEqual(self.dispatched, [(1, [0]), (1, [1])])
+
+    def test_disabled(self):
+        coalescer = MotionCoalescer(0, self.dispatch)
+        coalescer.add(self.camera, 0)
+        coalescer.add(self.camera, 1)
+        self.assertEqual(self.dispatched, [(1, [0]), (1, [1])])
+
+
+class MemoryStoreTest(SimpleTestCase):
+    def get_store(self):
+        return MemoryStore()
+
+    def setUp(self):
+        self.store = self.get_store()
+
+    def test_motion(self):
+        self.assertIsNone(self.store.last_motion(1))
+        self.store.touch_motion(1, 10)
+        self.store.touch_motion(1, 5)
+        self.assertEqual(self.store.last_motion(1), 10)
+
+    def test_alert(self):
+        """Ensure only one alert is claimed per interval."""
+        self.assertTrue(self.store.claim_alert(1, 300, now=1000))
+        self.assertFalse(self.store.claim_alert(1, 300, now=1100))
+        self.assertTrue(self.store.claim_alert(2, 300, now=1100))
+        self.assertTrue(self.store.claim_alert(1, 300, now=1300))
+
+    def test_disabled(self):
+        self.assertIsNone(self.store.is_disabled(1))
+        self.store.set_disabled(1, True)
+        self.assertTrue(self.store.is_disabled(1))
+        self.store.forget(1)
+        self.assertIsNone(self.store.is_disabled(1))
+
+
+class SqliteStoreTest(MemoryStoreTest):
+    def get_store(self):
+        return SqliteStore(os.path.join(tempfile.mkdtemp(), 'state.db'))
+
+    def test_shared(self):
+        """Ensure state is shared between connections."""
+        self.store.touch_motion(1, 10)
+        self.assertEqual(SqliteStore(self.store.path).last_motion(1), 10)
+
+
+class JSONDataEncoderTest(TransactionTestCase):
+    fixtures = ('unittest', )
+
+    def test_roundtrip(self):
+        """Ensure models are sent by key and loaded with a query per model."""
+        camera = Camera.objects.get(auth=TEST_USERNAME)
+        images = [Image.objects.create(camera=camera, mime='image/jpeg')
+                  for i in range(3)]
+        encoded = JSONDataEncoder.encode({'args': (camera, images), 'kwargs': {}})
+        self.assertNotIn(TEST_PASSWORD, encoded)
+        data = JSONDataEncoder.decode(encoded)
+        self.assertIsInstance(data['args'][0], ModelRef)
+        with self.assertNumQueries(2):
+            args = resolve(data['args'])
+        self.assertEqual(args[0], camera)
+        self.assertEqual(args[1], images)
+
+    def test_missing(self):
+        camera = Camera.objects.get(auth=TEST_USERNAME)
+        data = JSONDataEncoder.decode(JSONDataEncoder.encode([camera]))
+        camera.delete()
+        self.assertRaises(MissingRow, resolve, data)
+
+
+def camera_name(camera):
+    return camera.name
+
+
+def fail():
+    raise ValueError()
+
+
+class LocalBackendTest(TransactionTestCase):
+    fixtures = ('unittest', )
+
+    def setUp(self):
+        self.backend = LocalBackend(workers=1)
+        self.ran = []
+
+    def tearDown(self):
+        self.backend.stop()
+
+    def test_apply_wait(self):
+        camera = Camera.objects.get(auth=TEST_USERNAME)
+        task = Task(camera_name)
+        self.assertEqual(self.backend.submit_wait(task, {'args': (camera, )}),
+                         camera.name)
+        self.assertRaises(TaskError, self.backend.submit_wait, Task(fail), {})
+
+    def test_priority(self):
+        """Ensure queued tasks run highest priority first."""
+        block = threading.Event()
+        self.backend.submit(Task(block.wait), {'args': (1, )})
+        for priority in (PRIORITY_LOW, PRIORITY_HIGH):
+            self.backend.submit(Task(self.ran.append, priority=priority),
+                                {'args': (priority, )})
+        block.set()
+        self.backend.stop()
+        self.assertEqual(self.ran, [PRIORITY_HIGH, PRIORITY_LOW])
+
+    def test_unique(self):
+        """Ensure a task is not queued twice under the same key."""
+        block = threading.Event()
+        self.backend.submit(Task(block.wait), {'args': (1, )})
+        for i in range(3):
+            self.backend.submit(Task(self.ran.append), {'args': (i, )},
+                                unique='test')
+        block.set()
+        self.backend.stop()
+        self.assertEqual(self.ran, [0])
+
+
+class TaskTest(TransactionTestCase):
+    fixtures = ('unittest', )
+
+    def test_apply(self):
+        """Ensure apply() passes models by key, as a backend does."""
+        camera = Camera.objects.get(auth=TEST_USERNAME)
+        Camera.objects.filter(id=camera.id).update(name='renamed')
+        task = Task(camera_name)
+        self.assertEqual(task(camera), camera.name)
+        self.assertEqual(task.apply(camera), 'renamed')
+        self.assertEqual(task.apply_wait(camera), 'renamed')
+
+    def test_capture_quota(self):
+        """Ensure scheduled captures skip users over quota."""
+        camera = Camera.objects.get(auth=TEST_USERNAME)
+        captured = []
+        camera.get_backend = lambda: captured.append(camera)
+        QUOTAS.users.clear()
+        try:
+            with self.settings(USAGE_QUOTA=0):
+                tasks.capture(camera)
+        finally:
+            QUOTAS.users.clear()
+        self.assertEqual(captured, [])
+
+
+class FakeJob(object):
+    connection = 'connection'
+
+    def __init__(self, task, data=None):
+        self.task = task
+        self.data = data
+
+
+class RecordingGearmanWorker(GearmanWorker):
+    def __init__(self, *args, **kwargs):
+        super(RecordingGearmanWorker, self).__init__([], *args, **kwargs)
+        self.connection_to_handler_map[FakeJob.connection] = None
+        self.results = []
+        self.abilities = []
+
+    def set_ability(self, task, can_do):
+        self.abilities.append((task, can_do))
+
+    def on_job_complete(self, job, result):
+        self.results.append(result)
+
+    def on_job_exception(self, job, exc_info):
+        self.results.append(exc_info[0])
+
+    def wait(self, count):
+        for i in range(50):
+            self.after_poll(False)
+            if len(self.results) >= count:
+                break
+            time.sleep(0.05)
+
+
+class GearmanWorkerTest(SimpleTestCase):
+    def test_concurrent(self):
+        """Ensure a quick job completes while a long one runs."""
+        worker = RecordingGearmanWorker(workers=2)
+        block = threading.Event()
+        worker.register_task('long', lambda w, job: block.wait(5))
+        worker.register_task('short', lambda w, job: job.data)
+        worker.on_job_execute(FakeJob('long'))
+        worker.on_job_execute(FakeJob('short', 'done'))
+        self.assertTrue(worker.is_full())
+        worker.wait(1)
+        self.assertEqual(worker.results, ['done'])
+        self.assertFalse(worker.is_full())
+        block.set()
+        worker.wait(2)
+        self.assertEqual(worker.results, ['done', True])
+        worker.shutdown()
+
+    def test_metrics(self):
+        worker = RecordingGearmanWorker(workers=2)
+        worker.register_task('ok', lambda w, job: None)
+        worker.register_task('fail', lambda w, job: fail())
+        worker.on_job_execute(FakeJob('ok', {'submitted': time.time() - 2}))
+        worker.on_job_execute(FakeJob('fail', {}))
+        worker.wait(2)
+        worker.shutdown()
+        tasks = worker.metrics.snapshot()['tasks']
+        self.assertEqual(tasks['ok']['completed'], 1)
+        self.assertEqual(tasks['ok']['in_flight'], 0)
+        self.assertGreaterEqual(tasks['ok']['latency']['min'], 2)
+        self.assertEqual(tasks['fail']['error_rate'], 1.0)
+        self.assertEqual(tasks['fail']['latency']['count'], 0)
+
+    def test_limit(self):
+        """Ensure a task stops being offered at its limit, and jobs assigned
+        past the limit wait their turn."""
+        worker = RecordingGearmanWorker(workers=4)
+        worker.register_task('limited', lambda w, job: job.data, limit=1)
+        worker.on_job_execute(FakeJob('limited', 1))
+        worker.on_job_execute(FakeJob('limited', 2))
+        self.assertEqual(worker.active, 1)
+        self.assertEqual(worker.abilities, [('limited', False)])
+        worker.wait(2)
+        self.assertEqual(worker.results, [1, 2])
+        self.assertEqual(worker.abilities[-1], ('limited', True))
+        worker.shutdown()
+
+
+class FailingCommand(LoopCommand):
+    def setup(self):
+        self.calls = ['setup']
+
+    def run(self):
+        self.calls.append('run')
+        raise IOError('Failed')
+
+    def shutdown(self):
+        self.calls.append('shutdown')
+
+
+class LoopCommandTest(SimpleTestCase):
+    def test_failure(self):
+        """Ensure a failed run is logged rather than raised."""
+        command = FailingCommand()
+        command.handle(loop=False, interval=None)
+        self.assertEqual(command.calls, ['setup', 'run', 'shutdown'])
+        self.assertEqual(command.get_interval(), 60)
+
+
+class MetricsTest(SimpleTestCase):
+    def test_histogram(self):
+        histogram = Histogram(smallest=1)
+        for i in range(1, 101):
+            histogram.add(i)
+        snapshot = histogram.snapshot()
+        self.assertEqual((snapshot['min'], snapshot['max']), (1, 100))
+        self.assertEqual(snapshot['mean'], 50.5)
+        self.assertEqual(snapshot['p50'], 64)
+        self.assertEqual(snapshot['p99'], 128)
+
+    def test_stats_server(self):
+        metrics = Metrics()
+        metrics.job_started('motion', latency=0.5, size=100)
+        server = StatsServer(('127.0.0.1', 0), metrics)
+        server.start()
+        try:
+            r = requests.get('http://127.0.0.1:%s/' % server.server_port)
+        finally:
+            server.shutdown()
+        self.assertEqual(r.json()['tasks']['motion']['in_flight'], 1)
+
+    def test_profiler(self):
+        directory = tempfile.mkdtemp()
+        profiler = Profiler({'motion': 1.0}, directory)
+        self.assertEqual(profiler.run('motion', sum, [1, 2]), 3)
+        self.assertEqual(profiler.run('alert', sum, [1, 2]), 3)
+        self.assertEqual(os.listdir(directory), ['motion.prof'])
+
+
+class CapturerTest(TransactionTestCase):
+    fixtures = ('unittest', )
+
+    def setUp(self):
+        self.server = ThreadedHTTPServer(('127.0.0.1', 0), SnapshotHandler)
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.capturer = Capturer(workers=4, per_host=2)
+        Camera.objects.update(make='Foscam', model='FI9805W',
+                              url='http://127.0.0.1:%s/' % self.server.server_address[1])
+
+    def tearDown(self):
+        self.capturer.shutdown()
+        self.server.shutdown()
+
+    def test_zone(self):
+        """Ensure cameras in nested zones are captured, and images saved."""
+        cameras = list(get_zone_cameras(Zone.objects.get(name='Zone 0')))
+        self.assertEqual(len(cameras), Camera.objects.count())
+        # The insert, and an update of each camera's usage.
+        with self.assertNumQueries(1 + len(cameras)):
+            images, failed = self.capturer.capture(cameras * 3)
+        self.assertEqual(failed, [])
+        self.assertEqual(Image.objects.count(), len(cameras) * 3)
+        image = Image.objects.all()[0]
+        self.assertEqual(image.mime, 'image/jpeg')
+        with image.open('rb') as f:
+            self.assertEqual(f.read(), SnapshotHandler.snapshot)
+
+    def test_failed(self):
+        camera = Camera.objects.get(auth=TEST_USERNAME)
+        camera.url = 'http://127.0.0.1:1/'
+        images, failed = self.capturer.capture([camera])
+        self.assertEqual((images, failed[0][0]), ([], camera))
+
+
+class FailingObjectStore(MemoryObjectStore):
+    """Fails every part after the first while `failing`, like a connection
+    lost midway, and records the parts sent."""
+    def __init__(self):
+        super(FailingObjectStore, self).__init__()
+        self.failing = True
+        self.sent = []
+
+    def upload_part(self, key, upload_id, number, data):
+        if self.failing and number > 1:
+            raise IOError('Connection reset')
+        self.sent.append(number)
+        super(FailingObjectStore, self).upload_part(key, upload_id, number,
+                                                    data)
+
+
+class UploaderTest(TransactionTestCase):
+    fixtures = ('unittest', )
+
+    def setUp(self):
+        self.store = MemoryObjectStore()
+        self.uploader = Uploader(self.store, workers=4, files=2, part_size=4,
+                                 image_age=0)
+
+    def tearDown(self):
+        self.uploader.shutdown()
+
+    def test_disabled(self):
+        """Ensure the command idles when no store is configured."""
+        with self.settings(UPLOAD_STORE=None):
+            command = uploader.Command()
+            command.handle(loop=False, interval=None)
+        self.assertIsNone(command.uploader)
+
+    def test_multipart(self):
+        """Ensure large files are sent in parts, and evicted once sent."""
+        video = Video.objects.create(camera_id=1, mime='video/x-matroska',
+                                     closed=timezone.now())
+        video.write('0123456789')
+        image = Image(camera_id=1, mime='image/jpeg')
+        image.write('jpeg')
+        image.save()
+        self.assertEqual(self.uploader.sync(), (2, 0))
+        self.assertEqual(self.store.objects, {video.get_name(): '0123456789',
+                                              image.get_name(): 'jpeg'})
+        video = Video.objects.get(pk=video.pk)
+        self.assertTrue(video.uploaded)
+        self.assertFalse(os.path.exists(video.get_path()))
+        self.assertEqual(self.uploader.sync(), (0, 0))
+
+    def test_resume(self):
+        """Ensure an interrupted upload only sends the missing parts."""
+        video = Video.objects.create(camera_id=1, mime='video/x-matroska',
+                                     closed=timezone.now())
+        video.write('0123456789')
+        store = self.uploader.store = FailingObjectStore()
+        self.assertEqual(self.uploader.sync(), (0, 1))
+        video = Video.objects.get(pk=video.pk)
+        self.assertTrue(video.upload_id)
+        self.assertFalse(video.uploaded)
+        store.failing = False
+        self.assertEqual(self.uploader.sync(), (1, 0))
+        self.assertEqual(sorted(store.sent), [1, 2, 3])
+        self.assertEqual(store.objects[video.get_name()], '0123456789')
+        self.assertEqual(Video.objects.get(pk=video.pk).upload_id, '')
+
+    def test_pending(self):
+        """Ensure videos still recording and recent stills are kept."""
+        Video.objects.create(camera_id=1, mime='video/x-matroska')
+        Image.objects.create(camera_id=1, mime='image/jpeg')
+        self.uploader.image_age = 300
+        self.assertEqual(self.uploader.get_pending(), [])
+
+    def test_segmented(self):
+        video = Video.objects.create(camera_id=1, mime='video/x-matroska',
+                                     segmented=True, closed=timezone.now())
+        for i in range(3):
+            segment = Segment.objects.create(video=video, sequence=i,
+                                             filename='%05d.mkv' % i,
+                                             start=i, duration=1)
+            with segment.open('wb') as f:
+                f.write(str(i))
+        self.assertEqual(self.uploader.sync(), (1, 0))
+        self.assertEqual(sorted(self.store.objects.values()), ['0', '1', '2'])
+        with self.settings(UPLOAD_STORE='main.storage.MemoryObjectStore'):
+            storage.OBJECT_STORE = self.store
+            try:
+                segment = Video.objects.get(pk=video.pk).segments.all()[1]
+                self.assertEqual(segment.open().read(), '1')
+            finally:
+                storage.OBJECT_STORE = None
+        self.assertFalse(os.path.exists(segment.get_path()))
+
+    def test_rate(self):
+        limiter = RateLimiter(1000)
+        start = time.time()
+        for i in range(3):
+            limiter.consume(500)
+        self.assertGreaterEqual(time.time() - start, 0.45)
+        RateLimiter().consume(10 ** 9)
+
+
+class ExpirerTest(TransactionTestCase):
+    fixtures = ('unittest', )
+
+    def setUp(self):
+        self.expirer = Expirer(batch_size=2, pause=0)
+        Retention.objects.create(user_id=1, days=7, alert_days=30)
+        Retention.objects.create(user_id=1, camera_id=2, days=1)
+
+    def create(self, model, days, **kwargs):
+        o = model.objects.create(**kwargs)
+        model.objects.filter(pk=o.pk).update(
+            created=timezone.now() - timedelta(days=days))
+        return model.objects.get(pk=o.pk)
+
+    def image(self, days, data=None):
+        image = self.create(Image, days, camera_id=1, mime='image/jpeg')
+        image.write(data or image.id)
+        image.save()
+        return image
+
+    def test_policies(self):
+        self.assertEqual(self.expirer.get_policies(), {1: (7, 30),
+                                                       2: (1, None)})
+        Retention.objects.all().delete()
+        self.assertEqual(self.expirer.get_policies(), {})
+        with self.settings(RETENTION_DAYS=90):
+            self.assertEqual(self.expirer.get_policies(), {1: (90, None),
+                                                           2: (90, None)})
+
+    def test_expire(self):
+        """Ensure old items are deleted in batches, alerts kept longer."""
+        old = [self.image(10) for i in range(3)]
+        new = self.image(1)
+        alerted = self.image(10)
+        alert = self.create(Event, 10, camera_id=1, image=alerted,
+                            event=Event.CAMERA_EVENT_ALERT)
+        self.create(Event, 40, camera_id=1, image=self.image(40),
+                    event=Event.CAMERA_EVENT_ALERT)
+        self.create(Event, 10, camera_id=1, event=Event.CAMERA_EVENT_MOTION)
+        self.create(Event, 1, camera_id=1, event=Event.CAMERA_EVENT_MOTION)
+        video = self.create(Video, 2, camera_id=2, mime='video/x-matroska',
+                            closed=timezone.now())
+        video.write('video')
+        self.create(Video, 2, camera_id=2, mime='video/x-matroska')
+
+        stats = self.expirer.expire()
+        self.assertEqual(stats, {'events': 2, 'images': 4, 'videos': 1,
+                                 'blobs': 4, 'bytes': 4 * 36 + 5})
+        self.assertEqual(set(Image.objects.values_list('id', flat=True)),
+                         set([new.id, alerted.id]))
+        self.assertEqual(Event.objects.count(), 2)
+        self.assertTrue(Event.objects.filter(pk=alert.pk).exists())
+        self.assertEqual(Video.objects.filter(closed=None).count(), 1)
+        for image in old:
+            self.assertFalse(os.path.exists(image.get_path()))
+        self.assertEqual(self.expirer.expire()['images'], 0)
+
+    def test_events(self):
+        """Ensure newer events outlive the expired image and video they
+        reference."""
+        video = self.create(Video, 10, camera_id=1, mime='video/x-matroska',
+                            closed=timezone.now())
+        event = self.create(Event, 1, camera_id=1, image=self.image(10),
+                            video=video, event=Event.CAMERA_EVENT_RECORDING)
+        stats = self.expirer.expire()
+        self.assertEqual((stats['images'], stats['videos'], stats['events']),
+                         (1, 1, 0))
+        event = Event.objects.get(pk=event.pk)
+        self.assertEqual((event.image_id, event.video_id), (None, None))
+
+    def test_blobs(self):
+        """Ensure a blob is deleted with the last image referencing it."""
+        old = self.image(10, 'jpeg')
+        new = self.image(1, 'jpeg')
+        self.assertEqual(old.blob_id, new.blob_id)
+        stats = self.expirer.expire()
+        self.assertEqual((stats['images'], stats['blobs']), (1, 0))
+        self.assertTrue(os.path.exists(new.get_path()))
+        Image.objects.all().delete()
+        self.assertEqual(self.expirer.expire()['blobs'], 1)
+        self.assertFalse(Blob.objects.exists())
+        self.assertFalse(os.path.exists(new.get_path()))
+
+
+class UsageTest(TransactionTestCase):
+    fixtures = ('unittest', )
+
+    def setUp(self):
+        Usage.objects.users.clear()
+
+    def usage(self, camera_id=None):
+        return Usage.objects.values_list('images', 'image_bytes', 'videos',
+                                         'video_bytes', 'uploaded_bytes') \
+            .get(user=1, camera=camera_id)
+
+    def test_count(self):
+        """Ensure files are counted as they are written and deleted."""
+        image = Image(camera_id=1, mime='image/jpeg')
+        image.write('jpeg')
+        image.save()
+        writer = WriteBehind(100, 60)
+        for i in range(2):
+            image = Image(camera_id=2, mime='image/jpeg')
+            image.write('data%s' % i)
+            writer.add(image)
+        writer.stop()
+        video = Video.objects.create(camera_id=2, mime='video/x-matroska')
+        video.write('video')
+        video.close()
+        self.assertEqual(self.usage(1), (1, 4, 0, 0, 0))
+        self.assertEqual(self.usage(2), (2, 10, 1, 5, 0))
+        self.assertEqual(self.usage(), (3, 14, 1, 5, 0))
+        Usage.objects.record([video], uploaded=True)
+        video.uploaded = timezone.now()
+        video.delete()
+        image.delete()
+        self.assertEqual(self.usage(), (2, 9, 0, 0, 0))
+        self.assertEqual(reconcile(), 0)
+
+    def test_reconcile(self):
+        image = Image(camera_id=1, mime='image/jpeg')
+        image.write('jpeg')
+        image.save()
+        Usage.objects.filter(camera=1).update(images=10, image_bytes=0)
+        Image.objects.filter(pk=image.pk).update(uploaded=timezone.now())
+        self.assertEqual(reconcile(), 2)
+        self.assertEqual(self.usage(1), (1, 4, 0, 0, 4))
+        self.assertEqual(self.usage(2), (0, 0, 0, 0, 0))
+        self.assertEqual(self.usage(), (1, 4, 0, 0, 4))
+
+    def test_move(self):
+        """Ensure a camera moved to another user is charged to them."""
+        Usage.objects.add(1, images=1)
+        user = User.objects.create(username='other')
+        zone = Camera.objects.get(pk=1).zone
+        zone.user = user
+        zone.save()
+        Usage.objects.add(1, images=1)
+        self.assertEqual(self.usage(), (1, 0, 0, 0, 0))
+        self.assertEqual(Usage.objects.values_list('images', flat=True)
+                         .get(user=user, camera=None), 1)
+
+    def test_backfill(self):
+        """Ensure rows whose file can not be measured do not keep the
+        others from being measured."""
+        # Ordered by id, the row that can be measured comes last.
+        for i in range(3):
+            Image.objects.create(id='backfill-%s' % i, camera_id=1,
+                                 mime='image/jpeg')
+        image = Image(id='backfill-3', camera_id=1, mime='image/jpeg')
+        image.write('jpeg')
+        image.save()
+        Image.objects.filter(pk=image.pk).update(size=0)
+        cursors, size = {}, usage.BACKFILL_SIZE
+        usage.BACKFILL_SIZE = 2
+        try:
+            self.assertEqual(backfill(cursors), 0)
+            self.assertEqual(backfill(cursors), 1)
+            self.assertEqual(backfill(cursors), 0)
+        finally:
+            usage.BACKFILL_SIZE = size
+        self.assertEqual(Image.objects.get(pk=image.pk).size, 4)
+        self.assertEqual(cursors, {Image: '', Video: ''})
+
+    def test_quota(self):
+        quotas = QuotaCache(ttl=60)
+        camera = Camera.objects.get(pk=1)
+        with self.settings(USAGE_QUOTA=4):
+            quotas.check(camera)
+            Image(camera_id=1, mime='image/jpeg').write('jpeg')
+            Usage.objects.add(1, image_bytes=4)
+            # Cached.
+            quotas.check(camera)
+            quotas.users.clear()
+            self.assertRaises(QuotaExceeded, quotas.check, camera)
+            Usage.objects.filter(user=1, camera=None).update(quota=5)
+            quotas.users.clear()
+            quotas.check(camera)
+
+
+class HealthCheckerTest(TransactionTestCase):
+    fixtures = ('unittest', )
+
+    def setUp(self):
+        self.server = ThreadedHTTPServer(('127.0.0.1', 0), HealthHandler)
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.checker = HealthChecker(spread=0, jitter=0)
+        Camera.objects.filter(auth=TEST_USERNAME).update(
+            url='http://127.0.0.1:%s/' % self.server.server_address[1])
+        Camera.objects.exclude(auth=TEST_USERNAME).update(url='http://127.0.0.1:1/')
+
+    def tearDown(self):
+        self.checker.shutdown()
+        self.server.shutdown()
+
+    def test_sweep(self):
+        """Ensure state changes and unreachable events are recorded once."""
+        self.checker.sweep()
+        states = dict(Camera.objects.values_list('auth', 'state'))
+        self.assertEqual(states.pop(TEST_USERNAME), Camera.CAMERA_STATE_OK)
+        self.assertEqual(set(states.values()), set([Camera.CAMERA_STATE_UNREACHABLE]))
+        events = Event.objects.filter(event=Event.CAMERA_EVENT_UNREACHABLE)
+        self.assertEqual(events.count(), len(states))
+        self.checker.sweep()
+        self.assertEqual(events.count(), len(states))
+        self.assertEqual(set(events.values_list('count', flat=True)), set([2]))
+
+    def test_alert(self):
+        """Ensure an alert is sent on the nth failure only."""
+        alerts = Event.objects.filter(event=Event.CAMERA_EVENT_ALERT)
+        self.checker.alert_after = 2
+        self.checker.sweep()
+        self.assertEqual(alerts.count(), 0)
+        self.checker.sweep()
+        cameras = Camera.objects.exclude(auth=TEST_USERNAME).count()
+        self.assertEqual(alerts.count(), cameras)
+        self.checker.sweep()
+        self.assertEqual(alerts.count(), cameras)
+
+    def test_no_outage(self):
+        """Ensure a camera left unreachable without an open outage gets one,
+        which is counted and alerted on."""
+        Camera.objects.exclude(auth=TEST_USERNAME).update(
+            state=Camera.CAMERA_STATE_UNREACHABLE)
+        outages = Event.objects.filter(event=Event.CAMERA_EVENT_UNREACHABLE)
+        alerts = Event.objects.filter(event=Event.CAMERA_EVENT_ALERT)
+        cameras = Camera.objects.exclude(auth=TEST_USERNAME).count()
+        self.checker.alert_after = 2
+        self.checker.sweep()
+        self.assertEqual(outages.count(), cameras)
+        self.assertEqual(alerts.count(), 0)
+        self.checker.sweep()
+        self.assertEqual(set(outages.values_list('count', flat=True)),
+                         set([2]))
+        self.assertEqual(alerts.count(), cameras)
+
+    def test_recover(self):
+        """Ensure the outage is closed on recovery."""
+        camera = Camera.objects.get(auth=TEST_USERNAME)
+        camera.set_state(Camera.CAMERA_STATE_UNREACHABLE)
+        outage = camera.events.create(event=Event.CAMERA_EVENT_UNREACHABLE,
+                                      count=4)
+        self.checker.sweep()
+        self.assertEqual(Camera.objects.get(id=camera.id).state,
+                         Camera.CAMERA_STATE_OK)
+        self.assertIsNotNone(Event.objects.get(id=outage.id).closed)
+
+
+class SchedulerTest(TransactionTestCase):
+    fixtures = ('unittest', )
+
+    def setUp(self):
+        self.camera = Camera.objects.get(auth=TEST_USERNAME)
+        self.period = Period.objects.create(camera=self.camera, interval=10,
+                                            action=Period.PERIOD_ACTION_CAPTURE)
+        self.dispatched = []
+        self.scheduler = Scheduler(dispatch=self.dispatched.append)
+
+    def test_run(self):
+        """Ensure a period runs once per interval."""
+        now = 1000000
+        next_run = self.scheduler.tick(now)
+        self.assertEqual(self.dispatched, [])
+        self.assertTrue(now < next_run <= now + 10)
+        next_run = self.scheduler.get_next_run(self.period, now)
+        for t in range(now, now + 30):
+            self.scheduler.tick(t)
+        self.assertEqual(len(self.dispatched), 3)
+        self.assertEqual(self.scheduler.get_next_run(self.period, next_run),
+                         next_run + 10)
+
+    def test_reload(self):
+        """Ensure changed and disabled periods are picked up."""
+        now = 1000000
+        self.scheduler.tick(now)
+        self.scheduler.since -= timedelta(seconds=10)
+        self.period.interval = 1
+        self.period.save()
+        with self.assertNumQueries(3):
+            self.scheduler.tick(now + self.scheduler.reload_interval)
+        self.assertEqual(self.scheduler.periods[self.period.id].interval, 1)
+        self.camera.disabled = True
+        self.camera.save()
+        self.scheduler.tick(now + self.scheduler.reload_interval * 2)
+        self.assertEqual(self.scheduler.periods, {})
+
+    def test_window(self):
+        period = Period(start=time_of_day(22), end=time_of_day(6))
+        self.assertTrue(period.in_window(time_of_day(23)))
+        self.assertTrue(period.in_window(time_of_day(1)))
+        self.assertFalse(period.in_window(time_of_day(12)))
+        self.assertTrue(Period().in_window(time_of_day(12)))
+
+
+class SleepCamera(BaseCamera):
+    """Records by sleeping, which stops on SIGINT like ffmpeg."""
+    def get_record_args(self, video):
+        return ['sleep', '30']
+
+
+class SegmentCamera(BaseCamera):
+    """Lists a segment at once and another when interrupted, like ffmpeg
+    with -f segment."""
+    def get_record_args(self, video):
+        path = video.get_segment_list()
+        return ['sh', '-c', 'printf "00000.mkv,0.0,10.0\\n00001.mkv,10" > %s; '
+                'trap \'kill $!; printf ".0,12.5\\n" >> %s; exit\' INT; '
+                'sleep 30 & wait' % (path, path)]
+
+
+class SpoolCamera(BaseCamera):
+    """Writes a one second segment every 50ms, like ffmpeg with -f
+    segment."""
+    def get_segment_args(self, directory, segment_list, segment_time=None):
+        return ['sh', '-c', 'i=0; while true; do f=$(printf %%05d.mkv $i); '
+                'printf x > %s/$f; printf "$f,$i,$((i+1))\\n" >> %s; '
+                'i=$((i+1)); sleep 0.05; done' % (directory, segment_list)]
+
+
+class RecorderTest(TransactionTestCase):
+    fixtures = ('unittest', )
+
+    def setUp(self):
+        STATE.clear()
+        self.camera = Camera.objects.get(auth=TEST_USERNAME)
+        self.recorder = Recorder(address=os.path.join(tempfile.mkdtemp(),
+                                 'recorder.sock'), backend=SleepCamera,
+                                 spool_dir=tempfile.mkdtemp())
+
+    def tearDown(self):
+        self.recorder.shutdown()
+
+    def wait(self):
+        for i in range(50):
+            self.recorder.tick()
+            if not self.recorder.recordings:
+                break
+            time.sleep(0.1)
+
+    def test_record(self):
+        """Ensure a recording is started, stopped at its deadline and
+        recorded as an event."""
+        self.recorder.handle({'command': 'record', 'camera': self.camera.id,
+                              'duration': 0})
+        self.assertEqual(Camera.objects.get(id=self.camera.id).state,
+                         Camera.CAMERA_STATE_RECORDING)
+        self.wait()
+        self.assertEqual(self.recorder.recordings, {})
+        self.assertEqual(Camera.objects.get(id=self.camera.id).state,
+                         Camera.CAMERA_STATE_OK)
+        self.assertEqual(self.camera.events.filter(
+                         event=Event.CAMERA_EVENT_RECORDING).count(), 1)
+
+    def test_extend(self):
+        """Ensure further motion extends the current recording."""
+        message = {'command': 'record', 'camera': self.camera.id,
+                   'duration': 0}
+        self.recorder.handle(message)
+        recording = self.recorder.recordings[self.camera.id]
+        message['duration'] = 60
+        self.recorder.handle(message)
+        self.recorder.tick()
+        self.assertIs(self.recorder.recordings[self.camera.id], recording)
+        self.assertIsNone(recording.stopping)
+
+    def test_motion(self):
+        """Ensure a recording continues while stills are received."""
+        self.recorder.handle({'command': 'record', 'camera': self.camera.id,
+                              'duration': 0})
+        recording = self.recorder.recordings[self.camera.id]
+        recording.duration = 60
+        STATE.touch_motion(self.camera.id)
+        self.recorder.tick()
+        self.assertIsNone(recording.stopping)
+        self.assertGreater(recording.deadline, time.time() + 30)
+
+    def test_disabled(self):
+        """Ensure disabling a camera stops its recording."""
+        self.recorder.handle({'command': 'record', 'camera': self.camera.id,
+                              'duration': 60})
+        self.camera.disabled = True
+        self.camera.save()
+        self.wait()
+        self.assertEqual(self.recorder.recordings, {})
+
+    def test_segments(self):
+        """Ensure segments are registered as they are closed."""
+        self.recorder.backend = SegmentCamera
+        self.recorder.handle({'command': 'record', 'camera': self.camera.id,
+                              'duration': 60})
+        recording = self.recorder.recordings[self.camera.id]
+        for i in range(50):
+            self.recorder.tick()
+            if recording.segments:
+                break
+            time.sleep(0.1)
+        video = recording.video
+        self.assertTrue(video.segmented)
+        self.assertEqual([(s.sequence, s.filename, s.duration) for s in
+                          video.segments.all()], [(0, '00000.mkv', 10.0)])
+        recording.stop()
+        self.wait()
+        self.assertEqual([(s.sequence, s.start, s.duration) for s in
+                          video.segments.all()], [(0, 0.0, 10.0),
+                                                  (1, 10.0, 2.5)])
+        self.assertIsNotNone(Video.objects.get(id=video.id).closed)
+
+    def test_preroll(self):
+        """Ensure a recording starts with the buffered footage and carries
+        on from the same process, which keeps buffering once stopped."""
+        self.recorder.backend = SpoolCamera
+        self.camera.preroll = 3
+        self.camera.save()
+        self.recorder.load_spools()
+        spool = self.recorder.spools[self.camera.id]
+        for i in range(50):
+            self.recorder.tick()
+            if self.recorder.preroll.size >= 3:
+                break
+            time.sleep(0.1)
+        self.assertEqual(self.recorder.preroll.snapshot()['cameras'][
+                         self.camera.id]['seconds'], 3.0)
+        self.recorder.handle({'command': 'record', 'camera': self.camera.id,
+                              'duration': 60})
+        recording = self.recorder.recordings[self.camera.id]
+        self.assertIs(recording.process, spool.process)
+        self.assertEqual(recording.segments, 3)
+        self.assertEqual(self.recorder.preroll.size, 0)
+        time.sleep(0.2)
+        self.recorder.tick()
+        self.assertGreater(recording.segments, 3)
+        recording.stop()
+        self.recorder.tick()
+        self.assertEqual(self.recorder.recordings, {})
+        self.assertFalse(spool.exited.done())
+        segments = list(recording.video.segments.all())
+        self.assertEqual([s.start for s in segments],
+                         [float(i) for i in range(len(segments))])
+        with segments[0].open() as f:
+            self.assertEqual(f.read(), 'x')
+        time.sleep(0.2)
+        self.recorder.tick()
+        self.assertGreater(self.recorder.preroll.size, 0)
+        self.camera.preroll = 0
+        self.camera.save()
+        self.recorder.load_spools()
+        self.assertEqual(self.recorder.spools, {})
+        self.assertTrue(spool.exited.done())
+
+    def test_command(self):
+        """Ensure commands are received over the socket."""
+        self.recorder.bind()
+        with self.settings(RECORDER_SOCKET=self.recorder.address):
+            recorder.record(self.camera, 60)
+            self.recorder.poll(1)
+            self.assertIn(self.camera.id, self.recorder.recordings)
+            recorder.stop(self.camera)
+            self.recorder.poll(1)
+        self.wait()
+        self.assertEqual(self.recorder.recordings, {})
+
+    def test_errors(self):
+        """Ensure a recording that fails to finish or restart does not stop
+        the others, and that finishing is tried again."""
+        other = Camera.objects.exclude(id=self.camera.id)[0]
+        finish, start = self.recorder.finish, self.recorder.start
+        failed = []
+
+        def fail_once(f, recording, *args):
+            if recording.camera.id == self.camera.id and f not in failed:
+                failed.append(f)
+                raise IOError('Failed')
+            return f(recording, *args)
+        self.recorder.finish = lambda r: fail_once(finish, r)
+        for camera in (self.camera, other):
+            self.recorder.handle({'command': 'record', 'camera': camera.id,
+                                  'duration': 60})
+            self.recorder.recordings[camera.id].stop()
+        self.wait()
+        self.assertEqual(self.recorder.recordings, {})
+        self.assertEqual(failed, [finish])
+        for camera in (self.camera, other):
+            self.assertEqual(camera.events.filter(
+                             event=Event.CAMERA_EVENT_RECORDING).count(), 1)
+
+        for camera in (self.camera, other):
+            self.recorder.handle({'command': 'record', 'camera': camera.id,
+                                  'duration': 60})
+            recording = self.recorder.recordings[camera.id]
+            recording.stop()
+            recording.restart = time.time() + 60
+
+        def fail_start(camera_id, *args):
+            if camera_id == self.camera.id:
+                raise OSError('Failed')
+            return start(camera_id, *args)
+        self.recorder.start = fail_start
+        for i in range(50):
+            self.recorder.tick()
+            if all(r.stopping is None for r in
+                   self.recorder.recordings.values()):
+                break
+            time.sleep(0.1)
+        self.assertEqual(self.recorder.recordings.keys(), [other.id])
+
+
+class PrerollTest(SimpleTestCase):
+    def chunk(self, size=10, duration=1.0):
+        return Chunk(time.time(), duration, '.mkv', 'x' * size)
+
+    def test_seconds(self):
+        """Ensure a buffer keeps the chunks covering its seconds."""
+        ring = RingBuffer(3, 1000)
+        for i in range(10):
+            ring.add(self.chunk())
+        self.assertEqual((len(ring.chunks), ring.length, ring.size),
+                         (3, 3.0, 30))
+        self.assertEqual(len(ring.flush()), 3)
+        self.assertEqual((ring.length, ring.size), (0, 0))
+
+    def test_camera_limit(self):
+        preroll = Preroll(max_bytes=1000, camera_max_bytes=25)
+        for i in range(5):
+            preroll.add(1, 10, self.chunk())
+        snapshot = preroll.snapshot()
+        self.assertEqual(snapshot['bytes'], 20)
+        self.assertEqual(snapshot['cameras'][1]['dropped'], 3)
+
+    def test_limit(self):
+        """Ensure the largest buffer gives way when over the total."""
+        preroll = Preroll(max_bytes=50, camera_max_bytes=1000)
+        for i in range(4):
+            preroll.add(1, 10, self.chunk())
+        preroll.add(2, 10, self.chunk())
+        preroll.add(2, 10, self.chunk())
+        self.assertEqual(preroll.size, 50)
+        self.assertEqual(preroll.dropped, 1)
+        self.assertEqual(preroll.buffers[1].size, 30)
+        self.assertEqual(len(preroll.flush(2)), 2)
+        self.assertEqual(preroll.size, 30)
+
+
 class ThreadedSMTPServer(SMTPServer):
     def __init__(self, *args, **kwargs):
         SMTPServer.__init__(self, *args, **kwargs)
@@ -77,11 +1274,29 @@ class ThreadedSMTPServer(SMTPServer):
         self.thread.join()
 
 
+class ThreadedIngestSMTPServer(IngestSMTPServer):
+    def __init__(self, *args, **kwargs):
+        IngestSMTPServer.__init__(self, *args, **kwargs)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=asyncore.loop,
+                                       kwargs={'timeout': 0.1,
+                                               'use_poll': True})
+        self.thread.start()
+
+    def stop(self):
+        IngestSMTPServer.stop(self)
+        self.thread.join()
+
+
 class SMTPTest(TransactionTestCase):
     fixtures = ('unittest', )
+    server_class = ThreadedSMTPServer
 
     def setUp(self):
-        self.server = ThreadedSMTPServer(('127.0.0.1', 0))
+        CAMERAS.clear()
+        self.server = self.server_class(('127.0.0.1', 0))
         self.server.start()
         self.client = smtplib.SMTP('127.0.0.1', self.server.socket.getsockname()[1])
 
@@ -130,8 +1345,49 @@ class SMTPTest(TransactionTestCase):
             self.fail('Could not send email due to authentication failure')
         self.client.sendmail('unittest@example.org', ['unittest@example.org'],
                              TEST_MULTIPART)
+        WRITER.flush()
         self.assertGreater(Image.objects.all().count(), 0)
 
+    def test_quota(self):
+        """Ensure a still from a user over quota is refused for good."""
+        self.client.login(TEST_USERNAME, TEST_PASSWORD)
+        QUOTAS.users.clear()
+        try:
+            with self.settings(USAGE_QUOTA=0):
+                with self.assertRaises(smtplib.SMTPDataError) as cm:
+                    self.client.sendmail('unittest@example.org',
+                                         ['unittest@example.org'],
+                                         TEST_MULTIPART)
+        finally:
+            QUOTAS.users.clear()
+        self.assertEqual(cm.exception.smtp_code, 552)
+        WRITER.flush()
+        self.assertEqual(Image.objects.count(), 0)
+
+
+class IngestSMTPTest(SMTPTest):
+    """Runs the SMTP tests against the executor based server."""
+    server_class = ThreadedIngestSMTPServer
+
+    def test_auth_initial(self):
+        """Ensure a username sent along with AUTH LOGIN is accepted."""
+        self.client.ehlo()
+        code, resp = self.client.docmd('AUTH', 'LOGIN %s' % base64.b64encode(TEST_USERNAME))
+        self.assertEqual(code, 334)
+        code, resp = self.client.docmd(base64.b64encode(TEST_PASSWORD))
+        self.assertEqual(code, 235)
+
+    def test_pipelined(self):
+        """Ensure commands received while the password is being checked are
+        answered in order."""
+        self.client.ehlo()
+        self.client.send('AUTH LOGIN %s\r\n%s\r\nNOOP\r\n' % (
+                         base64.b64encode(TEST_USERNAME),
+                         base64.b64encode(TEST_PASSWORD)))
+        self.assertEqual(self.client.getreply()[0], 334)
+        self.assertEqual(self.client.getreply()[0], 235)
+        self.assertEqual(self.client.getreply()[0], 250)
+
 
 class ThreadedFTPServer(threading.Thread):
     "Threaded FTP server for running unit tests."
@@ -158,6 +1414,7 @@ class FTPTest(TransactionTestCase):
     fixtures = ('unittest', )
 
     def setUp(self):
+        CAMERAS.clear()
         handler = FTPHandler
         handler.authorizer = FTPAuth()
         handler.abstracted_fs = FTPImageStorageFS
@@ -192,4 +1449,8 @@ class FTPTest(TransactionTestCase):
         except ftplib.error_perm:
             self.fail('Could not upload due to authentication failure')
         self.client.storbinary('STOR example.jpg', StringIO(TEST_IMAGE))
+        # The server handles the upload before it answers the next command.
+        self.client.voidcmd('NOOP')
+        WRITER.flush()
         self.assertGreater(Image.objects.all().count(), 0)
+        self.assertEqual(Event.objects.filter(event=Event.CAMERA_EVENT_MOTION).count(), 1)
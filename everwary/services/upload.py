@@ -0,0 +1,185 @@
+import time
+import shutil
+import logging
+import datetime
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_connection
+from django.utils import timezone
+
+from main.models import Image
+from main.models import Video
+from main.models import Usage
+from main.storage import get_object_store
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Most files picked up by each sync.
+BATCH_SIZE = 1000
+
+
+class RateLimiter(object):
+    """A token bucket shared by threads, `rate` bytes per second with bursts
+    of up to a second's worth. No limit when `rate` is None."""
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.tokens = rate or 0
+        self.last = time.time()
+
+    def consume(self, n):
+        """Waits until `n` bytes may be sent."""
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Uploader(object):
+    """Moves the files of finished Videos and Images to the object store.
+
+    Up to `files` files are uploaded at once. Files larger than `part_size`
+    are sent as multipart uploads, their parts, and the segments of
+    segmented videos, sent on a pool of `workers` threads. The id of a
+    multipart upload is saved as it starts, so an upload interrupted by a
+    crash resumes with the parts the store is missing. Once the store has
+    the whole file the row is marked uploaded and the local copy deleted."""
+    def __init__(self, store=None, workers=None, files=None, part_size=None,
+                 rate=None, image_age=None):
+        self.store = store or get_object_store()
+        self.workers = workers or getattr(settings, 'UPLOAD_WORKERS', 8)
+        self.files = files or getattr(settings, 'UPLOAD_FILES', 4)
+        self.part_size = part_size or getattr(settings, 'UPLOAD_PART_SIZE',
+                                              8 * 1024 * 1024)
+        self.image_age = image_age if image_age is not None else \
+            getattr(settings, 'UPLOAD_IMAGE_AGE', 300)
+        self.limiter = RateLimiter(rate or getattr(settings, 'UPLOAD_RATE',
+                                                   None))
+        # Separate pools, files wait on their parts.
+        self.file_pool = ThreadPoolExecutor(self.files)
+        self.part_pool = ThreadPoolExecutor(self.workers)
+
+    def get_pending(self):
+        """Returns the Images old enough to be done with and the closed
+        Videos that are not uploaded yet."""
+        age = timezone.now() - datetime.timedelta(seconds=self.image_age)
+        videos = Video.objects.filter(uploaded=None, closed__isnull=False)
+        images = Image.objects.filter(uploaded=None, created__lt=age)
+        return list(videos[:BATCH_SIZE]) + list(images[:BATCH_SIZE])
+
+    def sync(self):
+        """Uploads the pending files, returns how many were uploaded and
+        how many failed."""
+        start = time.time()
+        jobs = [(o, self.file_pool.submit(self.upload_pending, o))
+                for o in self.get_pending()]
+        uploaded, failed = 0, 0
+        for o, job in jobs:
+            try:
+                job.result()
+            except Exception:
+                LOGGER.exception('Could not upload %s %s',
+                                 type(o).__name__, o.id)
+                failed += 1
+            else:
+                uploaded += 1
+        if jobs:
+            LOGGER.info('Uploaded %s files in %.1fs, %s failed', uploaded,
+                        time.time() - start, failed)
+        return uploaded, failed
+
+    def upload_pending(self, o):
+        # Runs on the pool, whose threads have their own connections.
+        try:
+            self.upload(o)
+        finally:
+            close_connection()
+
+    def upload(self, o):
+        if isinstance(o, Video) and o.segmented:
+            jobs = [self.part_pool.submit(self.upload_segment, s)
+                    for s in o.segments.select_related('video')]
+            for job in jobs:
+                job.result()
+        elif isinstance(o, Image) and o.blob_id:
+            # Shared with other images, which are uploaded along with it.
+            if not self.store.exists(o.get_name()):
+                self.upload_file(o)
+        else:
+            self.upload_file(o)
+        if isinstance(o, Image) and o.blob_id:
+            rows = Image.objects.filter(blob=o.blob_id, uploaded=None)
+        else:
+            rows = type(o).objects.filter(pk=o.pk)
+        Usage.objects.record(rows.filter(uploaded=None), uploaded=True)
+        rows.update(uploaded=timezone.now(), upload_id='')
+        o.uploaded = timezone.now()
+        if isinstance(o, Video) and o.segmented:
+            shutil.rmtree(o.get_segment_dir(), ignore_errors=True)
+        else:
+            o.get_storage().delete(o.get_name())
+
+    def upload_segment(self, segment):
+        name = segment.get_name()
+        # Left by an earlier attempt that did not finish.
+        if self.store.exists(name):
+            return
+        with open(segment.get_path(), 'rb') as f:
+            data = f.read()
+        self.limiter.consume(len(data))
+        self.store.put(name, data)
+
+    def upload_file(self, o):
+        name = o.get_name()
+        size = o.get_storage().size(name)
+        if size <= self.part_size:
+            with o.open('rb') as f:
+                data = f.read()
+            self.limiter.consume(len(data))
+            self.store.put(name, data)
+            return
+
+        done = {}
+        if o.upload_id:
+            try:
+                done = self.store.list_parts(name, o.upload_id)
+            except Exception, e:
+                LOGGER.warning('Restarting upload of %s: %s', name, e)
+                o.upload_id = ''
+        if not o.upload_id:
+            o.upload_id = self.store.create_multipart(name)
+            type(o).objects.filter(pk=o.pk).update(upload_id=o.upload_id)
+
+        jobs = []
+        for number, offset in enumerate(range(0, size, self.part_size), 1):
+            length = min(self.part_size, size - offset)
+            if done.get(number) == length:
+                continue
+            jobs.append(self.part_pool.submit(self.upload_part, o, name,
+                                              o.upload_id, number, offset,
+                                              length))
+        for job in jobs:
+            job.result()
+        self.store.complete(name, o.upload_id)
+
+    def upload_part(self, o, name, upload_id, number, offset, length):
+        with o.open('rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        self.limiter.consume(len(data))
+        self.store.upload_part(name, upload_id, number, data)
+
+    def shutdown(self):
+        self.file_pool.shutdown()
+        self.part_pool.shutdown()
@@ -0,0 +1,127 @@
+import time
+import errno
+import logging
+import threading
+import collections
+
+from django.conf import settings
+from django.db.models import Sum
+from django.db.models import Count
+from django.utils import timezone
+
+from main.models import Image
+from main.models import Video
+from main.models import Usage
+from main.models import Camera
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Most rows whose size is measured by each reconciliation.
+BACKFILL_SIZE = 1000
+
+COUNTERS = ('images', 'image_bytes', 'videos', 'video_bytes',
+            'uploaded_bytes')
+
+
+class QuotaExceeded(IOError):
+    def __init__(self, camera):
+        super(QuotaExceeded, self).__init__(
+            errno.EDQUOT, 'Storage quota exceeded for %s' % camera)
+
+
+class QuotaCache(object):
+    """Remembers whether each user is over quota for `ttl` seconds, so
+    ingest checks a still with a dict lookup, and the database once in a
+    while."""
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.users = {}
+
+    def over_quota(self, camera_id):
+        user_id = Usage.objects.get_user(camera_id)
+        now = time.time()
+        with self.lock:
+            entry = self.users.get(user_id)
+        if entry is None or entry[0] < now:
+            quota = Usage.objects.get_quota(user_id)
+            over = quota is not None and \
+                Usage.objects.get_total(user_id) >= quota
+            entry = (now + self.ttl, over)
+            with self.lock:
+                self.users[user_id] = entry
+        return entry[1]
+
+    def check(self, camera):
+        """Raises QuotaExceeded if the user of `camera` is over quota."""
+        if self.over_quota(camera.id):
+            raise QuotaExceeded(camera)
+
+
+QUOTAS = QuotaCache(getattr(settings, 'USAGE_QUOTA_CACHE_TTL', 10))
+
+
+def backfill(cursors):
+    """Measures the files of rows stored before sizes were recorded, up to
+    BACKFILL_SIZE rows of each model per call. `cursors` holds the last row
+    looked at by model, and is updated so that the next call carries on
+    from there, past rows whose file is missing or empty. Returns how many
+    were measured."""
+    count = 0
+    for model, queryset in ((Image, Image.objects.all()),
+                            (Video, Video.objects.filter(closed__isnull=False))):
+        rows = list(queryset.filter(size=0, uploaded=None,
+                                    pk__gt=cursors.get(model, ''))
+                    .order_by('pk')[:BACKFILL_SIZE])
+        for o in rows:
+            size = o.get_size()
+            if size:
+                model.objects.filter(pk=o.pk).update(size=size)
+                count += 1
+        # Start over once every row was looked at.
+        cursors[model] = rows[-1].pk if len(rows) == BACKFILL_SIZE else ''
+    return count
+
+
+def reconcile():
+    """Recounts the files of every camera and user, correcting counters
+    that drifted (from a crash between writing a file and counting it,
+    say). Files written while this runs may be counted twice or not at
+    all, until the next run. Returns the number of rows corrected."""
+    counts = collections.defaultdict(lambda: dict.fromkeys(COUNTERS, 0))
+    for queryset, kind in (
+            (Image.objects.all(), 'image'),
+            (Video.objects.filter(closed__isnull=False), 'video')):
+        for row in queryset.values('camera').annotate(n=Count('id'),
+                                                      bytes=Sum('size')):
+            counts[row['camera']][kind + 's'] = row['n']
+            counts[row['camera']][kind + '_bytes'] = row['bytes'] or 0
+        for row in queryset.filter(uploaded__isnull=False) \
+                .values('camera').annotate(bytes=Sum('size')):
+            counts[row['camera']]['uploaded_bytes'] += row['bytes'] or 0
+    rows = []
+    users = collections.defaultdict(lambda: dict.fromkeys(COUNTERS, 0))
+    for camera_id, user_id in Camera.objects.values_list('id', 'zone__user'):
+        rows.append(((user_id, camera_id), counts[camera_id]))
+        for key, value in counts[camera_id].items():
+            users[user_id][key] += value
+    rows.extend(((user_id, None), c) for user_id, c in users.items())
+
+    corrected = 0
+    now = timezone.now()
+    existing = dict(((u.user_id, u.camera_id), u)
+                    for u in Usage.objects.all())
+    for (user_id, camera_id), c in rows:
+        usage = existing.get((user_id, camera_id))
+        if usage is None:
+            usage, created = Usage.objects.get_or_create(user_id=user_id,
+                                                         camera_id=camera_id)
+        drift = dict((k, c[k] - getattr(usage, k)) for k in COUNTERS
+                     if c[k] != getattr(usage, k))
+        if drift:
+            LOGGER.info('Correcting usage of user %s camera %s by %s',
+                        user_id, camera_id, drift)
+            corrected += 1
+        Usage.objects.filter(pk=usage.pk).update(reconciled=now, **c)
+    return corrected